@@ -0,0 +1,447 @@
+import argparse
+from datetime import datetime
+import imp
+import json
+import os
+import psycopg2
+import sys
+import time
+
+
+"""
+Benchmarks distributions-etl against a repeatable, synthetic OpenLMIS dataset.
+
+Fills a scratch Postgres database (by default open_lmis_benchmark on the ETL's DB_HOST/DB_PORT/DB_USER, which
+must already exist) with facilities, a country > province > district geographic zone hierarchy, delivery zones,
+monthly periods, distributions, one facility visit per facility and period, and all of the line item tables.
+The data is generated by Postgres from a fixed random seed, so the same scale always gives the same data.  Then
+runs the ETL stages loadOpenLmis, generateLastVisitDate and storeVisits, records each stage's wall time, rows
+per second, bytes fetched and peak resident memory with the ETL's StageMetrics, and saves the results as JSON so
+runs can be compared.
+
+Limitations:
+ - Only the tables and columns the ETL reads are created, not the full OpenLMIS schema.
+ - Peak memory is the process's resident set size sampled every PEAK_RSS_INTERVAL seconds (see the ETL) while
+    a stage runs.  Where /proc isn't available it is the process's peak so far (ru_maxrss).
+
+"""
+
+
+ETL_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'distributions-etl.py')
+REPORT_DDL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'facility_visits_report.sql')
+BENCHMARK_DB_NAME = 'open_lmis_benchmark'
+
+# first period start, the ETL only reports on periods from 2014-04 on
+FIRST_PERIOD = '2014-04-01'
+
+# line item keys, as OpenLMIS names them, so every pivot produces the report's columns
+EPI_INV_PRODUCT_CODES = ['bcg20', 'bcgdil', 'gas', 'hpv2', 'measles10', 'measlesdil', 'pcv10', 'penta1', 'penta10',
+    'polio10', 'polio20', 'safetybox', 'syringe005ml', 'syringe05ml', 'syringe5ml', 'tetanus10']
+EPI_USE_PRODUCT_GROUP_CODES = ['1bcg', '2bcgdil', '3polio', '4penta', '5measles', '6measlesdil', '7pcv10', '8hpv',
+    '9tetanus']
+ADULT_COVERAGE_GROUPS = ['MIF 15-49 years - Students', 'MIF 15-49 years - Community', 'MIF 15-49 years - Workers',
+    'Students not MIF', 'Other not MIF', 'Workers not MIF', 'Pregnant Women']
+CHILD_COVERAGE_VACCINATIONS = ['BCG', 'Polio (Newborn)', 'Polio 1st dose', 'Polio 2nd dose', 'Polio 3rd dose',
+    'Penta 1st dose', 'Penta 2nd dose', 'Penta 3rd dose', 'PCV10 1st dose', 'PCV10 2nd dose', 'PCV10 3rd dose',
+    'Measles']
+CHILD_COVERAGE_PRODUCT_VIALS = ['BCG', 'Polio10', 'Polio20', 'Penta1', 'Penta10', 'PCV', 'Measles']
+
+
+# The source tables, with only the columns the ETL reads
+SCHEMA_DDL = """CREATE TABLE geographic_levels ( id integer PRIMARY KEY
+    , code text NOT NULL
+    , levelnumber integer NOT NULL
+    );
+CREATE TABLE geographic_zones ( id integer PRIMARY KEY
+    , code text NOT NULL
+    , levelid integer NOT NULL references geographic_levels(id)
+    , parentid integer references geographic_zones(id)
+    );
+CREATE TABLE facilities ( id integer PRIMARY KEY
+    , code text NOT NULL unique
+    , geographiczoneid integer NOT NULL references geographic_zones(id)
+    );
+CREATE TABLE delivery_zones ( id integer PRIMARY KEY
+    , code text NOT NULL
+    );
+CREATE TABLE processing_periods ( id integer PRIMARY KEY
+    , startdate date NOT NULL
+    );
+CREATE TABLE distributions ( id integer PRIMARY KEY
+    , deliveryzoneid integer NOT NULL references delivery_zones(id)
+    , periodid integer NOT NULL references processing_periods(id)
+    );
+CREATE TABLE facility_visits ( id integer PRIMARY KEY
+    , facilityid integer NOT NULL references facilities(id)
+    , distributionid integer NOT NULL references distributions(id)
+    , visited boolean
+    , visitdate date
+    , confirmedbyname text
+    , confirmedbytitle text
+    , verifiedbyname text
+    , verifiedbytitle text
+    , reasonfornotvisiting text
+    , otherreasondescription text
+    , observations text
+    , facilitycatchmentpopulation integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    );
+CREATE TABLE full_coverages ( id serial PRIMARY KEY
+    , facilityvisitid integer NOT NULL references facility_visits(id)
+    , femalehealthcenter integer
+    , femaleoutreach integer
+    , malehealthcenter integer
+    , maleoutreach integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    );
+CREATE TABLE adult_coverage_opened_vial_line_items ( id serial PRIMARY KEY
+    , facilityvisitid integer NOT NULL references facility_visits(id)
+    , productvialname text NOT NULL
+    , openedvials integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    );
+CREATE TABLE epi_inventory_line_items ( id serial PRIMARY KEY
+    , facilityvisitid integer NOT NULL references facility_visits(id)
+    , productcode text NOT NULL
+    , existingquantity integer
+    , spoiledquantity integer
+    , deliveredquantity integer
+    , idealquantity integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    );
+CREATE TABLE product_groups ( id integer PRIMARY KEY
+    , code text NOT NULL
+    );
+CREATE TABLE epi_use_line_items ( id serial PRIMARY KEY
+    , facilityvisitid integer NOT NULL references facility_visits(id)
+    , productgroupid integer NOT NULL references product_groups(id)
+    , stockatfirstofmonth integer
+    , stockatendofmonth integer
+    , expirationdate text
+    , received integer
+    , distributed integer
+    , loss integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    );
+CREATE TABLE vaccination_adult_coverage_line_items ( id serial PRIMARY KEY
+    , facilityvisitid integer NOT NULL references facility_visits(id)
+    , demographicgroup text NOT NULL
+    , healthcentertetanus1 integer
+    , outreachtetanus1 integer
+    , healthcentertetanus2to5 integer
+    , outreachtetanus2to5 integer
+    , targetgroup integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    );
+CREATE TABLE vaccination_child_coverage_line_items ( id serial PRIMARY KEY
+    , facilityvisitid integer NOT NULL references facility_visits(id)
+    , vaccination text NOT NULL
+    , healthcenter11months integer
+    , outreach11months integer
+    , healthcenter23months integer
+    , outreach23months integer
+    , targetgroup integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    );
+CREATE TABLE child_coverage_opened_vial_line_items ( id serial PRIMARY KEY
+    , facilityvisitid integer NOT NULL references facility_visits(id)
+    , productvialname text NOT NULL
+    , openedvials integer
+    , modifieddate timestamp NOT NULL DEFAULT now()
+    )"""
+
+
+# every table of SCHEMA_DDL and the report, dropped before generating
+BENCHMARK_TABLES = ['facility_visits_report', 'child_coverage_opened_vial_line_items',
+    'vaccination_child_coverage_line_items', 'vaccination_adult_coverage_line_items', 'epi_use_line_items',
+    'product_groups', 'epi_inventory_line_items', 'adult_coverage_opened_vial_line_items', 'full_coverages',
+    'facility_visits', 'distributions', 'processing_periods', 'delivery_zones', 'facilities', 'geographic_zones',
+    'geographic_levels']
+
+
+# (table, sql) filling each table of SCHEMA_DDL in order.  Ids are positional: facility f is in district
+# 1 + (f - 1) % districts and delivery zone 1 + (f - 1) % zones, and its visit in period p has id
+# (f - 1) * periods + p.  90% of facility visits happen, on a day within the period.
+GENERATE_SQL = [('geographic_levels', """INSERT INTO geographic_levels (id, code, levelnumber)
+    VALUES (1, 'country', 1), (2, 'commune', 2), (3, 'dept', 3)"""),
+    ('geographic_zones', """INSERT INTO geographic_zones (id, code, levelid, parentid)
+    SELECT 1, 'COUNTRY', 1, NULL
+    UNION ALL SELECT 1 + p, 'P' || p, 2, 1
+    FROM generate_series(1, %(provinces)s) AS p
+    UNION ALL SELECT 1 + %(provinces)s + d, 'D' || d, 3, 2 + (d - 1) %% %(provinces)s
+    FROM generate_series(1, %(districts)s) AS d"""),
+    ('facilities', """INSERT INTO facilities (id, code, geographiczoneid)
+    SELECT f, 'F' || lpad(f::text, 6, '0'), 2 + %(provinces)s + (f - 1) %% %(districts)s
+    FROM generate_series(1, %(facilities)s) AS f"""),
+    ('delivery_zones', """INSERT INTO delivery_zones (id, code)
+    SELECT z, 'DZ' || z
+    FROM generate_series(1, %(zones)s) AS z"""),
+    ('processing_periods', """INSERT INTO processing_periods (id, startdate)
+    SELECT p, (date %(firstPeriod)s + (p - 1) * interval '1 month')::date
+    FROM generate_series(1, %(periods)s) AS p"""),
+    ('distributions', """INSERT INTO distributions (id, deliveryzoneid, periodid)
+    SELECT (z - 1) * %(periods)s + p, z, p
+    FROM generate_series(1, %(zones)s) AS z, generate_series(1, %(periods)s) AS p"""),
+    ('facility_visits', """INSERT INTO facility_visits (id, facilityid, distributionid, visited, visitdate
+    , confirmedbyname, confirmedbytitle, verifiedbyname, verifiedbytitle, reasonfornotvisiting
+    , otherreasondescription, observations, facilitycatchmentpopulation)
+    SELECT v.id, v.f, (v.f - 1) %% %(zones)s * %(periods)s + v.p, v.visited
+    , CASE WHEN v.visited THEN period.startdate + floor(random() * 28)::integer END
+    , 'Confirmer ' || v.f, 'Nurse', 'Verifier ' || v.f, 'Supervisor'
+    , CASE WHEN NOT v.visited THEN 'TRANSPORT_UNAVAILABLE' END
+    , NULL, CASE WHEN random() < 0.1 THEN 'Observed at visit ' || v.id END
+    , 1000 + floor(random() * 20000)::integer
+    FROM (SELECT (f - 1) * %(periods)s + p AS id, f, p, random() < 0.9 AS visited
+	FROM generate_series(1, %(facilities)s) AS f, generate_series(1, %(periods)s) AS p) AS v
+    JOIN processing_periods AS period ON (period.id=v.p)"""),
+    ('full_coverages', """INSERT INTO full_coverages (facilityvisitid, femalehealthcenter, femaleoutreach
+    , malehealthcenter, maleoutreach)
+    SELECT fv.id, floor(random() * 50)::integer, floor(random() * 50)::integer, floor(random() * 50)::integer
+    , floor(random() * 50)::integer
+    FROM facility_visits AS fv"""),
+    ('adult_coverage_opened_vial_line_items', """INSERT INTO adult_coverage_opened_vial_line_items
+    (facilityvisitid, productvialname, openedvials)
+    SELECT fv.id, 'Tetanus', floor(random() * 20)::integer
+    FROM facility_visits AS fv"""),
+    ('epi_inventory_line_items', """INSERT INTO epi_inventory_line_items (facilityvisitid, productcode
+    , existingquantity, spoiledquantity, deliveredquantity, idealquantity)
+    SELECT fv.id, code, floor(random() * 500)::integer, floor(random() * 10)::integer
+    , floor(random() * 500)::integer, floor(random() * 1000)::integer
+    FROM facility_visits AS fv, unnest(%(epiInvCodes)s) AS code"""),
+    ('product_groups', """INSERT INTO product_groups (id, code)
+    SELECT i, code
+    FROM unnest(%(epiUseCodes)s) WITH ORDINALITY AS pg(code, i)"""),
+    ('epi_use_line_items', """INSERT INTO epi_use_line_items (facilityvisitid, productgroupid, stockatfirstofmonth
+    , stockatendofmonth, expirationdate, received, distributed, loss)
+    SELECT fv.id, pg.id, floor(random() * 500)::integer, floor(random() * 500)::integer
+    , to_char(date %(firstPeriod)s + floor(random() * 1500)::integer, 'MM/YYYY'), floor(random() * 500)::integer
+    , floor(random() * 500)::integer, floor(random() * 10)::integer
+    FROM facility_visits AS fv, product_groups AS pg"""),
+    ('vaccination_adult_coverage_line_items', """INSERT INTO vaccination_adult_coverage_line_items
+    (facilityvisitid, demographicgroup, healthcentertetanus1, outreachtetanus1, healthcentertetanus2to5
+    , outreachtetanus2to5, targetgroup)
+    SELECT fv.id, grp, floor(random() * 100)::integer, floor(random() * 100)::integer
+    , floor(random() * 100)::integer, floor(random() * 100)::integer, floor(random() * 1000)::integer
+    FROM facility_visits AS fv, unnest(%(adultGroups)s) AS grp"""),
+    ('vaccination_child_coverage_line_items', """INSERT INTO vaccination_child_coverage_line_items
+    (facilityvisitid, vaccination, healthcenter11months, outreach11months, healthcenter23months
+    , outreach23months, targetgroup)
+    SELECT fv.id, vacc, floor(random() * 100)::integer, floor(random() * 100)::integer
+    , floor(random() * 100)::integer, floor(random() * 100)::integer, floor(random() * 1000)::integer
+    FROM facility_visits AS fv, unnest(%(childVaccs)s) AS vacc"""),
+    ('child_coverage_opened_vial_line_items', """INSERT INTO child_coverage_opened_vial_line_items
+    (facilityvisitid, productvialname, openedvials)
+    SELECT fv.id, vial, floor(random() * 20)::integer
+    FROM facility_visits AS fv, unnest(%(childVials)s) AS vial""")]
+
+
+# line item tables indexed on facilityvisitid once filled, as the ETL looks line items up by facility visit
+LINE_ITEM_TABLES = ['full_coverages', 'adult_coverage_opened_vial_line_items', 'epi_inventory_line_items',
+    'epi_use_line_items', 'vaccination_adult_coverage_line_items', 'vaccination_child_coverage_line_items',
+    'child_coverage_opened_vial_line_items']
+
+
+def loadEtl():
+    """
+    @return the distributions-etl script as a module, reading fieldmap.csv from beside it
+    """
+    etl = imp.load_source('distributions_etl', ETL_SCRIPT)
+    etl.FIELD_MAP = os.path.join(os.path.dirname(ETL_SCRIPT), etl.FIELD_MAP)
+    return etl
+
+
+def scaleParams(facilities, periods):
+    """
+    @return the sql parameters of GENERATE_SQL for the given number of facilities and periods
+    """
+    districts = max(1, facilities // 50)
+    return {'facilities': facilities,
+	'periods': periods,
+	'districts': districts,
+	'provinces': max(1, districts // 10),
+	'zones': max(1, facilities // 100),
+	'firstPeriod': FIRST_PERIOD,
+	'epiInvCodes': EPI_INV_PRODUCT_CODES,
+	'epiUseCodes': EPI_USE_PRODUCT_GROUP_CODES,
+	'adultGroups': ADULT_COVERAGE_GROUPS,
+	'childVaccs': CHILD_COVERAGE_VACCINATIONS,
+	'childVials': CHILD_COVERAGE_PRODUCT_VIALS}
+
+
+def generateDataset(conn, facilities, periods, seed):
+    """
+    Drops and recreates every benchmark table, the report table included, and fills the source tables.
+    @param seed: Postgres random seed between -1 and 1, the same seed and scale always generate the same data
+    @return dict of table name => rows generated
+    """
+    params = scaleParams(facilities, periods)
+    cur = conn.cursor()
+    for tableName in BENCHMARK_TABLES:
+	cur.execute('DROP TABLE IF EXISTS ' + tableName)
+    cur.execute(SCHEMA_DDL)
+    cur.execute(reportDdl())
+
+    # a parallel plan would draw random numbers in several processes, and not repeatably
+    cur.execute('SET LOCAL max_parallel_workers_per_gather = 0')
+    cur.execute('SELECT setseed(%s)', (seed,))
+    rowCounts = {}
+    for tableName, sql in GENERATE_SQL:
+	started = time.time()
+	cur.execute(sql, params)
+	rowCounts[tableName] = cur.rowcount
+	print 'Generated %d %s rows in %.2fs' % (cur.rowcount, tableName, time.time() - started)
+
+    for tableName in LINE_ITEM_TABLES:
+	cur.execute('CREATE INDEX ON ' + tableName + ' (facilityvisitid)')
+    cur.execute('ANALYZE')
+    cur.close()
+    conn.commit()
+    return rowCounts
+
+
+def reportDdl():
+    """
+    @return the report table DDL from facility_visits_report.sql, less its DROP TABLE as the table is
+	dropped with the rest of the benchmark tables
+    """
+    f = open(REPORT_DDL)
+    ddl = f.read()
+    f.close()
+    return '\n'.join(line for line in ddl.splitlines() if not line.upper().startswith('DROP TABLE'))
+
+
+def runStage(etl, stageName, stageFn, rowCountFn):
+    """
+    Runs one benchmark stage, measured by the ETL's own stage metrics (see the ETL's measureStage).
+    @param stageFn: function of no arguments running the stage
+    @param rowCountFn: function of stageFn's result giving the number of rows the stage processed
+    @return tuple of stageFn's result and a dict of the stage's measurements
+    """
+    rssBefore = etl.currentRss()
+    with etl.measureStage('benchmark:' + stageName) as measured:
+	result = stageFn()
+	measured['rows'] = rowCountFn(result)
+
+    elapsed = measured['seconds']
+    stage = {'stage': stageName,
+	'seconds': round(elapsed, 3),
+	'rows': measured['rows'],
+	'rows_per_second': round(measured['rows'] / elapsed, 1) if elapsed > 0 else None,
+	'bytes_fetched': measured['bytes_fetched'],
+	'rss_before_bytes': rssBefore,
+	'peak_rss_bytes': measured['peak_rss_bytes']}
+    print '%s: %d rows in %.2fs (%.0f rows/s), peak rss %.1f MB' % (stageName, stage['rows'], elapsed,
+	stage['rows_per_second'] or 0, stage['peak_rss_bytes'] / 1048576.0)
+    return result, stage
+
+
+def runBenchmark(etl, conn, args):
+    """
+    Runs the ETL stages over the benchmark database, storing the report in it.
+    @return list of stage measurements, see runStage
+    """
+    fields = etl.loadFields()
+    layout = etl.visitRowLayout(fields)
+    stages = []
+
+    facVisitRows, stage = runStage(etl, 'loadOpenLmis', lambda: etl.loadOpenLmis(conn, itersize=args.itersize,
+	pivotEngine=args.pivot_engine, layout=layout), len)
+    stages.append(stage)
+
+    result, stage = runStage(etl, 'generateLastVisitDate', lambda: etl.generateLastVisitDate(facVisitRows),
+	lambda result: len(facVisitRows))
+    stages.append(stage)
+
+    result, stage = runStage(etl, 'storeVisits', lambda: etl.storeVisits(conn, facVisitRows, fields,
+	loadMethod=args.load_method, batchSize=args.batch_size), lambda result: len(facVisitRows))
+    stages.append(stage)
+    conn.commit()
+    return stages
+
+
+def compareResults(results, baseline):
+    """
+    Prints each stage's time against the same stage of a baseline run's results.
+    """
+    baselineStages = dict((stage['stage'], stage) for stage in baseline['stages'])
+    for stage in results['stages']:
+	before = baselineStages.get(stage['stage'])
+	if before is None or not before['seconds']:
+	    continue
+	print '%s: %.2fs vs %.2fs in baseline (%.2fx)' % (stage['stage'], stage['seconds'], before['seconds'],
+	    stage['seconds'] / before['seconds'])
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks distributions-etl against synthetic OpenLMIS data')
+    parser.add_argument('--database', default=BENCHMARK_DB_NAME,
+	help='the scratch database filled with synthetic data, its tables are dropped (default: %(default)s)')
+    parser.add_argument('--facilities', type=int, default=1000,
+	help='number of facilities generated (default: %(default)s)')
+    parser.add_argument('--periods', type=int, default=12,
+	help='number of monthly periods generated, each facility is visited once a period (default: %(default)s)')
+    parser.add_argument('--seed', type=float, default=0.5,
+	help='random seed between -1 and 1 for the generated data (default: %(default)s)')
+    parser.add_argument('--skip-generate', action='store_true',
+	help='benchmark the data already in the database instead of generating it')
+    parser.add_argument('--output', default=None,
+	help='file the JSON results are saved to (default: benchmark-<facilities>x<periods>-<time>.json)')
+    parser.add_argument('--baseline', default=None,
+	help='JSON results of an earlier run to compare stage times against')
+    parser.add_argument('--load-method', choices=['copy', 'insert'], default='copy',
+	help='passed to storeVisits (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=None,
+	help='report rows sent per COPY or INSERT statement (default: the ETL\'s)')
+    parser.add_argument('--itersize', type=int, default=None,
+	help='source rows fetched per round trip by the extraction cursors (default: the ETL\'s)')
+    parser.add_argument('--pivot-engine', choices=['python', 'sql', 'numpy'], default='python',
+	help='passed to loadOpenLmis (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    etl = loadEtl()
+    if args.batch_size is None:
+	args.batch_size = etl.LOAD_BATCH_SIZE
+    if args.itersize is None:
+	args.itersize = etl.EXTRACT_ITER_SIZE
+
+    started = datetime.now()
+    connectArgs = etl.dbConnectArgs()
+    connectArgs['database'] = args.database
+    conn = psycopg2.connect(**connectArgs)
+    try:
+	results = {'started': started.isoformat(),
+	    'scale': {'facilities': args.facilities, 'periods': args.periods, 'seed': args.seed},
+	    'options': {'pivot_engine': args.pivot_engine, 'load_method': args.load_method,
+		'batch_size': args.batch_size, 'itersize': args.itersize},
+	    'python': sys.version.split()[0],
+	    'postgres': conn.server_version}
+	if not args.skip_generate:
+	    generateStarted = time.time()
+	    results['generated_rows'] = generateDataset(conn, args.facilities, args.periods, args.seed)
+	    results['generate_seconds'] = round(time.time() - generateStarted, 3)
+	results['stages'] = runBenchmark(etl, conn, args)
+
+	# every stage the ETL measured within the benchmark's, e.g. each source query and pivot
+	results['etl_stages'] = etl.STAGE_METRICS.totals()
+    finally:
+	conn.close()
+
+    output = args.output or 'benchmark-%dx%d-%s.json' % (args.facilities, args.periods,
+	started.strftime('%Y%m%d%H%M%S'))
+    f = open(output, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
+    print 'Saved results to ' + output
+
+    if args.baseline is not None:
+	f = open(args.baseline)
+	baseline = json.load(f)
+	f.close()
+	compareResults(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
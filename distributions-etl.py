@@ -1,14 +1,53 @@
+import argparse
+import ConfigParser
+import cProfile
+from cStringIO import StringIO
 import csv
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import multiprocessing.util
+from multiprocessing.pool import ThreadPool
+import operator
+import os
+import pstats
+import Queue
 import psycopg2
 import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 import re
-import types
+import resource
+import select
+import shutil
+import sys
+import threading
+import time
 from pprint import pprint
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 
+try:
+    import numpy # only needed for --pivot-engine numpy
+except ImportError:
+    numpy = None
+
+try:
+    import tracemalloc # only needed for --trace-memory, in Python 2 from the pytracemalloc backport
+except ImportError:
+    tracemalloc = None
+
+try:
+    import pyarrow # only needed for --parquet
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 
 """
 Basic ETL script to denormalize, combine and do any necessary modifications to report on facility visits.  
@@ -18,6 +57,14 @@ Limitations:
  - adult coverage open vials are 1-1 with facility visits because all adult coverage tracks is tetanus.  This 
     exploits that and simply does a join to get adult_coverage_tetanus_vials_opened in reports.  So not useful outside 
     of Adult Coverage with just Tetanus.
+ - --incremental runs find changed facility visits by the modifieddate of facility_visits and their line items.  
+    Deleted facility visits, and changes to facilities, distributions or periods, are only picked up by a full run.
+    A modifieddate is set when its transaction writes the row, not when it commits, so the high-water marks are
+    taken HIGH_WATER_OVERLAP before the latest modifieddate and every run refreshes the visits of that window
+    again.  A transaction committing more than HIGH_WATER_OVERLAP after it wrote a row is still missed.
+ - --sources consolidates several OpenLMIS databases into facility_visits_report_sources rather than the report,
+    with each row's source key in its source_key column.  Facility, zone and period ids are those of the row's
+    source, so the consolidated table has no foreign keys to the source tables and isn't rolled up.
 
 """
 
@@ -28,6 +75,14 @@ DB_HOST = 'localhost'
 DB_PORT = '5432'
 DB_USER = "postgres"
 
+# Connection options a source of --sources may give, each defaulting to the DB_ setting above
+SOURCE_OPTIONS = ['host', 'port', 'database', 'user', 'password']
+# The column of FACILITY_VISIT_REPORT_SOURCES_TABLE holding the key of each row's source, see tagSourceRows
+SOURCE_KEY_COLUMN = 'source_key'
+
+# names the server side cursors opened by loadAllFromSql
+CURSOR_IDS = itertools.count()
+
 # table names
 ADULT_COVERAGE_TABLE = 'vaccination_adult_coverage_line_items'
 ADULT_COVERAGE_OPEN_VIAL_TABLE = 'adult_coverage_opened_vial_line_items'
@@ -37,9 +92,21 @@ DZ_TABLE = 'delivery_zones'
 DISTRIBUTION_TABLE = 'distributions'
 EPI_INV_TABLE = 'epi_inventory_line_items'
 EPI_USE_TABLE = 'epi_use_line_items'
+ETL_STATE_TABLE = 'facility_visits_report_etl_state'
+LINE_ITEM_CODE_TABLE = 'facility_visits_report_etl_codes'
+CHECKPOINT_TABLE = 'facility_visits_report_etl_checkpoint'
+CHECKPOINT_MARK_TABLE = 'facility_visits_report_etl_checkpoint_marks'
+PARQUET_PENDING_TABLE = 'facility_visits_report_etl_parquet_pending'
 FACILITY_TABLE = 'facilities'
 FACILITY_VISIT_TABLE = 'facility_visits'
 FACILITY_VISIT_REPORT_TABLE = 'facility_visits_report'
+FACILITY_VISIT_REPORT_STAGING_TABLE = 'facility_visits_report_staging'
+FACILITY_VISIT_REPORT_SWAP_TABLE = 'facility_visits_report_swap'
+FACILITY_VISIT_REPORT_VIEW = 'facility_visits_report_view'
+FACILITY_VISIT_REPORT_SOURCES_TABLE = 'facility_visits_report_sources'
+FACILITY_VISIT_DISTRICT_ROLLUP_TABLE = 'facility_visits_report_district_period'
+FACILITY_VISIT_PROVINCE_ROLLUP_TABLE = 'facility_visits_report_province_period'
+FACILITY_VISIT_DZ_ROLLUP_TABLE = 'facility_visits_report_delivery_zone_period'
 FULL_COVERAGE_TABLE = 'full_coverages'
 GEO_ZONE_TABLE = 'geographic_zones'
 GEO_LEVEL_TABLE = 'geographic_levels'
@@ -48,17 +115,147 @@ PRODUCT_TABLE = 'products'
 PRODUCT_GROUP_TABLE = 'product_groups'
 
 
+# Source tables watched by incremental runs and the column in each that refers to the facility visit.  Their
+# high-water marks are max(modifieddate), so each needs an index on modifieddate for taking them not to scan it,
+# e.g. CREATE INDEX ON facility_visits (modifieddate).
+INCREMENTAL_SOURCES = [(FACILITY_VISIT_TABLE, 'id'),
+    (FULL_COVERAGE_TABLE, 'facilityvisitid'),
+    (ADULT_COVERAGE_OPEN_VIAL_TABLE, 'facilityvisitid'),
+    (EPI_INV_TABLE, 'facilityvisitid'),
+    (EPI_USE_TABLE, 'facilityvisitid'),
+    (ADULT_COVERAGE_TABLE, 'facilityvisitid'),
+    (CHILD_COVERAGE_TABLE, 'facilityvisitid'),
+    (CHILD_COVERAGE_OPEN_VIAL_TABLE, 'facilityvisitid')]
+# How far the high-water marks are taken before the latest modifieddate.  A row written by a transaction that
+# commits after the marks were taken can carry a modifieddate below them; refreshing the visits of this window
+# again in the next run picks such rows up, and is harmless since the report rows are upserted.
+HIGH_WATER_OVERLAP = timedelta(minutes=10)
+
+
+# Number of report rows sent to the database per COPY (or INSERT) when storing visits
+LOAD_BATCH_SIZE = 5000
+
+
+# Number of rows fetched per round trip by the server side cursors used to extract source data
+EXTRACT_ITER_SIZE = 2000
+
+# Streamed query results measure the bytes fetched of one row in this many, see rowBytes
+FETCHED_BYTES_SAMPLE = 100
+
+
+# Report column holding a hash of the row's report fields, see --refresh changed
+ROW_HASH_COLUMN = 'row_hash'
+
+
+# The report column and rollup table of each grain the report is summed by per period, see --rollups
+ROLLUP_GRAINS = [('district_id', FACILITY_VISIT_DISTRICT_ROLLUP_TABLE),
+    ('province_id', FACILITY_VISIT_PROVINCE_ROLLUP_TABLE),
+    ('delivery_zone_id', FACILITY_VISIT_DZ_ROLLUP_TABLE)]
+
+
+# The integer report fields with these prefixes are summed by the rollups
+ROLLUP_FIELD_PREFIXES = ('epi_inventory_', 'epi_use_', 'child_coverage_', 'adult_coverage_')
+
+
+# Field map type => the pyarrow type of its Parquet column, see writeParquet
+PARQUET_TYPES = {'integer': 'int32', 'text': 'string', 'date': 'date32', 'boolean': 'bool_'}
+
+
+# Rows per row group of the Parquet files, the most rows held in memory while writing them
+PARQUET_ROW_GROUP_SIZE = 10000
+
+
+# Columns kept in every facility visit row besides the report fields in the field map
+ROW_EXTRA_COLUMNS = ['id', ROW_HASH_COLUMN]
+
+
+# --partition-by choice => the distributions column a partitioned run splits facility visits by
+PARTITION_COLUMNS = {'delivery-zone': 'deliveryzoneid', 'period': 'periodid'}
+# The report field holding each partition column's value, which the staged rows are counted by
+PARTITION_REPORT_COLUMNS = {'deliveryzoneid': 'delivery_zone_id', 'periodid': 'period_id'}
+
+
+# Partitions per worker process in partitioned runs, more than one so a process that finishes early takes more
+PARTITIONS_PER_PROCESS = 4
+
+
+# Channel and trigger names of --daemon's change notifications, see NOTIFY_FUNCTION_SQL
+NOTIFY_CHANNEL = 'facility_visits_report_changes'
+NOTIFY_FUNCTION = 'facility_visits_report_notify'
+NOTIFY_TRIGGER = 'facility_visits_report_notify'
+
+
+# --daemon refreshes changed facility visits once no change has been notified for DAEMON_DEBOUNCE seconds, at
+# most DAEMON_MAX_WAIT seconds after the first change or as soon as DAEMON_MAX_BATCH facility visits changed
+DAEMON_DEBOUNCE = 5.0
+DAEMON_MAX_WAIT = 60.0
+DAEMON_MAX_BATCH = 5000
+# Seconds --daemon waits after a batch failed before retrying its facility visits
+DAEMON_RETRY_DELAY = 10.0
+
+
+# Items (chunks) that may wait between two stages of a pipeline, and the seconds a stage waiting on a queue
+# checks whether the pipeline stopped, see runPipeline
+PIPELINE_QUEUE_SIZE = 2
+PIPELINE_POLL = 0.1
+
+
+# Seconds between samples of resident memory while stages run, see StageMetrics.  Not much less, as the
+# sampling thread competes with the stages it measures for the GIL
+PEAK_RSS_INTERVAL = 0.1
+
+
+# Stack frames kept per allocation by --trace-memory, and the number of allocation sites and functions reported
+# by --trace-memory and --profile
+TRACEMALLOC_FRAMES = 25
+PROFILE_TOP = 40
+
+
+# --profile-sql flags sequential scans that read at least this many rows, and profiles the queries of scoped runs
+# (incremental, chunked, partitioned) with a scope of this many of the latest facility visits
+PROFILE_SEQ_SCAN_ROWS = 10000
+PROFILE_SCOPE_SIZE = 1000
+
+
+# Per stage metrics written by --prometheus-file, as (name, stage total, help)
+PROMETHEUS_STAGE_METRICS = [('distributions_etl_stage_seconds', 'seconds', 'Wall time of the stage, summed'),
+    ('distributions_etl_stage_rows', 'rows', 'Rows handled by the stage, summed'),
+    ('distributions_etl_stage_bytes_fetched', 'bytes_fetched',
+	'Bytes of query results fetched by the stage, estimated from sampled rows, summed'),
+    ('distributions_etl_stage_peak_rss_bytes', 'peak_rss_bytes', 'Peak resident memory while the stage ran'),
+    ('distributions_etl_stage_count', 'count', 'Times the stage ran')]
+
+
+# Seconds the cached distinct line item codes are used for by the pivots done in Postgres (--pivot-engine sql,
+# --materialized-view), before they're selected again.  Python pivots collect them while extracting.
+LINE_ITEM_CODE_MAX_AGE = 24 * 60 * 60
+
+
+# Columns of the report's filters, indexed in the period-partitioned report (see reportTableDdl).  period_id
+# isn't as every partition holds a single period.
+REPORT_INDEX_COLUMNS = ['district_id', 'province_id', 'delivery_zone_id']
+
+
 # Geo level name=>code that visit report record wants
 GEO_LEVEL = {'district': 'dept',
 	     'province': 'commune' }
 
 
+# visited_last_date is the latest visit date of the facility's earlier visits among the rows selected, see
+# --last-visit-date.  Visit dates fall within their period so the max is the date of the last visit.  The
+# window sorts every facility visit selected, so FACILITY_VISIT_SQL only selects it when asked to, see
+# facilityVisitSql
+LAST_VISIT_DATE_SQL = """
+    , max(fv.visitdate) OVER (PARTITION BY fv.facilityid ORDER BY period.startdate
+	ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS visited_last_date"""
+
+
+# The facility visits, with LAST_VISIT_DATE_SQL or nothing as %(lastVisitDate)s
 FACILITY_VISIT_SQL = """SELECT fv.id AS id
     , f.code || '-' || to_char(period.startdate, 'YYYY-MM') AS visit_code
     , fv.facilityid AS facility_id
     , fv.visited AS visited
-    , fv.visitdate AS visited_date
-    , '2010-06-01' AS visited_last_date
+    , fv.visitdate AS visited_date%%(lastVisitDate)s
     , fv.confirmedbyname AS confirmed_by_name
     , fv.confirmedbytitle AS confirmed_by_title
     , fv.verifiedbyname AS verified_by_name
@@ -91,12 +288,33 @@ FACILITY_VISIT_SQL = """SELECT fv.id AS id
      'adultCovOpenVialTable': ADULT_COVERAGE_OPEN_VIAL_TABLE}
 
 
-GEO_ZONE_SQL = """ SELECT gz.id
-    , gz.parentid
-    , gl.code AS geo_level_code
-    FROM %(geoZoneTable)s AS gz
-    JOIN %(geoLevelTable)s AS gl ON (gz.levelid=gl.id)""" % \
-    {'geoZoneTable': GEO_ZONE_TABLE, 'geoLevelTable': GEO_LEVEL_TABLE}
+# The geographic zone id at each of GEO_LEVEL for every facility that has a facility visit.  The recursive
+# CTE walks up from each facility's zone to the root, then one row per facility keeps the zone of each level
+# as <geo level name>_id (e.g. district_id).  %(visitFacilitySql)s selects the facility ids to include.
+FACILITY_GEO_SQL = """WITH RECURSIVE facility_zones AS (
+    SELECT f.id AS facilityid, gz.id, gz.parentid, gz.levelid
+    FROM %(facilitiesTable)s AS f
+    JOIN %(geoZoneTable)s AS gz ON (f.geographiczoneid=gz.id)
+    WHERE f.id IN (%%(visitFacilitySql)s)
+    UNION ALL
+    SELECT fz.facilityid, gz.id, gz.parentid, gz.levelid
+    FROM facility_zones AS fz
+    JOIN %(geoZoneTable)s AS gz ON (fz.parentid=gz.id))
+    SELECT fz.facilityid AS id
+    , %(levelCols)s
+    FROM facility_zones AS fz
+    JOIN %(geoLevelTable)s AS gl ON (fz.levelid=gl.id)
+    GROUP BY fz.facilityid""" % \
+    {'facilitiesTable': FACILITY_TABLE,
+     'geoZoneTable': GEO_ZONE_TABLE,
+     'geoLevelTable': GEO_LEVEL_TABLE,
+     'levelCols': '\n    , '.join("max(CASE WHEN gl.code = '%s' THEN fz.id END) AS %s_id" % (geoLevelCode, geoLevelName)
+	for geoLevelName, geoLevelCode in sorted(GEO_LEVEL.iteritems()))}
+
+
+VISIT_FACILITY_SQL = """SELECT fv.facilityid
+    FROM %(facilityVisitsTable)s AS fv""" % \
+    {'facilityVisitsTable': FACILITY_VISIT_TABLE}
 
 
 EPI_INV_DISTINCT_CODE_SQL = """SELECT DISTINCT epiln.productcode
@@ -145,31 +363,461 @@ CHILD_COV_DISTINCT_PRODUCT_VIAL_SQL = """SELECT DISTINCT productvialname
     {'childCovOpenVialTable': CHILD_COVERAGE_OPEN_VIAL_TABLE}
 
 
-def loadRefTable(cursor, tableName):
-    cursor.execute("select * from %(table)s" % {'table': tableName})
-    return cursor.fetchall()
+ETL_STATE_DDL = """CREATE TABLE IF NOT EXISTS %(stateTable)s ( source_table text PRIMARY KEY
+    , high_water timestamp NOT NULL
+    )""" % \
+    {'stateTable': ETL_STATE_TABLE}
+
+
+# The partitions of a partitioned run staged so far, each committed along with its staged rows (see --resume)
+CHECKPOINT_DDL = """CREATE TABLE IF NOT EXISTS %(checkpointTable)s ( partition_column text NOT NULL
+    , partition_key integer NOT NULL
+    , staged_rows integer NOT NULL
+    , finished_at timestamptz NOT NULL DEFAULT now()
+    , PRIMARY KEY (partition_column, partition_key)
+    )""" % \
+    {'checkpointTable': CHECKPOINT_TABLE}
+
+
+# The high-water marks taken when the checkpointed partitioned run started, saved when it completes
+CHECKPOINT_MARK_DDL = """CREATE TABLE IF NOT EXISTS %(markTable)s ( source_table text PRIMARY KEY
+    , high_water timestamp NOT NULL
+    )""" % \
+    {'markTable': CHECKPOINT_MARK_TABLE}
+
+
+# The periods whose --parquet files are still to be written, a null period_id meaning every period.  They're
+# queued in the transaction that stores their report rows and cleared once the files are written.
+PARQUET_PENDING_DDL = """CREATE TABLE IF NOT EXISTS %(pendingTable)s ( period_id integer
+    , queued_at timestamptz NOT NULL DEFAULT now()
+    )""" % \
+    {'pendingTable': PARQUET_PENDING_TABLE}
+
+
+# The distinct key values (codes) of each line item table, as last collected
+LINE_ITEM_CODE_DDL = """CREATE TABLE IF NOT EXISTS %(codeTable)s ( line_item_table text NOT NULL
+    , code text NOT NULL
+    , cached_at timestamptz NOT NULL DEFAULT now()
+    , PRIMARY KEY (line_item_table, code)
+    )""" % \
+    {'codeTable': LINE_ITEM_CODE_TABLE}
+
+
+# Whether a table has the given column
+TABLE_COLUMN_SQL = """SELECT EXISTS (SELECT 1 FROM pg_attribute
+    WHERE attrelid = to_regclass(%s) AND attname = %s AND attnum > 0 AND NOT attisdropped)"""
+
+
+# The columns of a table in order, none when it doesn't exist
+TABLE_COLUMNS_SQL = """SELECT attname FROM pg_attribute
+    WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+    ORDER BY attnum"""
+
+
+# The latest facility visits, the sample scope --profile-sql profiles scoped queries with
+PROFILE_SCOPE_SQL = """SELECT id FROM %(facilityVisitsTable)s ORDER BY id DESC LIMIT %%s""" % \
+    {'facilityVisitsTable': FACILITY_VISIT_TABLE}
+
+
+# Whether a table has an index whose first column is the given column
+INDEXED_COLUMN_SQL = """SELECT EXISTS (SELECT 1 FROM pg_index AS i
+    JOIN pg_attribute AS a ON (a.attrelid=i.indrelid AND a.attnum=i.indkey[0])
+    WHERE i.indrelid = to_regclass(%s) AND a.attname = %s)"""
+
+
+# The cached codes of each line item table, with the age in seconds of the oldest
+CACHED_CODE_SQL = """SELECT line_item_table
+    , array_agg(code)
+    , extract(epoch FROM now() - min(cached_at))
+    FROM %(codeTable)s
+    GROUP BY line_item_table""" % \
+    {'codeTable': LINE_ITEM_CODE_TABLE}
+
+
+# The earliest period start date per facility among the given (changed) facility visits
+CHANGED_FACILITY_START_SQL = """SELECT fv.facilityid
+    , min(period.startdate) AS startdate
+    FROM %(facilityVisitsTable)s AS fv
+    JOIN %(distributionsTable)s AS d ON (fv.distributionid=d.id)
+    JOIN %(periodsTable)s AS period ON (d.periodid=period.id)
+    WHERE fv.id = ANY(%%(visitIds)s)
+    GROUP BY fv.facilityid""" % \
+    {'facilityVisitsTable': FACILITY_VISIT_TABLE,
+     'distributionsTable': DISTRIBUTION_TABLE,
+     'periodsTable': PERIOD_TABLE}
+
+
+# Every facility visit at a changed facility from the facility's earliest changed period onwards.  These
+# are the visits whose report rows, including visited_last_date, may differ after the change.
+AFFECTED_VISIT_SQL = """SELECT fv.id
+    FROM %(facilityVisitsTable)s AS fv
+    JOIN %(distributionsTable)s AS d ON (fv.distributionid=d.id)
+    JOIN %(periodsTable)s AS period ON (d.periodid=period.id)
+    JOIN (%(changedSql)s) AS changed ON (changed.facilityid=fv.facilityid AND period.startdate >= changed.startdate)""" % \
+    {'facilityVisitsTable': FACILITY_VISIT_TABLE,
+     'distributionsTable': DISTRIBUTION_TABLE,
+     'periodsTable': PERIOD_TABLE,
+     'changedSql': CHANGED_FACILITY_START_SQL}
+
+
+# The last visit date already in the report for each changed facility, before the visits being re-extracted
+LAST_VISIT_SEED_SQL = """SELECT DISTINCT ON (r.facility_id) r.facility_id
+    , r.visited_date
+    FROM %(reportTable)s AS r
+    JOIN %(periodsTable)s AS period ON (r.period_id=period.id)
+    JOIN (%(changedSql)s) AS changed ON (changed.facilityid=r.facility_id AND period.startdate < changed.startdate)
+    WHERE r.visited_date IS NOT NULL
+    ORDER BY r.facility_id, r.visit_code DESC""" % \
+    {'reportTable': FACILITY_VISIT_REPORT_TABLE,
+     'periodsTable': PERIOD_TABLE,
+     'changedSql': CHANGED_FACILITY_START_SQL}
+
+
+# The start of the earliest period of any of the changed facility visits
+CHANGED_START_SQL = """SELECT min(changed.startdate) FROM (%(changedSql)s) AS changed""" % \
+    {'changedSql': CHANGED_FACILITY_START_SQL}
+
+
+# The last visit date already in the report for each facility, before the period starting at %(startDate)s
+REPORT_LAST_VISIT_SQL = """SELECT DISTINCT ON (r.facility_id) r.facility_id
+    , r.visited_date
+    FROM %(reportTable)s AS r
+    JOIN %(periodsTable)s AS period ON (r.period_id=period.id)
+    WHERE period.startdate < %%(startDate)s AND r.visited_date IS NOT NULL
+    ORDER BY r.facility_id, r.visit_code DESC""" % \
+    {'reportTable': FACILITY_VISIT_REPORT_TABLE,
+     'periodsTable': PERIOD_TABLE}
+
+
+# The rows of %(reportTable)s (the report, or the table swapped in for it) summed by %(groupColumn)s and period,
+# for %(where)s rows
+ROLLUP_SQL = """SELECT %(groupColumn)s
+    , period_id
+    , count(*) AS visit_count
+    , count(NULLIF(visited, false)) AS visited_count
+    , %(sums)s
+    FROM %(reportTable)s
+    %(where)s
+    GROUP BY %(groupColumn)s, period_id"""
+
+
+# The processing periods starting on or after a date, in order
+PERIOD_SQL = """SELECT id FROM %(periodsTable)s WHERE startdate >= %%s ORDER BY startdate, id""" % \
+    {'periodsTable': PERIOD_TABLE}
+
+
+# The distinct values of a distributions column (%(partitionColumn)s), in order of their first period
+PARTITION_KEY_SQL = """SELECT d.%%(partitionColumn)s
+    FROM %(distributionsTable)s AS d
+    JOIN %(periodsTable)s AS period ON (d.periodid=period.id)
+    GROUP BY d.%%(partitionColumn)s
+    ORDER BY min(period.startdate), d.%%(partitionColumn)s""" % \
+    {'distributionsTable': DISTRIBUTION_TABLE,
+     'periodsTable': PERIOD_TABLE}
+
+
+# The facility visits of distributions whose %(partitionColumn)s is one of an array parameter
+PARTITION_VISIT_SQL = """SELECT fv.id
+    FROM %(facilityVisitsTable)s AS fv
+    JOIN %(distributionsTable)s AS d ON (fv.distributionid=d.id)
+    WHERE d.%%(partitionColumn)s = ANY(%%%%s)""" % \
+    {'facilityVisitsTable': FACILITY_VISIT_TABLE,
+     'distributionsTable': DISTRIBUTION_TABLE}
+
+
+# A table with the report's field columns, %(fields)s, and nothing else, that partitioned runs store into.
+# %(tableKind)s is UNLOGGED TABLE, unless the staged rows are kept across runs with their checkpoints
+STAGING_DDL = """CREATE %%(tableKind)s %(stagingTable)s AS
+    SELECT %%(fields)s FROM %(reportTable)s WITH NO DATA""" % \
+    {'stagingTable': FACILITY_VISIT_REPORT_STAGING_TABLE,
+     'reportTable': FACILITY_VISIT_REPORT_TABLE}
+
+
+# The staged rows of each value of the report field %(reportColumn)s, see PARTITION_REPORT_COLUMNS
+STAGED_ROWS_SQL = """SELECT %%(reportColumn)s, count(*) FROM %(stagingTable)s GROUP BY %%(reportColumn)s""" % \
+    {'stagingTable': FACILITY_VISIT_REPORT_STAGING_TABLE}
+
+
+# Sets visited_last_date of every staged row from the facility's staged visits, as LAST_VISIT_DATE_SQL's window
+# does for the rows it selects
+STAGING_LAST_VISIT_SQL = """UPDATE %(stagingTable)s AS s
+    SET visited_last_date = lv.visited_last_date
+    FROM (SELECT r.visit_code
+	, max(r.visited_date) OVER (PARTITION BY r.facility_id ORDER BY period.startdate
+	    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS visited_last_date
+	FROM %(stagingTable)s AS r
+	JOIN %(periodsTable)s AS period ON (r.period_id=period.id)) AS lv
+    WHERE s.visit_code=lv.visit_code""" % \
+    {'stagingTable': FACILITY_VISIT_REPORT_STAGING_TABLE,
+     'periodsTable': PERIOD_TABLE}
+
+
+# Trigger function notifying NOTIFY_CHANNEL of the facility visit id in the changed row's column named by the
+# trigger's argument, for the old and the new row.  Notifications of the same id in a transaction are sent once.
+NOTIFY_FUNCTION_SQL = """CREATE OR REPLACE FUNCTION %(function)s() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+	PERFORM pg_notify('%(channel)s', row_to_json(OLD) ->> TG_ARGV[0]);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+	PERFORM pg_notify('%(channel)s', row_to_json(NEW) ->> TG_ARGV[0]);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql""" % \
+    {'function': NOTIFY_FUNCTION,
+     'channel': NOTIFY_CHANNEL}
+
+
+# Notifies changes to the rows of %(table)s, whose %(idColumn)s is the facility visit id
+NOTIFY_TRIGGER_SQL = """CREATE TRIGGER %(trigger)s AFTER INSERT OR UPDATE OR DELETE ON %%(table)s
+    FOR EACH ROW EXECUTE PROCEDURE %(function)s('%%(idColumn)s')""" % \
+    {'trigger': NOTIFY_TRIGGER,
+     'function': NOTIFY_FUNCTION}
+
+
+# The report's constraints, other than NOT NULL, as (name, definition), foreign keys last
+REPORT_CONSTRAINT_SQL = """SELECT conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'x', 'c', 'f')
+    ORDER BY contype = 'f', conname"""
+
+
+# The report's indexes that don't belong to a constraint, as (name, definition)
+REPORT_INDEX_SQL = """SELECT i.relname, pg_get_indexdef(i.oid)
+    FROM pg_index AS x
+    JOIN pg_class AS i ON (x.indexrelid=i.oid)
+    WHERE x.indrelid = %s::regclass
+    AND NOT EXISTS (SELECT 1 FROM pg_constraint AS c WHERE c.conrelid=x.indrelid AND c.conindid=x.indexrelid)
+    ORDER BY i.relname"""
+
+
+# The sequences owned by the report's (serial) columns, as (column, sequence)
+REPORT_SEQUENCE_SQL = """SELECT attname, pg_get_serial_sequence(%s, attname)
+    FROM pg_attribute
+    WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+    AND pg_get_serial_sequence(%s, attname) IS NOT NULL"""
+
+
+# Privileges other roles have on the report, as (grantee, privilege)
+REPORT_GRANT_SQL = """SELECT grantee, privilege_type
+    FROM information_schema.role_table_grants
+    WHERE table_schema = current_schema() AND table_name = %s AND grantee <> current_user"""
+
+
+# The comment on the materialized view, holding the hash of the sql it was created from
+VIEW_HASH_SQL = """SELECT obj_description(to_regclass(%s), 'pg_class')"""
+
+
+# Rows of one report relation missing from the other, compared on the given fields
+VIEW_DIFF_SQL = """SELECT count(*) FROM (
+    SELECT %(fields)s FROM %(left)s
+    EXCEPT ALL
+    SELECT %(fields)s FROM %(right)s) AS diff"""
+
+
+class VisitScope(object):
+    """
+    Restricts extraction to a subset of facility visits.  A scope renders as a SQL condition on whichever
+    column holds the facility visit id in a query (e.g. fv.id or facilityvisitid) along with its parameters.
+    """
+
+    def __init__(self, condition, params):
+	self.condition = condition
+	self.params = params
+
+    def where(self, column):
+	"""
+	@param column: the facility visit id column the condition applies to
+	@return tuple of the SQL condition and a list of its parameters
+	"""
+	return self.condition.format(column=column), list(self.params)
+
+    @classmethod
+    def byIds(cls, visitIds):
+	return cls('{column} = ANY(%s)', [list(visitIds)])
+
+    @classmethod
+    def byIdRange(cls, firstId, lastId):
+	return cls('{column} BETWEEN %s AND %s', [firstId, lastId])
+
+    @classmethod
+    def byPartition(cls, partitionColumn, keys):
+	"""
+	@return scope of the facility visits of distributions whose partitionColumn is one of keys
+	"""
+	visitSql = PARTITION_VISIT_SQL % {'partitionColumn': partitionColumn}
+	return cls('{column} IN (' + visitSql + ')', [list(keys)])
+
+
+def scopeSql(sql, scope, column, conjunction='WHERE'):
+    """
+    Appends the scope's condition on column to sql.
+    @return tuple of the sql and its parameters (None when there's no scope)
+    """
+    if scope is None:
+	return sql, None
+    condition, params = scope.where(column)
+    return sql + ' ' + conjunction + ' ' + condition, params
 
 
-def toUtf(string):
+class StageMetrics(object):
     """
-    Encodes a string into utf-8.  Returns same object if not a string or is already a unicode object.
-    No attempt is made to determine/convert a unicode object is made.
+    Measures the stages of a run: wall time, rows, bytes fetched and peak resident memory.  Stages may nest and
+    may run in several threads at once.  Bytes fetched are estimated by the stages that fetch query results,
+    from the size of the values fetched (see rowBytes), and are None for the others.  Peak memory is the process's
+    resident set size, sampled every PEAK_RSS_INTERVAL seconds by a thread that runs while any stage does.
+    Where /proc isn't available peak memory is the process's peak so far.
 
-    @param string: a string to convert to unicode using the utf-8 encoding
-    @return a unicode object using utf-8. Or the same object as passed if the string parameter wasn't a
-	subtype of basestring or was already a subtype of unicode.
+    @param listeners: functions called with each finished stage's dict
+    """
 
+    def __init__(self, listeners=None):
+	self.stages = []
+	self.listeners = listeners or []
+	self.running = {}
+	self.lock = threading.Lock()
+	self.sampler = None # (thread, stop event) sampling memory while stages run
+
+    @contextmanager
+    def stage(self, name):
+	"""
+	Measures the body of a with statement.  The body sets the number of rows it handled in the
+	stage dict it's given, e.g. stage['rows'] = len(rows).
+	"""
+	stage = {'stage': name, 'rows': None, 'bytes_fetched': None, 'peak_rss_bytes': currentRss()}
+	started = time.time()
+	with self.lock:
+	    self.running[id(stage)] = stage
+	    if self.sampler is None:
+		stopped = threading.Event()
+		thread = threading.Thread(target=self.sampleRss, args=(stopped,))
+		thread.daemon = True
+		thread.start()
+		self.sampler = (thread, stopped)
+	try:
+	    yield stage
+	finally:
+	    stage['seconds'] = time.time() - started
+	    sampler = None
+	    with self.lock:
+		del self.running[id(stage)]
+		rss = currentRss()
+		stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], rss) if rss is not None else maxRss()
+		stage['finished'] = datetime.now().isoformat()
+		if len(self.running) == 0: # the last running stage stops the sampler
+		    sampler, self.sampler = self.sampler, None
+	    if sampler is not None:
+		thread, stopped = sampler
+		stopped.set()
+		thread.join()
+	    self.record(stage)
+
+    def record(self, stage):
+	"""
+	Adds a finished stage, e.g. one measured in another process.
+	"""
+	with self.lock:
+	    self.stages.append(stage)
+	for listener in self.listeners:
+	    listener(stage)
+
+    def sampleRss(self, stopped):
+	while not stopped.wait(PEAK_RSS_INTERVAL):
+	    rss = currentRss()
+	    with self.lock:
+		for stage in self.running.itervalues():
+		    stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], rss)
+
+    def totals(self):
+	"""
+	@return OrderedDict of stage name => dict of the seconds, rows and bytes fetched summed, and the
+	    peak memory, over every finished stage of that name
+	"""
+	totals = OrderedDict()
+	for stage in self.stages:
+	    total = totals.setdefault(stage['stage'], {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes_fetched': 0,
+		'peak_rss_bytes': 0})
+	    total['count'] += 1
+	    total['seconds'] += stage['seconds']
+	    total['rows'] += stage['rows'] or 0
+	    total['bytes_fetched'] += stage['bytes_fetched'] or 0
+	    total['peak_rss_bytes'] = max(total['peak_rss_bytes'], stage['peak_rss_bytes'])
+	return totals
+
+
+# the stages of this run, see measureStage
+STAGE_METRICS = StageMetrics()
+
+
+def measureStage(name):
+    """
+    Measures a stage of the run into STAGE_METRICS, e.g.
+	with measureStage('extract:facilities') as stage:
+	    ...
+	    stage['rows'] = rowCount
     """
+    return STAGE_METRICS.stage(name)
 
-    if not isinstance(string, types.StringTypes): return string
-    if isinstance(string, unicode): return string
+
+def currentRss():
+    """
+    @return resident set size of this process in bytes, None where /proc/self/statm isn't available
+    """
     try:
-	asUtf8 = unicode(string, 'utf-8')
-    except:
-	print 'Failure to encode as utf-8: ' + string
-	print type(string)
-	raise
-    return asUtf8
+	f = open('/proc/self/statm')
+	try:
+	    return int(f.read().split()[1]) * resource.getpagesize()
+	finally:
+	    f.close()
+    except (IOError, IndexError, ValueError):
+	return None
+
+
+def maxRss():
+    """
+    @return the peak resident set size of this process so far in bytes
+    """
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss if sys.platform == 'darwin' else maxRss * 1024 # bytes on Mac OS, kilobytes elsewhere
+
+
+def rowBytes(values):
+    """
+    @return the size of fetched values, as bytes fetched are estimated: the UTF-8 length of text values and
+	8 bytes for any other value that isn't null.  They're counted at the cursor as libpq reads its socket
+	with recv(), which the thread's I/O statistics (rchar) leave out.  Streamed results only count one row
+	in FETCHED_BYTES_SAMPLE, so measuring doesn't slow extracting down.
+    """
+    return sum(len(value.encode('utf-8')) if isinstance(value, unicode) else
+	len(value) if isinstance(value, str) else 8 for value in values if value is not None)
+
+
+def loadLineItems(conn, tableName, scope=None, itersize=EXTRACT_ITER_SIZE):
+    """
+    Streams a line item table ordered by facility visit.
+    @return generator of (facilityvisitid, list of line item dicts), see groupRows
+    """
+    sql, params = lineItemSql(tableName, scope)
+    return groupRows(loadAllFromSql(conn, sql, params, itersize, stageName='extract:' + tableName),
+	'facilityvisitid')
+
+
+def lineItemSql(tableName, scope=None):
+    """
+    @return tuple of the sql selecting a line item table's line items ordered by facility visit, and its parameters
+    """
+    sql, params = scopeSql("select * from %(table)s" % {'table': tableName}, scope, 'facilityvisitid')
+    return sql + ' ORDER BY facilityvisitid', params
+
+
+def groupRows(rows, keyColumn):
+    """
+    Groups rows that are already ordered by keyColumn without holding more than one group in memory.
+    @return generator of (key, list of rows with that key) in the order of rows
+    """
+    for key, group in itertools.groupby(rows, operator.itemgetter(keyColumn)):
+	yield key, list(group)
 
 
 def rowToTable(rowData, keyColumn, allowDupes = False):
@@ -177,27 +825,22 @@ def rowToTable(rowData, keyColumn, allowDupes = False):
     Turns a list of dict's into a dict that's keyed off one common column from the dicts.
     Return: a dict keyed off of keyColumn found in all rowData.  If multiple row's would
     be keyed off the same value, then each item from rowData will be in a list under the same key.
+    The row dicts themselves are used, not copied.  Strings are already unicode as the driver decodes them.
     """
     table = dict()
     for row in rowData:
 	if keyColumn not in row:
 	    raise LookupError('Key column ' + keyColumn + ' not in row data: ' + str(rowData))
-	key = toUtf(row[keyColumn])
-	if allowDupes == False and row[keyColumn] in table:
-	    raise StandardError('Duplicate key ' + row[keyColumn] + ' found')
-
-	# turn row dict into a dict with strings in utf
-	asDict = {}
-	for k,v in row.iteritems():
-	    if isinstance(v, basestring): v = toUtf(v)
-	    asDict[toUtf(k)] = v
+	key = row[keyColumn]
+	if allowDupes == False and key in table:
+	    raise StandardError('Duplicate key ' + unicode(key) + ' found')
 
 	# enter dict item into result dict that's keyed off the column given.  If
 	# an item already exists under that key, turn the value into a list of dicts.
 	if key in table:
 	    if not isinstance(table[key], list): table[key] = [table[key],]
-	    table[key].append(asDict)
-	else: table[key] = asDict
+	    table[key].append(row)
+	else: table[key] = row
 
     return table
 
@@ -207,386 +850,1189 @@ def loadFields():
     Loads field names we want from field map file
     Return: list of field names
     """
-    fieldNames = []
+    return list(loadFieldDefs())
+
+
+def loadFieldDefs():
+    """
+    Loads the field map file
+    Return: OrderedDict of field name => its field map row (type, nullable, constraint, ...)
+    """
+    fieldDefs = OrderedDict()
     f = open(FIELD_MAP, mode='rb')
     reader = csv.DictReader(f)
     for rowD in reader:
-	fieldNames.append(rowD['fieldname'])
+	fieldDefs[rowD['fieldname']] = rowD
 
     f.close()
-    return fieldNames
+    return fieldDefs
 
 
-def loadFacilityVisits(conn):
+def loadFacilityVisits(conn, layout, scope=None, itersize=EXTRACT_ITER_SIZE, lastVisitDate=False):
     """
     Given a db connection, will fetch the OpenLMIS facility visit data.
     Return: an Iterable with facility visit data where every element is a 
-    row of dicts keyed off of the column name.  Data is sorted by period's 
-    start date ascending.
+    VisitRow in the given RowLayout.
     """
-    return loadAllFromSql(conn, FACILITY_VISIT_SQL)
-
-
-def loadEpiUseLineItems(conn):
-    epiUseRows = loadAllFromSql(conn, EPI_USE_LINE_ITEM_SQL)
-    # convert expiration date from string in db to datetime, not done in db to avoid db setting for datestyle
-    for row in epiUseRows:
-	if 'expiration' in row and row['expiration'] is not None:
-	    row['expiration'] = datetime.strptime(row['expiration'], '%m/%Y').date()
-    
-    return epiUseRows
+    sql, params = facilityVisitSql(scope, lastVisitDate)
+    return loadVisitRows(conn, sql, params, layout, itersize, 'extract:' + FACILITY_VISIT_TABLE)
 
 
-def loadAllFromSql(conn, sql):
+class RowLayout(object):
     """
-    Fetches result (all) by running the given sql.
-    @param conn an open db connection
-    @param sql the sql string to run
-    @return result as a dict
+    The column order shared by every VisitRow of a run: the report fields in fieldmap.csv order followed
+    by ROW_EXTRA_COLUMNS.
     """
 
-    loadCur = getDictCursor(conn)
-    loadCur.execute(sql)
-    lineItems = loadCur.fetchall()
-    loadCur.close()
-    return lineItems
-
+    def __init__(self, columns):
+	self.columns = list(columns)
+	self.index = dict((name, i) for i, name in enumerate(self.columns))
 
-def storeVisits(conn, visitRows, fields):
-    if len(visitRows) == 0:
-	return
-    cur = conn.cursor()
-    cur.execute( 'DELETE FROM ' + FACILITY_VISIT_REPORT_TABLE) # clear before new load
-
-    # create a list of tuples that are the values from visits using the order and name of the fields
-    # from fields
-    valueTups = [tuple(visitD.get(fname) for fname in fields) for visitD in visitRows]
-    colStr = '(' + ','.join(fname for fname in fields) + ')'
-
-    # create a value string that's SQL safe for every tuple we created, this allows the insert
-    # statement later to be one statement, one column list and then a list of all the values/rows
-    formatStr= '(' + ','.join('%s' for fname in fields) + ')'
-    valStr = ','.join(cur.mogrify(formatStr, tup) for tup in valueTups)
-    insStr = 'INSERT INTO ' + FACILITY_VISIT_REPORT_TABLE + ' ' + colStr + ' VALUES ' + valStr 
-    cur.execute(insStr)
-    cur.close()
-
-
-def loadGeoZone(cur):
-    cur.execute(GEO_ZONE_SQL)
-    return cur.fetchall()
 
+def visitRowLayout(fields=None):
+    """
+    @param fields: the report fields, loaded from the field map file when not given
+    @return RowLayout for the report fields and ROW_EXTRA_COLUMNS
+    """
+    if fields is None:
+	fields = loadFields()
+    return RowLayout(list(fields) + [col for col in ROW_EXTRA_COLUMNS if col not in fields])
 
-def loadEpiInvDistinctCodes(conn):
-    return loadDistinct(conn, EPI_INV_DISTINCT_CODE_SQL)
 
+class VisitRow(object):
+    """
+    A facility visit as a list of values in RowLayout order, in place of a dict per row.  Supports the
+    dict operations the transform uses.  Assigning a column that isn't in the layout does nothing, as
+    only layout columns are ever stored.
+    """
+    __slots__ = ('layout', 'values')
 
-def loadEpiUseDistinctCodes(conn):
-    return loadDistinct(conn, EPI_USE_DISTINCT_CODE_SQL)
+    def __init__(self, layout, values=None):
+	self.layout = layout
+	self.values = values if values is not None else [None] * len(layout.columns)
 
+    def __getitem__(self, key):
+	return self.values[self.layout.index[key]]
 
-def loadAdultCovDistinctGroups(conn):
-    return loadDistinct(conn, ADULT_COV_DISTINCT_GROUP_SQL)
+    def __setitem__(self, key, value):
+	i = self.layout.index.get(key)
+	if i is not None:
+	    self.values[i] = value
 
+    def __contains__(self, key):
+	return key in self.layout.index
 
-def loadChildCovDistinctVaccs(conn):
-    return loadDistinct(conn, CHILD_COV_DISTINCT_VACC_SQL)
+    def __getstate__(self):
+	return self.layout, self.values
 
+    def __setstate__(self, state):
+	self.layout, self.values = state
 
-def loadChildCovDistinctProductVialNames(conn):
-    return loadDistinct(conn, CHILD_COV_DISTINCT_PRODUCT_VIAL_SQL)
+    def get(self, key, default=None):
+	i = self.layout.index.get(key)
+	return default if i is None else self.values[i]
 
+    def keys(self):
+	return list(self.layout.columns)
 
-def loadDistinct(conn, sql):
-    cur = conn.cursor()
-    cur.execute(sql)
-    rows = cur.fetchall()
-    asList = [row[0] for row in rows]
-    return asList
+    def update(self, pairs):
+	for key, value in pairs:
+	    self[key] = value
 
 
-def loadOpenLmis(conn):
+def loadVisitRows(conn, sql, params, layout, itersize=EXTRACT_ITER_SIZE, stageName='extract'):
     """
-    Loads and processes OpenLMIS facility visits to final reporting form.
-    @param conn: open database connection
-    @return list of OpenLMIS facility visits in reporting form.  Each entry in the list represents
-    one facility visit as a dict whose keys conform to the reporting columns.
-    
+    Streams the result of running sql through a server side cursor as VisitRows, placing each result
+    column by name in the layout.  Result columns that aren't in the layout are dropped.
+    @param stageName: name the query is measured under, see measureStage
+    @return generator of VisitRow
     """
-    if conn is None:
-	raise Exception("data source connection is not active")
-    cur = getDictCursor(conn)
-
-    facilityTable = rowToTable( loadRefTable(cur, FACILITY_TABLE), 'id' )
-    geoZoneTable = rowToTable( loadGeoZone(cur), 'id' )
-
-    # adds all geozones by geo level to all facilities
-    map(lambda f: facilityAddGeoLevels(f, geoZoneTable), facilityTable.values())
-
-    # load facility visit's
-    facVisitRows = loadFacilityVisits(conn)
+    loadCur = conn.cursor('etl_extract_%d' % next(CURSOR_IDS))
+    loadCur.itersize = itersize
+    try:
+	with measureStage(stageName) as stage:
+	    loadCur.execute(sql, params)
+	    positions = None
+	    width = len(layout.columns)
+	    stage['rows'] = 0
+	    stage['bytes_fetched'] = 0
+	    for row in loadCur:
+		if positions is None: # description is only known once the first rows are fetched
+		    positions = [(layout.index[desc[0]], i) for i, desc in enumerate(loadCur.description)
+			if desc[0] in layout.index]
+		values = [None] * width
+		for layoutPos, rowPos in positions:
+		    values[layoutPos] = row[rowPos]
+		if stage['rows'] % FETCHED_BYTES_SAMPLE == 0:
+		    stage['bytes_fetched'] += rowBytes(row) * FETCHED_BYTES_SAMPLE
+		stage['rows'] += 1
+		yield VisitRow(layout, values)
+    finally:
+	loadCur.close()
+
+
+def loadEpiUseLineItems(conn, scope=None, itersize=EXTRACT_ITER_SIZE):
+    """
+    Streams the epi use line items ordered by facility visit.
+    @return generator of (facilityvisitid, list of line item dicts), see groupRows
+    """
+    sql, params = epiUseLineItemSql(scope)
+    epiUseRows = loadAllFromSql(conn, sql, params, itersize, stageName='extract:' + EPI_USE_TABLE)
+    return groupRows(parseEpiUseExpiration(epiUseRows), 'facilityvisitid')
 
-    # add geographic_zone id's for the levels we're interested in for every facility visit
-    geoKeys = [geoPrefix + '_id' for geoPrefix in GEO_LEVEL]
-    map(lambda fv: dictColCopy(facilityTable[fv['facility_id']], fv, geoKeys), facVisitRows)
 
-    # load and map epi_inventory columns for every facility visit
-    epiInvTable = rowToTable( loadRefTable(cur, EPI_INV_TABLE), 'facilityvisitid', allowDupes=True)
-    epiInvProdCodes = loadEpiInvDistinctCodes(conn)
-    mapEpiInvToFacVisits(facVisitRows, epiInvTable, epiInvProdCodes)
+def epiUseLineItemSql(scope=None):
+    """
+    @return tuple of the sql loadEpiUseLineItems runs and its parameters
+    """
+    sql, params = scopeSql(EPI_USE_LINE_ITEM_SQL, scope, 'euli.facilityvisitid')
+    return sql + ' ORDER BY euli.facilityvisitid', params
 
-    # load and map epi_use columns for every facility visit
-    epiUseTable = rowToTable( loadEpiUseLineItems(conn), 'facilityvisitid', allowDupes=True)
-    epiUseProdCodes = loadEpiUseDistinctCodes(conn)
-    mapEpiUseToFacVisits(facVisitRows, epiUseTable, epiUseProdCodes)
 
-    # load and map adult coverage line items for every facility visit
-    adultCovTable = rowToTable( loadRefTable(cur, ADULT_COVERAGE_TABLE), 'facilityvisitid', allowDupes=True)
-    adultCovDemoGroups = loadAdultCovDistinctGroups(conn)
-    mapAdultCoverageToFacVisits(facVisitRows, adultCovTable, adultCovDemoGroups)
+def parseEpiUseExpiration(epiUseRows):
+    # convert expiration date from string in db to datetime, not done in db to avoid db setting for datestyle
+    for row in epiUseRows:
+	if 'expiration' in row and row['expiration'] is not None:
+	    row['expiration'] = datetime.strptime(row['expiration'], '%m/%Y').date()
+	yield row
 
-    # load and map child coverage line items for every facility visit
-    childCovTable = rowToTable( loadRefTable(cur, CHILD_COVERAGE_TABLE), 'facilityvisitid', allowDupes=True)
-    childCovVaccs = loadChildCovDistinctVaccs(conn)
-    mapChildCoverageToFacVisits(facVisitRows, childCovTable, childCovVaccs)
 
-    # load and map child coverage opened vial line items for every facility visit
-    childCovOpenVialTable = rowToTable( loadRefTable(cur, CHILD_COVERAGE_OPEN_VIAL_TABLE), 'facilityvisitid', allowDupes=True)
-    childCovProductVialNames = loadChildCovDistinctProductVialNames(conn)
-    mapChildCoverageOpenVialsToFacVisits(facVisitRows, childCovOpenVialTable, childCovProductVialNames)
+def loadAllFromSql(conn, sql, params=None, itersize=EXTRACT_ITER_SIZE, dictRows=True, stageName='extract'):
+    """
+    Streams the result of running the given sql through a server side (named) cursor, so that only
+    itersize rows are held on the client at a time.
+    @param conn an open db connection, the cursor lives in its current transaction
+    @param sql the sql string to run
+    @param params optional query parameters for the sql
+    @param itersize number of rows fetched from the server per round trip
+    @param dictRows when False rows are plain tuples in the sql's column order
+    @param stageName name the query is measured under, see measureStage
+    @return generator of result rows as dicts
+    """
 
-    cur.close()
-    return facVisitRows
+    cursorName = 'etl_extract_%d' % next(CURSOR_IDS)
+    loadCur = getDictCursor(conn, name=cursorName) if dictRows else conn.cursor(cursorName)
+    loadCur.itersize = itersize
+    try:
+	with measureStage(stageName) as stage:
+	    loadCur.execute(sql, params)
+	    stage['rows'] = 0
+	    stage['bytes_fetched'] = 0
+	    for row in loadCur:
+		if stage['rows'] % FETCHED_BYTES_SAMPLE == 0:
+		    stage['bytes_fetched'] += rowBytes(row.itervalues() if dictRows else row) * FETCHED_BYTES_SAMPLE
+		stage['rows'] += 1
+		yield row
+    finally:
+	loadCur.close()
+
+
+def storeVisits(conn, visitRows, fields, replaceAll=True, loadMethod='copy', batchSize=LOAD_BATCH_SIZE,
+	tableName=FACILITY_VISIT_REPORT_TABLE, append=False, skipUnchanged=False):
+    """
+    Writes visit rows to the report table.
+    @param replaceAll: when True every existing report row is deleted first, otherwise only the report rows
+	with the same visit_code as one of visitRows are replaced (an upsert by visit_code).
+    @param loadMethod: 'copy' streams rows with COPY FROM STDIN, 'insert' uses multi-row INSERT statements
+    @param batchSize: number of rows sent per COPY or INSERT statement
+    @param tableName: the table written, e.g. FACILITY_VISIT_REPORT_STAGING_TABLE
+    @param append: when True no rows are deleted, visitRows are only added
+    @param skipUnchanged: when True only the rows whose hash differs from the one stored with their visit_code
+	are written, see storeChangedVisits
+    """
+    if len(visitRows) == 0:
+	return
+    with measureStage('load:' + str(loadMethod)) as stage:
+	if skipUnchanged:
+	    stage['rows'] = storeChangedVisits(conn, visitRows, fields, replaceAll, loadMethod, batchSize,
+		tableName)
+	else:
+	    stage['rows'] = replaceVisits(conn, visitRows, fields, replaceAll, loadMethod, batchSize, tableName,
+		append)
 
 
-def generateLastVisitDate(visitRows):
+def storeChangedVisits(conn, visitRows, fields, replaceAll, loadMethod, batchSize, tableName):
     """
-    Generates the visited_last_date field for every record given by searching through all records to find
-    the last visit date for each facility.  Sets visited_last_date field to None if there was no last visit,
-    or the last visit date regardless of weather the facility record indicates it was not visited or not recorded.
-    
-    @param visitRows a list of dicts that is the entire visit record history and that will be updated with the 
-	visited_last_date field.
-
+    Sets ROW_HASH_COLUMN of every visit row to a hash of its fields and only writes the rows whose hash isn't
+    the one stored with their visit_code, i.e. new and changed rows.  When replaceAll the stored rows whose
+    visit_code isn't among visitRows are deleted.  Prints how many rows were inserted, updated, deleted and
+    left unchanged.
+    @return number of rows written
     """
+    cur = conn.cursor()
+    # only altered when the column is missing (reports created before it), as ALTER TABLE locks out readers
+    cur.execute(TABLE_COLUMN_SQL, (tableName, ROW_HASH_COLUMN))
+    if not cur.fetchone()[0]:
+	cur.execute('ALTER TABLE ' + tableName + ' ADD COLUMN ' + ROW_HASH_COLUMN + ' text')
+    if replaceAll:
+	cur.execute('SELECT visit_code, ' + ROW_HASH_COLUMN + ' FROM ' + tableName)
+    else:
+	cur.execute('SELECT visit_code, ' + ROW_HASH_COLUMN + ' FROM ' + tableName + ' WHERE visit_code = ANY(%s)',
+	    ([visitD['visit_code'] for visitD in visitRows],))
+    storedHashes = dict(cur.fetchall())
+
+    changedRows = []
+    inserted = 0
+    for visitD in visitRows:
+	visitD[ROW_HASH_COLUMN] = rowHash(visitD, fields)
+	if visitD['visit_code'] not in storedHashes:
+	    inserted += 1
+	    changedRows.append(visitD)
+	elif storedHashes.pop(visitD['visit_code']) != visitD[ROW_HASH_COLUMN]:
+	    changedRows.append(visitD)
+
+    # what's left of the stored rows are the ones that weren't generated again
+    deleted = len(storedHashes) if replaceAll else 0
+    if deleted > 0:
+	cur.execute('DELETE FROM ' + tableName + ' WHERE visit_code = ANY(%s)', (list(storedHashes),))
+    cur.close()
 
-    # sort chronological ascending by visit_code which will group by facility and then period (e.g. 2013-03, 2013-04)
-    rowsAsc = sorted(visitRows, key=lambda r: r['visit_code'])
+    rowCount = 0
+    if changedRows:
+	rowCount = replaceVisits(conn, changedRows, fields + [ROW_HASH_COLUMN], False, loadMethod, batchSize,
+	    tableName, False)
+    print 'Rows inserted: %d, updated: %d, deleted: %d, unchanged: %d' % \
+	(inserted, len(changedRows) - inserted, deleted, len(visitRows) - len(changedRows))
+    return rowCount
 
-    # for every visit row, extract facility code, enter it into map where fac_code => last_visit_date
-    lastVisitMap = dict()
-    for row in rowsAsc:
-	mapKey = row['facility_id']
 
-	# a) if no record in map exists, or value is None, last visit date for record is None
-	# b) if record in map exisits and is not None, last visit date for record is map value
-	# c) update map value with row's visit_date field if row's visit date is not None (i.e. only update for visits)
-	mapValue = lastVisitMap.get(mapKey)
-	row['visited_last_date'] = mapValue
-	if row['visited_date'] is not None:
-	    lastVisitMap[mapKey] = row['visited_date']
+def rowHash(visitD, fields):
+    """
+    @return md5 hex digest of the visit row's values of fields, as copyValue formats them
+    """
+    return hashlib.md5('\t'.join(copyValue(visitD.get(fname)) for fname in fields)).hexdigest()
 
 
-def geoZoneFlatten(geoZone, geoZoneTable):
+def replaceVisits(conn, visitRows, fields, replaceAll, loadMethod, batchSize, tableName, append):
     """
-    Given a leaf geographic zone, will loop up to each geographic zone parent until the heirachy is flat.
-    Returns a dict that's keyed off of the geographic level code
+    Deletes the report rows visitRows replace and writes visitRows, see storeVisits.
+    @return number of rows written
     """
-    gz = {}
-    while geoZone is not None:
-	gz[geoZone['geo_level_code']] = geoZone
-	geoZone = geoZoneTable.get(geoZone['parentid'])
+    cur = conn.cursor()
+    if replaceAll and not append:
+	cur.execute( 'DELETE FROM ' + tableName) # clear before new load
+    elif not append:
+	cur.execute('DELETE FROM ' + tableName + ' WHERE visit_code = ANY(%s)',
+	    ([visitD['visit_code'] for visitD in visitRows],))
+
+    started = time.time()
+    if loadMethod == 'copy':
+	rowCount = copyVisits(cur, visitRows, fields, batchSize, tableName)
+    elif loadMethod == 'insert':
+	rowCount = insertVisits(cur, visitRows, fields, batchSize, tableName)
+    else:
+	raise ValueError('Unknown load method: ' + str(loadMethod))
+    elapsed = time.time() - started
+    cur.close()
 
-    return gz
+    print 'Stored %d rows with %s in %.2fs (%.0f rows/s)' % \
+	(rowCount, loadMethod, elapsed, rowCount / elapsed if elapsed > 0 else 0)
+    return rowCount
 
 
-def facilityAddGeoLevels(fac, geoZoneTable):
+def insertVisits(cur, visitRows, fields, batchSize, tableName=FACILITY_VISIT_REPORT_TABLE):
     """
-    Updates a facility dictionary in place with key/values from the geographic zone's the facility is in.
-    Uses GEO_LEVEL to only add zone's that are at those levels and adds keys prepended with the geographic level
-    name.
+    Inserts visit rows into the report table with one INSERT statement per batch of rows.
+    @return number of rows inserted
     """
-    geoZoneFirst = geoZoneTable.get(fac['geographiczoneid'])
-    geoFlat = geoZoneFlatten(geoZoneFirst, geoZoneTable)
-    for geoLevelName, geoLevelCode in GEO_LEVEL.iteritems():
-	geoLevel = geoFlat.get(geoLevelCode)
-	if geoLevel is None:
-	    raise Exception('GeoLevelCode ' + geoLevelCode + ' not in geographic level table')
-	for geoK, geoV in geoLevel.iteritems():
-	    fac[geoLevelName + '_' + geoK] = geoV
+    colStr = '(' + ','.join(fname for fname in fields) + ')'
+    formatStr= '(' + ','.join('%s' for fname in fields) + ')'
 
-    return fac # allows inline use
+    rowCount = 0
+    for start in xrange(0, len(visitRows), batchSize):
+	# create a list of tuples that are the values from visits using the order and name of the fields
+	# from fields
+	valueTups = [tuple(visitD.get(fname) for fname in fields) for visitD in visitRows[start:start + batchSize]]
 
+	# create a value string that's SQL safe for every tuple we created, this allows the insert
+	# statement later to be one statement, one column list and then a list of all the values/rows
+	valStr = ','.join(cur.mogrify(formatStr, tup) for tup in valueTups)
+	insStr = 'INSERT INTO ' + tableName + ' ' + colStr + ' VALUES ' + valStr 
+	cur.execute(insStr)
+	rowCount += len(valueTups)
 
-def dictColCopy(fromDict, toDict, keyList):
+    return rowCount
+
+
+def copyVisits(cur, visitRows, fields, batchSize, tableName=FACILITY_VISIT_REPORT_TABLE):
     """
-    Copies keys specified in keyList from the fromDict to the newDict.
+    Streams visit rows into the report table with COPY FROM STDIN in the column order of fields.  At most
+    batchSize rows are buffered before they're sent.
+    @return number of rows copied
     """
+    copySql = 'COPY ' + tableName + ' (' + ','.join(fields) + ') FROM STDIN'
 
-    for key in keyList:
-	if key not in fromDict:
-	    raise Exception('Key ' + key + ' not found in: ' + str(fromDict))
-	toDict[key] = fromDict[key]
+    def flush(buf):
+	buf.seek(0)
+	cur.copy_expert(copySql, buf)
+	return StringIO()
 
+    rowCount = 0
+    buf = StringIO()
+    for visitD in visitRows:
+	buf.write('\t'.join(copyValue(visitD.get(fname)) for fname in fields))
+	buf.write('\n')
+	rowCount += 1
+	if rowCount % batchSize == 0:
+	    buf = flush(buf)
+    if rowCount % batchSize != 0:
+	flush(buf)
 
-def getDictCursor(conn):
-    """
-    Gets a dictionary cursor from the db conn
-    """
-    return conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    return rowCount
 
 
-def mapEpiInvToFacVisits(facVisitRows, epiInvTable, epiInvProdCodes):
+def copyValue(value):
     """
-    Given a list of the facility visits, the epi inventory line items as a table, 
-    and a list of distinct epi product codes, will map those epi inventory columns 
-    into the facility visit row.
+    Formats a value for COPY's text format.  None is \\N and text is utf-8 with backslashes, tabs and
+    newlines escaped.
     """
+    if value is None: return '\\N'
+    if isinstance(value, bool): return 't' if value else 'f'
+    if isinstance(value, (date, datetime)): return value.isoformat()
+    if isinstance(value, unicode): value = value.encode('utf-8')
+    elif not isinstance(value, str): return str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def loadDistinct(conn, sql, params=None):
+    with measureStage('extract:distinct') as stage:
+	cur = conn.cursor()
+	cur.execute(sql, params)
+	rows = cur.fetchall()
+	asList = [row[0] for row in rows]
+	stage['rows'] = len(asList)
+	stage['bytes_fetched'] = rowBytes(asList)
+    return asList
+
 
-    cols = ['existingquantity', 'spoiledquantity', 'deliveredquantity', 'idealquantity']
-    keyColName = 'productcode'
+def loadOpenLmis(conn, scope=None, itersize=EXTRACT_ITER_SIZE, pivotEngine='python', layout=None, connPool=None,
+	codeLists=None, cacheCodes=True, lastVisitDate=False):
+    """
+    Loads and processes OpenLMIS facility visits to final reporting form.  Line items are streamed
+    from the database and pivoted one facility visit at a time.
+    @param conn: open database connection
+    @param scope: optional VisitScope, when given only those facility visits and their line items are loaded
+    @param itersize: rows fetched per round trip while streaming source tables
+    @param pivotEngine: 'python' pivots line items with pivotLineItemValues, 'sql' has Postgres do every pivot
+	in the facility visit query (see buildPivotSql) and 'numpy' scatters line item arrays into a
+	precomputed column layout (see PivotLayout)
+    @param layout: RowLayout of the returned rows, defaults to the report fields (see visitRowLayout)
+    @param connPool: optional connection pool, when given the source tables are extracted concurrently
+	(see runExtractions)
+    @param codeLists: the codes of each of LINE_ITEM_PIVOTS, see extractOpenLmis
+    @param cacheCodes: whether the line item codes are cached in conn's database (see loadLineItemCodes), when
+	False nothing is written to it, so it may be read only
+    @param lastVisitDate: whether the facility visit query computes visited_last_date (--last-visit-date sql),
+	otherwise it's None until computed, e.g. by generateLastVisitDate
+    @return list of OpenLMIS facility visits in reporting form.  Each entry in the list represents
+    one facility visit as a VisitRow whose keys conform to the reporting columns.
     
-    # pivot the line items into a column structure
-    def rename(origColName): # a function that the pivoted column names will be renamed with
-	newColName = re.sub(r'quantity', '', origColName)
-	newColName = re.sub(r'ideal', 'isa', newColName)
-	newColName = re.sub(r'bcg20', 'bcg', newColName)
-	newColName = re.sub(r'measles10', 'measles', newColName)
-	newColName = re.sub(r'tetanus10', 'tetanus', newColName)
-	return 'epi_inventory_' + newColName
-    mapLineItemsToFacVisits(facVisitRows, epiInvTable, keyColName, epiInvProdCodes, cols, rename)
+    """
+    knownCodeLists, results = extractOpenLmis(conn, scope, itersize, pivotEngine, layout, connPool, codeLists,
+	cacheCodes, lastVisitDate)
+    facVisitRows, codeLists = transformOpenLmis(results, knownCodeLists, pivotEngine)
+    if pivotEngine != 'sql' and cacheCodes:
+	# scoped extractions only add the codes that weren't known
+	for pivot, codes, knownCodes in zip(LINE_ITEM_PIVOTS, codeLists, knownCodeLists):
+	    if scope is None or set(codes).difference(knownCodes):
+		saveLineItemCodes(conn, pivot, codes, replace=scope is None)
+    return facVisitRows
 
 
-def mapEpiUseToFacVisits(facVisitRows, epiUseTable, epiUseProdCodes):
+def extractOpenLmis(conn, scope=None, itersize=EXTRACT_ITER_SIZE, pivotEngine='python', layout=None, connPool=None,
+	codeLists=None, cacheCodes=True, lastVisitDate=False):
     """
-    Given a list of the facility visits, the epi use line items as a table, 
-    and a list of distinct epi product codes, will map those epi line items to columns 
-    into the facility visit row.
+    Starts extracting the facility visits and line items loadOpenLmis transforms, see loadOpenLmis for the
+    parameters.
+    @param codeLists: the codes of each of LINE_ITEM_PIVOTS, loaded when not given and the pivots need them
+	up front
+    @return tuple of (codeLists, iterator of the extraction results for transformOpenLmis: the facility geo
+	table, the facility visits and then each line item table)
     """
-    
-    cols = ['first_of_month', 'received', 'distributed', 'loss', 'end_of_month', 'expiration']
-    keyColName = 'product_code'
-    def rename(origColName): # a function that the pivoted column names will be renamed with
-	newColName = re.sub('1bcg', 'bcg', origColName)
-	newColName = re.sub('2bcgdil', 'bcgdil', newColName)
-	newColName = re.sub('3polio', 'polio', newColName)
-	newColName = re.sub('4penta', 'penta', newColName)
-	newColName = re.sub('5measles', 'measles', newColName)
-	newColName = re.sub('6measlesdil', 'measlesdil', newColName)
-	newColName = re.sub('7pcv10', 'pcv', newColName)
-	newColName = re.sub('8hpv', 'hpv', newColName)
-	newColName = re.sub('9tetanus', 'tetanus', newColName)
-	return 'epi_use_' + newColName
-    mapLineItemsToFacVisits(facVisitRows, epiUseTable, keyColName, epiUseProdCodes, cols, rename)
-
-
-def mapAdultCoverageToFacVisits(facVisitRows, adultCovTable, adultCovDemographicGroups):
-    """
-    Given a list of the facility visits, the adult vaccination line items as a table, 
-    and a list of distinct adult coverage demographic groups, will map those items to columns 
-    into the facility visit row.
+    if conn is None:
+	raise Exception("data source connection is not active")
+    if layout is None:
+	layout = visitRowLayout()
+
+    # Postgres pivots need the codes up front.  Python pivots collect them from the line items they extract,
+    # which are every code unless the extraction is scoped.
+    if codeLists is None and pivotEngine == 'sql':
+	codeLists = loadLineItemCodes(conn, LINE_ITEM_CODE_MAX_AGE, cacheCodes)
+    elif codeLists is None and scope is not None:
+	codeLists = loadLineItemCodes(conn, cacheCodes=cacheCodes)
+    elif codeLists is None:
+	codeLists = [() for pivot in LINE_ITEM_PIVOTS]
+
+    # every extraction is a task of a db connection: facility geo zones, then facility visit's, then the line items
+    tasks = [lambda c: loadFacilityGeoTable(c, scope)]
+    if pivotEngine == 'sql':
+	# facility visit's are already in the report's shape when Postgres does the pivots
+	tasks.append(lambda c: list(loadPivotedFacilityVisits(c, layout, scope, itersize, codeLists,
+	    lastVisitDate)))
+    elif pivotEngine in ('python', 'numpy'):
+	tasks.append(lambda c: list(loadFacilityVisits(c, layout, scope, itersize, lastVisitDate)))
+    else:
+	raise ValueError('Unknown pivot engine: ' + str(pivotEngine))
+
+    if pivotEngine == 'python':
+	tasks.extend(functools.partial(extractLineItemValues, pivot=pivot, scope=scope, itersize=itersize)
+	    for pivot in LINE_ITEM_PIVOTS)
+    elif pivotEngine == 'numpy':
+	tasks.extend(functools.partial(loadLineItemColumns, pivot=pivot, scope=scope, itersize=itersize)
+	    for pivot in LINE_ITEM_PIVOTS)
+
+    return codeLists, runExtractions(conn, tasks, connPool)
+
+
+def transformOpenLmis(results, codeLists, pivotEngine='python'):
     """
-    
-    cols = ['healthcentertetanus1', 'outreachtetanus1', 'healthcentertetanus2to5', 'outreachtetanus2to5', 'targetgroup']
-    keyColName = 'demographicgroup'
-    def rename(origColName): # a function that the pivoted column names will be renamed with
-	newColName = re.sub('MIF 15-49 years - Students', 'mif_student', origColName)
-	newColName = re.sub('MIF 15-49 years - Community', 'mif_community', newColName)
-	newColName = re.sub('MIF 15-49 years - Workers', 'mif_worker', newColName)
-	newColName = re.sub('Students not MIF', 'student', newColName)
-	newColName = re.sub('Other not MIF', 'other', newColName)
-	newColName = re.sub('Workers not MIF', 'worker', newColName)
-	newColName = re.sub('Pregnant Women', 'pregnant', newColName)
-	newColName = re.sub('healthcentertetanus1', 'tetanus1hc', newColName)
-	newColName = re.sub('outreachtetanus1', 'tetanus1mb', newColName)
-	newColName = re.sub('healthcentertetanus2to5', 'tetanus25hc', newColName)
-	newColName = re.sub('outreachtetanus2to5', 'tetanus25mb', newColName)
-	newColName = re.sub('targetgroup', 'target_group', newColName)
-	return 'adult_coverage_' + newColName
-    mapLineItemsToFacVisits(facVisitRows, adultCovTable, keyColName, adultCovDemographicGroups, cols, rename)
-
-
-def mapChildCoverageToFacVisits(facVisitRows, childCovTable, childCovVaccs):
-    """
-    Given a list of the facility visits, the child coverage line items as a table, 
-    and a list of distinct child coverage vaccinations, will map those line items to columns 
-    into the facility visit row.
+    Transforms extracted facility visits to reporting form: adds their geographic zones and pivots the line
+    items into them.
+    @param results: iterator of the extraction results and codeLists, as extractOpenLmis returns them
+    @return tuple of (list of facility visit VisitRows, the sorted codes of each of LINE_ITEM_PIVOTS pivoted)
     """
-    
-    cols = ['healthcenter11months', 'outreach11months', 'healthcenter23months', 'outreach23months', 'targetgroup']
-    keyColName = 'vaccination'
-    def rename(origColName): # a function that the pivoted column names will be renamed with
-	newColName = re.sub('BCG', 'bcg', origColName)
-	newColName = re.sub('Measles', 'measles', newColName)
-	newColName = re.sub('PCV10 ', 'pcv', newColName)
-	newColName = re.sub('Penta ', 'penta', newColName)
-	newColName = re.sub('Polio ', 'polio', newColName)
-	newColName = re.sub('\(Newborn\)', '0', newColName)
-	newColName = re.sub('1st dose', '1', newColName)
-	newColName = re.sub('2nd dose', '2', newColName)
-	newColName = re.sub('3rd dose', '3', newColName)
-	newColName = re.sub('healthcenter', 'hc', newColName)
-	newColName = re.sub('outreach', 'mb', newColName)
-	newColName = re.sub('11months', '0_11', newColName)
-	newColName = re.sub('23months', '12_23', newColName)
-	newColName = re.sub('(.+)\d+_targetgroup', r'\1_targetgroup', newColName) # fix things like polio2_targetgroup to be just polio_targetgroup
-	newColName = re.sub('targetgroup', 'target_group', newColName)
-	return 'child_coverage_' + newColName
-    mapLineItemsToFacVisits(facVisitRows, childCovTable, keyColName, childCovVaccs, cols, rename)
-
-
-def mapChildCoverageOpenVialsToFacVisits(facVisitRows, childCovOpenVialsTable, childCovProductVialNames):
-    """
-    Given a list of the facility visits, the child coverage opened vial line items as a table, 
-    and a list of distinct child coverage product vial names, will map those line items to columns 
-    into the facility visit row.
+    facilityTable = next(results)
+    facVisitRows = next(results)
+
+    # add geographic_zone id's for the levels we're interested in for every facility visit
+    with measureStage('transform:geo levels') as stage:
+	geoKeys = [geoPrefix + '_id' for geoPrefix in GEO_LEVEL]
+	map(lambda fv: dictColCopy(facilityTable[fv['facility_id']], fv, geoKeys), facVisitRows)
+	stage['rows'] = len(facVisitRows)
+
+    # the rest of the results are line item tables, mapped into the facility visits one at a time
+    if pivotEngine == 'sql':
+	return facVisitRows, codeLists
+
+    pivotedCodes = []
+    for pivot, knownCodes in zip(LINE_ITEM_PIVOTS, codeLists):
+	if pivotEngine == 'python':
+	    visitValues, codes = next(results)
+	    pivotD, codes = pivotLineItemValues(pivot, visitValues, codes.union(knownCodes))
+	    with measureStage('pivot:copy ' + pivot.name) as stage:
+		copyPivotToFacVisits(facVisitRows, pivotD)
+		stage['rows'] = len(pivotD)
+	else:
+	    columns = next(results)
+	    codes = sorted(set(knownCodes).union(columns[1]))
+	    with measureStage('pivot:numpy ' + pivot.name) as stage:
+		mapLineItemPivotsNumpy(facVisitRows, PivotLayout([pivot], [codes]), [columns])
+		stage['rows'] = len(facVisitRows)
+	pivotedCodes.append(codes)
+
+    return facVisitRows, pivotedCodes
+
+
+def loadLineItemCodes(conn, maxAge=None, cacheCodes=True):
     """
+    Loads the distinct key values (codes) of every line item pivot from LINE_ITEM_CODE_TABLE.  Where a line
+    item table has none cached, or they were cached more than maxAge seconds ago, they're selected with the
+    pivot's distinctSql instead, and cached.
+    @param cacheCodes: when False every pivot's codes are selected with its distinctSql and nothing is read
+	from or written to LINE_ITEM_CODE_TABLE, for databases that are read only (e.g. replicas, --sources)
+    @return list of the sorted codes of each of LINE_ITEM_PIVOTS
+    """
+    cached = {}
+    if cacheCodes:
+	cur = conn.cursor()
+	cur.execute(LINE_ITEM_CODE_DDL)
+	cur.execute(CACHED_CODE_SQL)
+	cached = dict((name, (codes, age)) for name, codes, age in cur.fetchall())
+	cur.close()
+
+    codeLists = []
+    for pivot in LINE_ITEM_PIVOTS:
+	codes, age = cached.get(pivot.name, (None, None))
+	if codes is None or (maxAge is not None and age > maxAge):
+	    codes = loadDistinct(conn, pivot.distinctSql)
+	    if cacheCodes:
+		saveLineItemCodes(conn, pivot, codes, replace=True)
+	codeLists.append(sorted(codes))
+    return codeLists
+
+
+def saveLineItemCodes(conn, pivot, codes, replace=False):
+    """
+    Caches the codes of a line item pivot in LINE_ITEM_CODE_TABLE.
+    @param replace: when True codes are all of the line item table's codes and replace the cached ones,
+	otherwise codes not yet cached are added
+    """
+    cur = conn.cursor()
+    cur.execute(LINE_ITEM_CODE_DDL)
+    if replace:
+	cur.execute('DELETE FROM ' + LINE_ITEM_CODE_TABLE + ' WHERE line_item_table = %s', (pivot.name,))
+    cur.execute('INSERT INTO ' + LINE_ITEM_CODE_TABLE + ' (line_item_table, code) SELECT %s, unnest(%s::text[]) ' +
+	'ON CONFLICT DO NOTHING', (pivot.name, list(codes)))
+    cur.close()
+
+
+def loadFacilityGeoTable(conn, scope=None):
+    """
+    Loads the geographic zone ancestors, one id per level in GEO_LEVEL, of the facilities that have a facility
+    visit in scope.  Ancestors are resolved once per facility by FACILITY_GEO_SQL rather than walking the zone
+    hierarchy in Python, and only the ids the report needs are kept.
+    @return dict of facility id => dict of <geo level name>_id (e.g. district_id) => geographic zone id
+    """
+    sql, params = facilityGeoSql(scope)
+    with measureStage('extract:' + GEO_ZONE_TABLE) as stage:
+	cur = getDictCursor(conn)
+	cur.execute(sql, params)
+	rows = cur.fetchall()
+	cur.close()
+	facilityTable = rowToTable(rows, 'id')
+	stage['rows'] = len(facilityTable)
+	stage['bytes_fetched'] = sum(rowBytes(row.itervalues()) for row in rows)
+
+    for geoLevelName, geoLevelCode in GEO_LEVEL.iteritems():
+	for fac in facilityTable.itervalues():
+	    if fac[geoLevelName + '_id'] is None:
+		raise Exception('GeoLevelCode ' + geoLevelCode + ' not found for facility ' + str(fac['id']))
+    return facilityTable
+
+
+def facilityVisitSql(scope=None, lastVisitDate=False):
+    """
+    @param lastVisitDate: whether visited_last_date is selected, see LAST_VISIT_DATE_SQL
+    @return tuple of FACILITY_VISIT_SQL with the scope's condition and its parameters
+    """
+    sql = FACILITY_VISIT_SQL % {'lastVisitDate': LAST_VISIT_DATE_SQL if lastVisitDate else ''}
+    return scopeSql(sql, scope, 'fv.id', conjunction='AND')
+
+
+def facilityGeoSql(scope=None):
+    """
+    @return tuple of the sql loadFacilityGeoTable runs and its parameters
+    """
+    visitFacilitySql, params = scopeSql(VISIT_FACILITY_SQL, scope, 'fv.id')
+    return FACILITY_GEO_SQL % {'visitFacilitySql': visitFacilitySql}, params
+
+
+def extractLineItemValues(conn, pivot, scope=None, itersize=EXTRACT_ITER_SIZE):
+    """
+    Streams a line item table for the Python pivot, keeping each line item as a tuple of its values of
+    pivot.cols until the codes are known, and collects the codes.
+    @return tuple of (list of (facility visit id, dict of code => values), set of the codes)
+    """
+    codes = set()
+    visitValues = []
+    for liKey, lineItems in pivot.loadLineItems(conn, scope, itersize):
+	if not isinstance(lineItems, list): lineItems = [lineItems,]
+	liValues = dict((li[pivot.keyColName], tuple(li.get(col) for col in pivot.cols)) for li in lineItems)
+	codes.update(liValues)
+	visitValues.append((liKey, liValues))
+    return visitValues, codes
+
+
+def pivotLineItemValues(pivot, visitValues, codes):
+    """
+    Pivots the line items extractLineItemValues kept into the columns of the given codes.
+    @return tuple of (dict of facility visit id => pivoted columns, sorted list of the codes)
+    """
+    with measureStage('pivot:' + pivot.name) as stage:
+	codes = sorted(codes)
+	colIndex = dict((col, c) for c, col in enumerate(pivot.cols))
+	colLayout = [(colName, code, colIndex[col]) for colName, (code, col) in
+	    pivot.columnLayout(codes).iteritems()]
+	pivotD = {}
+	for liKey, liValues in visitValues:
+	    pivotD[liKey] = dict((colName, liValues[code][c] if code in liValues else None)
+		for colName, code, c in colLayout)
+	stage['rows'] = len(pivotD)
+    return pivotD, codes
+
+
+def runExtractions(conn, tasks, connPool=None):
+    """
+    Runs independent extraction tasks, each a function of a db connection that returns fully loaded results.
+    Without a pool the tasks run one after another on conn, each only when its result is asked for.  With a
+    pool they run concurrently from a thread pool with one pooled connection per thread, all in a REPEATABLE
+    READ transaction importing a snapshot exported from conn so every task sees the same data.
+    @return iterator of the task results in task order
+    """
+    if connPool is None:
+	return (task(conn) for task in tasks)
+
+    snapshotId = exportSnapshot(conn)
+    def runTask(task):
+	taskConn = connPool.getconn()
+	try:
+	    importSnapshot(taskConn, snapshotId)
+	    return task(taskConn)
+	finally:
+	    try:
+		taskConn.rollback()
+	    except psycopg2.Error: # the connection was lost, it's closed rather than handed out again
+		connPool.putconn(taskConn, close=True)
+	    else:
+		connPool.putconn(taskConn)
+
+    def results():
+	threads = ThreadPool(connPool.maxconn)
+	try:
+	    for result in threads.imap(runTask, tasks):
+		yield result
+	    threads.close()
+	except BaseException:
+	    threads.terminate()
+	    raise
+	finally:
+	    threads.join()
+
+    return results()
+
+
+def exportSnapshot(conn):
+    """
+    @return id of a snapshot of conn's current transaction that other connections can import while
+	the transaction stays open
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT pg_export_snapshot()')
+    snapshotId = cur.fetchone()[0]
+    cur.close()
+    return snapshotId
+
+
+def importSnapshot(conn, snapshotId):
+    """
+    Starts a REPEATABLE READ transaction on conn that sees the exported snapshot.  Must be the first
+    statements of conn's transaction.
+    """
+    cur = conn.cursor()
+    cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    cur.execute('SET TRANSACTION SNAPSHOT %s', (snapshotId,))
+    cur.close()
+
+
+def generateLastVisitDate(visitRows, lastVisitMap=None):
+    """
+    Generates the visited_last_date field for every record given by searching through all records to find
+    the last visit date for each facility.  Sets visited_last_date field to None if there was no last visit,
+    or the last visit date regardless of weather the facility record indicates it was not visited or not recorded.
     
-    cols = ['openedvials']
-    keyColName = 'productvialname'
-    def rename(origColName): # a function that the pivoted column names will be renamed with
-	newColName = re.sub('BCG', 'bcg', origColName)
-	newColName = re.sub('Measles', 'measles', newColName)
-	newColName = re.sub('PCV', 'pcv', newColName)
-	newColName = re.sub('Penta', 'penta', newColName)
-	newColName = re.sub('Polio', 'polio', newColName)
-	newColName = re.sub('openedvials', 'vials_opened', newColName)
-	return 'child_coverage_' + newColName
-    mapLineItemsToFacVisits(facVisitRows, childCovOpenVialsTable, keyColName, childCovProductVialNames, cols, rename)
-
-
-def mapLineItemsToFacVisits(facVisitRows, lineItemTable, keyColName, distinctCodeList, desiredCols, colRenameFn):
-    """
-    Transforms line items to a column structure, maps each of those back to appropriate facility visit row.
-
-    @param facVisitRows: a list of dicts where each dict is a facility visit.  Each dict will have the keys & values 
-	from the line item pivot added to it.
-    @param lineItemTable: the line items to pivot as a dict of either one dict or a list of dict.  They key
-	should map the line item(s) to the facility visit row by facVisitRows['id']
-    @param keyColName: the name of the column the pivot function will pivot around found in every entry of the 
-	lineItemTable
-    @param distinctCodeList: a set of values we will use to maintain a consistent number of columns throughout
-	the pivot of each line items to facility visits.  Values here are found in the line items keyColName
-    @param desiredCols: a set of columns found in every line item that we want to turn into columns
-    @param colRenameFn: a function that takes the name of the original column from desiredCols and maps it to
-	a new name that will be found in the resulting map
-
-    """
-    # pivot the line items to a col structure
-    pivot = pivotLineItems(lineItemTable, keyColName, distinctCodeList, desiredCols, colRename = colRenameFn)
-    
+    @param visitRows a list of dicts that is the entire visit record history and that will be updated with the 
+	visited_last_date field.
+    @param lastVisitMap optional dict of facility_id => last visit date from before the earliest of visitRows,
+	used when visitRows is only the tail of each facility's history (i.e. incremental runs).
+
+    """
+
+    with measureStage('transform:visited_last_date') as stage:
+	# sort chronological ascending by visit_code which will group by facility and then period (e.g. 2013-03, 2013-04)
+	rowsAsc = sorted(visitRows, key=lambda r: r['visit_code'])
+
+	# for every visit row, extract facility code, enter it into map where fac_code => last_visit_date
+	lastVisitMap = dict(lastVisitMap or {})
+	for row in rowsAsc:
+	    mapKey = row['facility_id']
+
+	    # a) if no record in map exists, or value is None, last visit date for record is None
+	    # b) if record in map exisits and is not None, last visit date for record is map value
+	    # c) update map value with row's visit_date field if row's visit date is not None (i.e. only update for visits)
+	    mapValue = lastVisitMap.get(mapKey)
+	    row['visited_last_date'] = mapValue
+	    if row['visited_date'] is not None:
+		lastVisitMap[mapKey] = row['visited_date']
+	stage['rows'] = len(rowsAsc)
+
+
+def seedLastVisitDate(visitRows, lastVisitMap):
+    """
+    Completes the visited_last_date computed by FACILITY_VISIT_SQL when visitRows are only the tail of each
+    facility's history (i.e. incremental runs).  A row whose facility had no earlier visit among the rows
+    extracted gets the facility's last visit date from before them.  Each row is handled on its own, so
+    visitRows may be streamed.
+
+    @param visitRows iterable of visit rows whose visited_last_date came from FACILITY_VISIT_SQL
+    @param lastVisitMap dict of facility_id => last visit date from before the earliest of visitRows
+    @return generator of the visit rows
+    """
+    for row in visitRows:
+	if row['visited_last_date'] is None:
+	    row['visited_last_date'] = lastVisitMap.get(row['facility_id'])
+	yield row
+
+
+def loadHighWaterMarks(conn):
+    """
+    Loads the high-water marks persisted by the last successful run.
+    @return dict of source table name => last modifieddate processed.  Empty if there has been no run.
+    """
+    cur = conn.cursor()
+    cur.execute(ETL_STATE_DDL)
+    cur.execute('SELECT source_table, high_water FROM ' + ETL_STATE_TABLE)
+    marks = dict(cur.fetchall())
+    cur.close()
+    return marks
+
+
+def reportPartitioned(conn):
+    """
+    @return True when the report is the period partitioned table of reportTableDdl
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (FACILITY_VISIT_REPORT_TABLE,))
+    row = cur.fetchone()
+    cur.close()
+    return row is not None and row[0]
+
+
+def highWaterMarksKept(conn):
+    """
+    @return True when ETL_STATE_TABLE exists, i.e. high-water marks are kept for incremental runs
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT to_regclass(%s)', (ETL_STATE_TABLE,))
+    kept = cur.fetchone()[0] is not None
+    cur.close()
+    return kept
+
+
+def currentHighWaterMarks(conn):
+    """
+    @return dict of source table name => max modifieddate currently in that table less HIGH_WATER_OVERLAP, for
+	every table in INCREMENTAL_SOURCES that has rows.
+    """
+    cur = conn.cursor()
+    marks = {}
+    for tableName, idCol in INCREMENTAL_SOURCES:
+	cur.execute('SELECT max(modifieddate) FROM ' + tableName)
+	highWater = cur.fetchone()[0]
+	if highWater is not None:
+	    marks[tableName] = highWater - HIGH_WATER_OVERLAP
+    cur.close()
+    return marks
+
+
+def saveHighWaterMarks(conn, marks):
+    cur = conn.cursor()
+    cur.execute(ETL_STATE_DDL)
+    cur.execute('DELETE FROM ' + ETL_STATE_TABLE)
+    cur.executemany('INSERT INTO ' + ETL_STATE_TABLE + ' (source_table, high_water) VALUES (%s, %s)',
+	marks.items())
+    cur.close()
+
+
+def loadChangedVisitIds(conn, marks):
+    """
+    Finds the facility visits that have been modified, or had any line item modified, at or after the
+    given high-water marks.  A table without a mark is treated as entirely changed.
+    @return set of facility visit ids
+    """
+    cur = conn.cursor()
+    visitIds = set()
+    for tableName, idCol in INCREMENTAL_SOURCES:
+	sql = 'SELECT DISTINCT ' + idCol + ' FROM ' + tableName
+	if tableName in marks:
+	    cur.execute(sql + ' WHERE modifieddate >= %s', (marks[tableName],))
+	else:
+	    cur.execute(sql)
+	visitIds.update(row[0] for row in cur.fetchall())
+    cur.close()
+    return visitIds
+
+
+def loadPeriodIds(conn, startDate=date.min):
+    """
+    @return list of the ids of the processing periods starting on or after startDate, in order
+    """
+    return loadDistinct(conn, PERIOD_SQL, (startDate,))
+
+
+def loadAffectedVisitIds(conn, changedVisitIds):
+    """
+    Expands changed facility visits to every visit at the same facilities from the earliest changed period
+    onwards, as those later visits' visited_last_date may depend on the changed visits.
+    @return list of facility visit ids
+    """
+    return loadDistinct(conn, AFFECTED_VISIT_SQL, {'visitIds': list(changedVisitIds)})
+
+
+def loadLastVisitSeeds(conn, changedVisitIds):
+    """
+    @return dict of facility_id => the last visit date stored in the report before the facility's
+	earliest changed period, for seeding generateLastVisitDate
+    """
+    cur = conn.cursor()
+    cur.execute(LAST_VISIT_SEED_SQL, {'visitIds': list(changedVisitIds)})
+    seeds = dict(cur.fetchall())
+    cur.close()
+    return seeds
+
+
+def dictColCopy(fromDict, toDict, keyList):
+    """
+    Copies keys specified in keyList from the fromDict to the newDict.
+    """
+
+    for key in keyList:
+	if key not in fromDict:
+	    raise Exception('Key ' + key + ' not found in: ' + str(fromDict))
+	toDict[key] = fromDict[key]
+
+
+def getDictCursor(conn, name=None):
+    """
+    Gets a dictionary cursor from the db conn, a server side cursor if a name is given
+    """
+    return conn.cursor(name, cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+def epiInvColRename(origColName):
+    """
+    Renames pivoted epi inventory columns (e.g. BCG20_idealquantity) to report columns (e.g. epi_inventory_bcg_isa).
+    """
+    newColName = re.sub(r'quantity', '', origColName)
+    newColName = re.sub(r'ideal', 'isa', newColName)
+    newColName = re.sub(r'bcg20', 'bcg', newColName)
+    newColName = re.sub(r'measles10', 'measles', newColName)
+    newColName = re.sub(r'tetanus10', 'tetanus', newColName)
+    return 'epi_inventory_' + newColName
+
+
+def epiUseColRename(origColName):
+    """
+    Renames pivoted epi use columns (e.g. 1bcg_received) to report columns (e.g. epi_use_bcg_received).
+    """
+    newColName = re.sub('1bcg', 'bcg', origColName)
+    newColName = re.sub('2bcgdil', 'bcgdil', newColName)
+    newColName = re.sub('3polio', 'polio', newColName)
+    newColName = re.sub('4penta', 'penta', newColName)
+    newColName = re.sub('5measles', 'measles', newColName)
+    newColName = re.sub('6measlesdil', 'measlesdil', newColName)
+    newColName = re.sub('7pcv10', 'pcv', newColName)
+    newColName = re.sub('8hpv', 'hpv', newColName)
+    newColName = re.sub('9tetanus', 'tetanus', newColName)
+    return 'epi_use_' + newColName
+
+
+def adultCoverageColRename(origColName):
+    """
+    Renames pivoted adult coverage columns (e.g. Pregnant Women_outreachtetanus1) to report columns
+    (e.g. adult_coverage_pregnant_tetanus1mb).
+    """
+    newColName = re.sub('MIF 15-49 years - Students', 'mif_student', origColName)
+    newColName = re.sub('MIF 15-49 years - Community', 'mif_community', newColName)
+    newColName = re.sub('MIF 15-49 years - Workers', 'mif_worker', newColName)
+    newColName = re.sub('Students not MIF', 'student', newColName)
+    newColName = re.sub('Other not MIF', 'other', newColName)
+    newColName = re.sub('Workers not MIF', 'worker', newColName)
+    newColName = re.sub('Pregnant Women', 'pregnant', newColName)
+    newColName = re.sub('healthcentertetanus1', 'tetanus1hc', newColName)
+    newColName = re.sub('outreachtetanus1', 'tetanus1mb', newColName)
+    newColName = re.sub('healthcentertetanus2to5', 'tetanus25hc', newColName)
+    newColName = re.sub('outreachtetanus2to5', 'tetanus25mb', newColName)
+    newColName = re.sub('targetgroup', 'target_group', newColName)
+    return 'adult_coverage_' + newColName
+
+
+def childCoverageColRename(origColName):
+    """
+    Renames pivoted child coverage columns (e.g. Polio 2nd dose_outreach23months) to report columns
+    (e.g. child_coverage_polio2_mb12_23).
+    """
+    newColName = re.sub('BCG', 'bcg', origColName)
+    newColName = re.sub('Measles', 'measles', newColName)
+    newColName = re.sub('PCV10 ', 'pcv', newColName)
+    newColName = re.sub('Penta ', 'penta', newColName)
+    newColName = re.sub('Polio ', 'polio', newColName)
+    newColName = re.sub('\(Newborn\)', '0', newColName)
+    newColName = re.sub('1st dose', '1', newColName)
+    newColName = re.sub('2nd dose', '2', newColName)
+    newColName = re.sub('3rd dose', '3', newColName)
+    newColName = re.sub('healthcenter', 'hc', newColName)
+    newColName = re.sub('outreach', 'mb', newColName)
+    newColName = re.sub('11months', '0_11', newColName)
+    newColName = re.sub('23months', '12_23', newColName)
+    newColName = re.sub('(.+)\d+_targetgroup', r'\1_targetgroup', newColName) # fix things like polio2_targetgroup to be just polio_targetgroup
+    newColName = re.sub('targetgroup', 'target_group', newColName)
+    return 'child_coverage_' + newColName
+
+
+def childCoverageOpenVialColRename(origColName):
+    """
+    Renames pivoted child coverage opened vial columns (e.g. BCG20_openedvials) to report columns
+    (e.g. child_coverage_bcg20_vials_opened).
+    """
+    newColName = re.sub('BCG', 'bcg', origColName)
+    newColName = re.sub('Measles', 'measles', newColName)
+    newColName = re.sub('PCV', 'pcv', newColName)
+    newColName = re.sub('Penta', 'penta', newColName)
+    newColName = re.sub('Polio', 'polio', newColName)
+    newColName = re.sub('openedvials', 'vials_opened', newColName)
+    return 'child_coverage_' + newColName
+
+
+class LineItemPivot(object):
+    """
+    Describes how one line item table is pivoted into facility visit columns.  Every line item is keyed by
+    keyColName and each of its cols becomes the report column rename(key + '_' + col).
+
+    @param source: the line item table, or a parenthesized select, exposing facilityvisitid, keyColName and cols
+    @param distinctSql: sql selecting the distinct values of keyColName
+    @param valueSql: optional dict of col => sql expression used by generated sql in place of the column
+    @param loader: optional function of (conn, scope, itersize) streaming the line items for the Python
+	pivot, see loadLineItems (the default, reading the source table)
+    @param loaderSql: with loader, function of scope returning the sql loader runs and its parameters
+    @param name: the line item table's name in measurements, defaults to source
+    """
+
+    def __init__(self, source, keyColName, cols, rename, distinctSql, valueSql=None, loader=None, name=None,
+	    loaderSql=None):
+	self.name = name or source
+	self.source = source
+	self.keyColName = keyColName
+	self.cols = cols
+	self.rename = rename
+	self.distinctSql = distinctSql
+	self.valueSql = valueSql or {}
+	self.loader = loader
+	self.loaderSql = loaderSql
+
+    def loadLineItems(self, conn, scope=None, itersize=EXTRACT_ITER_SIZE):
+	"""
+	@return generator of (facilityvisitid, list of line item dicts), see groupRows
+	"""
+	if self.loader is not None:
+	    return self.loader(conn, scope, itersize)
+	return loadLineItems(conn, self.source, scope, itersize)
+
+    def lineItemSql(self, scope=None):
+	"""
+	@return tuple of the sql loadLineItems runs and its parameters
+	"""
+	if self.loaderSql is not None:
+	    return self.loaderSql(scope)
+	return lineItemSql(self.source, scope)
+
+    def columnLayout(self, codes):
+	"""
+	Computes the report columns this pivot produces for the given distinct key values.  Where two
+	(code, col) pairs are renamed to the same column the later one wins, as in pivotLineItems.
+	@return OrderedDict of report column name => (code, col)
+	"""
+	layout = OrderedDict()
+	for code in codes:
+	    for col in self.cols:
+		layout[self.rename(code + '_' + col)] = (code, col)
+	return layout
+
+
+EPI_INV_PIVOT = LineItemPivot(EPI_INV_TABLE, 'productcode',
+    ['existingquantity', 'spoiledquantity', 'deliveredquantity', 'idealquantity'],
+    epiInvColRename, EPI_INV_DISTINCT_CODE_SQL)
+
+EPI_USE_PIVOT = LineItemPivot('(' + EPI_USE_LINE_ITEM_SQL + ')', 'product_code',
+    ['first_of_month', 'received', 'distributed', 'loss', 'end_of_month', 'expiration'],
+    epiUseColRename, EPI_USE_DISTINCT_CODE_SQL,
+    valueSql={'expiration': "to_date(li.expiration, 'MM/YYYY')"}, # same conversion as loadEpiUseLineItems
+    loader=loadEpiUseLineItems, loaderSql=epiUseLineItemSql, name=EPI_USE_TABLE)
+
+ADULT_COVERAGE_PIVOT = LineItemPivot(ADULT_COVERAGE_TABLE, 'demographicgroup',
+    ['healthcentertetanus1', 'outreachtetanus1', 'healthcentertetanus2to5', 'outreachtetanus2to5', 'targetgroup'],
+    adultCoverageColRename, ADULT_COV_DISTINCT_GROUP_SQL)
+
+CHILD_COVERAGE_PIVOT = LineItemPivot(CHILD_COVERAGE_TABLE, 'vaccination',
+    ['healthcenter11months', 'outreach11months', 'healthcenter23months', 'outreach23months', 'targetgroup'],
+    childCoverageColRename, CHILD_COV_DISTINCT_VACC_SQL)
+
+CHILD_COVERAGE_OPEN_VIAL_PIVOT = LineItemPivot(CHILD_COVERAGE_OPEN_VIAL_TABLE, 'productvialname',
+    ['openedvials'],
+    childCoverageOpenVialColRename, CHILD_COV_DISTINCT_PRODUCT_VIAL_SQL)
+
+# every line item pivot in the order they're added to facility visits
+LINE_ITEM_PIVOTS = [EPI_INV_PIVOT, EPI_USE_PIVOT, ADULT_COVERAGE_PIVOT, CHILD_COVERAGE_PIVOT,
+    CHILD_COVERAGE_OPEN_VIAL_PIVOT]
+
+
+def buildPivotSql(codeLists, scope=None, lastVisitDate=False):
+    """
+    Generates a single statement that pivots every line item table in Postgres, returning facility visits
+    already in the report's shape.  Each pivot is a grouped subquery of max(CASE WHEN key = code THEN col END)
+    aggregates, one per report column, left joined to FACILITY_VISIT_SQL.
+
+    @param codeLists: the distinct key values for each of LINE_ITEM_PIVOTS, in the same order
+    @param scope: optional VisitScope restricting the facility visits and line items
+    @param lastVisitDate: whether visited_last_date is selected, see facilityVisitSql
+    @return tuple of the sql and its parameters
+    """
+    fvSql, params = facilityVisitSql(scope, lastVisitDate)
+    params = list(params or [])
+    selectCols = ['fv.*']
+    joins = []
+    for i, (pivot, codes) in enumerate(zip(LINE_ITEM_PIVOTS, codeLists)):
+	alias = 'p%d' % i
+	aggs = []
+	for colName, (code, col) in pivot.columnLayout(codes).iteritems():
+	    valueSql = pivot.valueSql.get(col, 'li.' + col)
+	    aggs.append('max(CASE WHEN li.%s = %%s THEN %s END) AS %s' % (pivot.keyColName, valueSql, quoteIdent(colName)))
+	    selectCols.append(alias + '.' + quoteIdent(colName))
+	    params.append(code)
+
+	liSql, liParams = scopeSql('SELECT li.facilityvisitid, ' + ', '.join(aggs) + ' FROM ' + pivot.source +
+	    ' AS li', scope, 'li.facilityvisitid')
+	params.extend(liParams or [])
+	joins.append('LEFT JOIN (' + liSql + ' GROUP BY li.facilityvisitid) AS ' + alias +
+	    ' ON (' + alias + '.facilityvisitid=fv.id)')
+
+    sql = 'SELECT ' + '\n    , '.join(selectCols) + '\n    FROM (' + fvSql + ') AS fv\n    ' + '\n    '.join(joins)
+    return sql, params
+
+
+def buildReportViewSql(conn, fieldDefs):
+    """
+    Generates the select of the report's materialized view: buildPivotSql's pivot of every facility visit
+    joined to FACILITY_GEO_SQL, with the field map's columns in order cast to their field map type.  Fields
+    neither provides are null.  The distinct codes of the line items are inlined, so the view has to be
+    created again when they change.
+
+    @param fieldDefs: loadFieldDefs
+    @return the sql, without parameters
+    """
+    codeLists = loadLineItemCodes(conn, LINE_ITEM_CODE_MAX_AGE)
+    pivotSql, params = buildPivotSql(codeLists, lastVisitDate=True)
+    geoCols = ''.join(', geo.%s_id' % level for level in sorted(GEO_LEVEL))
+    sourceSql = ('SELECT r.*' + geoCols + '\n    FROM (' + pivotSql + ') AS r\n    LEFT JOIN (' +
+	FACILITY_GEO_SQL % {'visitFacilitySql': VISIT_FACILITY_SQL} + ') AS geo ON (geo.id=r.facility_id)')
+
+    cur = conn.cursor()
+    cur.execute('SELECT * FROM (' + sourceSql + ') AS src LIMIT 0', params)
+    sourceCols = set(desc[0] for desc in cur.description)
+    selectCols = []
+    for name, fieldDef in fieldDefs.iteritems():
+	value = 'src.' + quoteIdent(name) if name in sourceCols else 'NULL'
+	if fieldDef.get('type'):
+	    value += '::' + fieldDef['type']
+	selectCols.append(value + ' AS ' + quoteIdent(name))
+
+    sql = cur.mogrify('SELECT ' + '\n    , '.join(selectCols) + '\n    FROM (' + sourceSql + ') AS src', params)
+    cur.close()
+    return sql
+
+
+def quoteIdent(name):
+    """
+    Quotes a column name for generated sql.  Percent signs are doubled as the sql is run with parameters.
+    """
+    return '"' + name.replace('"', '""').replace('%', '%%') + '"'
+
+
+class PivotLayout(object):
+    """
+    The report columns produced by a list of LineItemPivots, computed once per run instead of renaming
+    every code x column pair of every facility visit.  For each pivot, targets[code index, column index]
+    is the index of the report column that pair is pivoted into, or -1 where a later pair is renamed
+    to the same report column (and so wins, as in pivotLineItems).
+    """
+
+    def __init__(self, pivots, codeLists):
+	if numpy is None:
+	    raise ImportError('numpy is required for the numpy pivot engine')
+	self.pivots = pivots
+	self.columns = []
+	self.codeIndexes = []
+	self.targets = []
+	columnIndex = {}
+	for pivot, codes in zip(pivots, codeLists):
+	    codeIndex = dict((code, k) for k, code in enumerate(codes))
+	    colIndex = dict((col, c) for c, col in enumerate(pivot.cols))
+	    targets = numpy.full((len(codes), len(pivot.cols)), -1, dtype=numpy.intp)
+	    for colName, (code, col) in pivot.columnLayout(codes).iteritems():
+		if colName not in columnIndex:
+		    columnIndex[colName] = len(self.columns)
+		    self.columns.append(colName)
+		targets[codeIndex[code], colIndex[col]] = columnIndex[colName]
+	    self.codeIndexes.append(codeIndex)
+	    self.targets.append(targets)
+
+
+def loadLineItemColumns(conn, pivot, scope=None, itersize=EXTRACT_ITER_SIZE):
+    """
+    Loads a line item table column-wise for the numpy pivot engine.
+    @return tuple of (facility visit ids, key column values, list of value sequences one per pivot.cols)
+    """
+    selectCols = ['li.facilityvisitid', 'li.' + pivot.keyColName] + \
+	[pivot.valueSql.get(col, 'li.' + col) for col in pivot.cols]
+    sql, params = scopeSql('SELECT ' + ', '.join(selectCols) + ' FROM ' + pivot.source + ' AS li',
+	scope, 'li.facilityvisitid')
+    columns = zip(*loadAllFromSql(conn, sql, params, itersize, dictRows=False, stageName='extract:' + pivot.name))
+    if len(columns) == 0:
+	return (), (), [() for col in pivot.cols]
+    return columns[0], columns[1], columns[2:]
+
+
+def mapLineItemPivotsNumpy(facVisitRows, layout, lineItemColumns):
+    """
+    Pivots every line item table into the facility visit rows by loading each table into arrays (visit id,
+    code index and value columns) and scattering all values into one preallocated visits x report columns
+    array, one vectorized assignment per value column.  Unlike pivotLineItems, a visit without line items
+    gets None columns rather than an error.
+
+    @param lineItemColumns: iterable of each of layout.pivots line item tables, as loadLineItemColumns
+	returns them
+    """
+    if len(facVisitRows) == 0:
+	return
+    visitIds = numpy.array([fv['id'] for fv in facVisitRows], dtype=numpy.int64)
+    visitOrder = numpy.argsort(visitIds)
+    sortedIds = visitIds[visitOrder]
+    pivoted = numpy.empty((len(facVisitRows), len(layout.columns)), dtype=object)
+
+    for codeIndex, targets, columns in itertools.izip(layout.codeIndexes, layout.targets, lineItemColumns):
+	liVisitIds, liKeys, liValues = columns
+	if len(liVisitIds) == 0:
+	    continue
+
+	# row of each line item's facility visit, dropping line items of visits that weren't loaded
+	liVisitIds = numpy.array(liVisitIds, dtype=numpy.int64)
+	pos = numpy.minimum(numpy.searchsorted(sortedIds, liVisitIds), len(sortedIds) - 1)
+	codeIdx = numpy.array([codeIndex.get(key, -1) for key in liKeys], dtype=numpy.intp)
+	valid = (sortedIds[pos] == liVisitIds) & (codeIdx >= 0)
+	rows = visitOrder[pos[valid]]
+	codeIdx = codeIdx[valid]
+
+	for c, values in enumerate(liValues):
+	    colValues = numpy.empty(len(values), dtype=object)
+	    colValues[:] = values
+	    colTargets = targets[codeIdx, c]
+	    keep = colTargets >= 0
+	    pivoted[rows[keep], colTargets[keep]] = colValues[valid][keep]
+
+    columns = layout.columns
+    for i, facVisitD in enumerate(facVisitRows):
+	facVisitD.update(itertools.izip(columns, pivoted[i]))
+
+
+def loadPivotedFacilityVisits(conn, layout, scope=None, itersize=EXTRACT_ITER_SIZE, codeLists=None,
+	lastVisitDate=False):
+    """
+    Loads facility visits with every line item pivot done by Postgres, see buildPivotSql.
+    @param codeLists: the codes of each of LINE_ITEM_PIVOTS, defaults to loadLineItemCodes
+    @return generator of VisitRows with the pivoted line item columns
+    """
+    if codeLists is None:
+	codeLists = loadLineItemCodes(conn, LINE_ITEM_CODE_MAX_AGE)
+    sql, params = buildPivotSql(codeLists, scope, lastVisitDate)
+    return loadVisitRows(conn, sql, params, layout, itersize, 'extract:pivoted ' + FACILITY_VISIT_TABLE)
+
+
+def copyPivotToFacVisits(facVisitRows, pivot):
+    """
+    Copies the pivoted line item columns of each facility visit, as pivotLineItems returns them, into
+    the facility visit rows.
+    """
     def copyLineItemsToFacVisit(facVisitD):
 	fvId = facVisitD['id']
 	dictColCopy(pivot[fvId], facVisitD, pivot[fvId].keys())
     map(copyLineItemsToFacVisit, facVisitRows) 
-    
+
 
 def pivotLineItems(itemTable, keyColName, keyColValues, columns, colRename = None):
     """
     Given an item table of the form:
 	key => lineItem or
 	key => list(lineItems)
-    return a dict of the form:
+    or an iterable of (key, list(lineItems)) pairs such as groupRows generates, return a dict of the form:
 	key => lineItemDict
     Where lineItemDict has keys of the form:
 	"keyColValue_column" => lineItem[column] for lineItem[keyColName]
@@ -601,13 +2047,16 @@ def pivotLineItems(itemTable, keyColName, keyColValues, columns, colRename = Non
 
     If colRename is defined, it must be a function that takes a key string and returns a key string
     that will be used in place of keyColValue_column. e.g. {colRename('AAA_existing'): 10}
+
+    No run uses it anymore, it's the reference the pivot engines are tested against.
     """
 
     if columns is None: return itemTable
     
     # loop through line item table, for every key we look at the line items for that key
     pivotD = {} # holds the resulting pivot table
-    for liKey, liValue in itemTable.iteritems():
+    items = itemTable.iteritems() if isinstance(itemTable, dict) else itemTable
+    for liKey, liValue in items:
 	liDict = {}
 	if not isinstance(liValue, list): liValue = [liValue,]
 	liAsTable = rowToTable(liValue, keyColName)
@@ -635,28 +2084,1607 @@ def printMissingFieldNames(visitRows, fieldNames):
 		print 'Missing field name: ' + fname + ' from row with key: ' + row['visit_code']
  
 
-dbConn = None
-try:
-    dbConn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER)
-
+def runFull(conn, fields, args, connPool=None):
     # load open lmis facility visit rows
-    facVisitRows = loadOpenLmis(dbConn)
+    facVisitRows = loadOpenLmis(conn, itersize=args.itersize, pivotEngine=args.pivot_engine,
+	layout=visitRowLayout(fields), connPool=connPool, lastVisitDate=args.last_visit_date == 'sql')
 
-    # generate last visit date for every record
-    generateLastVisitDate(facVisitRows)
+    # generate last visit date for every record, unless FACILITY_VISIT_SQL's is used
+    if args.last_visit_date == 'python':
+	generateLastVisitDate(facVisitRows)
 
-    # load desired field list and store all visit rows in report DB
-    fields = loadFields()
     #printMissingFieldNames(facVisitRows, fields)
-    storeVisits(dbConn, facVisitRows, fields)
-
-    dbConn.commit()
-
-    print "distributions-etl has completed"
-except BaseException, err:
-    if dbConn is not None:
-	dbConn.rollback()
-    raise 
-finally:
-    if dbConn is not None:
-	dbConn.close()
+    return storeReport(conn, facVisitRows, fields, args)
+
+
+def storeReport(conn, facVisitRows, fields, args):
+    """
+    Replaces the report with every facility visit row, as --refresh says, and stores the --rollups of it.
+    @return number of report rows stored
+    """
+    if args.refresh == 'swap':
+	createSwapTable(conn)
+	storeVisits(conn, facVisitRows, fields, loadMethod=args.load_method, batchSize=args.batch_size,
+	    tableName=FACILITY_VISIT_REPORT_SWAP_TABLE, append=True)
+	if args.rollups:
+	    storeRollups(conn, reportTable=FACILITY_VISIT_REPORT_SWAP_TABLE)
+	swapReportTable(conn)
+    elif args.refresh == 'partitions':
+	with measureStage('load:partitions') as stage:
+	    stage['rows'] = replacePartitions(conn, facVisitRows, fields, loadPeriodIds(conn), args.load_method,
+		args.batch_size)
+    else:
+	storeVisits(conn, facVisitRows, fields, loadMethod=args.load_method, batchSize=args.batch_size,
+	    skipUnchanged=args.refresh == 'changed')
+    if args.rollups and args.refresh != 'swap':
+	storeRollups(conn)
+    return len(facVisitRows)
+
+
+def runIncremental(conn, fields, args, marks, connPool=None):
+    """
+    Refreshes only the report rows of facility visits that changed since the given high-water marks.
+    @return tuple of (number of report rows refreshed, set of the ids of their periods)
+    """
+    return refreshVisits(conn, fields, args, loadChangedVisitIds(conn, marks), connPool)
+
+
+def refreshVisits(conn, fields, args, changedVisitIds, connPool=None):
+    """
+    Refreshes the report rows of the changed facility visits, and of the later visits at the same facilities
+    whose visited_last_date may depend on them.  Their periods' --parquet files are left to exportParquet once
+    the refresh is committed.
+    @return tuple of (number of report rows refreshed, set of the ids of their periods)
+    """
+    if len(changedVisitIds) == 0:
+	return 0, set()
+
+    if args.refresh == 'partitions':
+	return refreshPeriods(conn, fields, args, changedVisitIds, connPool)
+
+    scope = VisitScope.byIds(loadAffectedVisitIds(conn, changedVisitIds))
+    facVisitRows = loadOpenLmis(conn, scope, args.itersize, args.pivot_engine, visitRowLayout(fields), connPool,
+	lastVisitDate=args.last_visit_date == 'sql')
+    facVisitRows = completeLastVisitDate(facVisitRows, loadLastVisitSeeds(conn, changedVisitIds), args)
+    storeVisits(conn, facVisitRows, fields, replaceAll=False, loadMethod=args.load_method,
+	batchSize=args.batch_size, skipUnchanged=args.refresh == 'changed')
+    periodIds = set(row['period_id'] for row in facVisitRows)
+    if args.rollups:
+	storeRollups(conn, periodIds)
+    return len(facVisitRows), periodIds
+
+
+def refreshPeriods(conn, fields, args, changedVisitIds, connPool=None):
+    """
+    Replaces the report partitions (see replacePartitions) of every period from the earliest period of the
+    changed facility visits onwards, as the later periods' visited_last_date may depend on the changed visits.
+    @return tuple of (number of report rows refreshed, set of the ids of the periods replaced)
+    """
+    cur = conn.cursor()
+    cur.execute(CHANGED_START_SQL, {'visitIds': list(changedVisitIds)})
+    startDate = cur.fetchone()[0]
+    if startDate is None:
+	cur.close()
+	return 0, set()
+    cur.execute(REPORT_LAST_VISIT_SQL, {'startDate': startDate})
+    seeds = dict(cur.fetchall())
+    cur.close()
+
+    periodIds = loadPeriodIds(conn, startDate)
+    scope = VisitScope.byPartition(PARTITION_COLUMNS['period'], periodIds)
+    facVisitRows = loadOpenLmis(conn, scope, args.itersize, args.pivot_engine, visitRowLayout(fields), connPool,
+	lastVisitDate=args.last_visit_date == 'sql')
+    facVisitRows = completeLastVisitDate(facVisitRows, seeds, args)
+    with measureStage('load:partitions') as stage:
+	stage['rows'] = replacePartitions(conn, facVisitRows, fields, periodIds, args.load_method, args.batch_size)
+    if args.rollups:
+	storeRollups(conn, periodIds)
+    return len(facVisitRows), set(periodIds)
+
+
+def writeParquet(visitRows, fieldDefs, directory, rowGroupSize=PARQUET_ROW_GROUP_SIZE):
+    """
+    Writes visit rows to a Parquet file per period, directory/period_id=<id>/part-0.parquet, partitioned the
+    way Hive and pyarrow datasets expect.  Each file has a column per field of the field map but period_id,
+    typed by the field's type (see PARQUET_TYPES) and nullable unless the field map says otherwise.  A row group
+    is written every rowGroupSize rows as they're iterated, so visitRows may be streamed.  Each file is written
+    beside its name and renamed over it, so readers never see a partial file.
+
+    @param visitRows: iterable of the visit rows ordered by period_id
+    @param fieldDefs: loadFieldDefs
+    @return list of the ids of the periods written
+    """
+    if pyarrow is None:
+	raise ImportError('pyarrow is required for --parquet')
+    names = [name for name in fieldDefs if name != 'period_id']
+    schema = pyarrow.schema([pyarrow.field(name, getattr(pyarrow, PARQUET_TYPES[fieldDefs[name]['type']])(),
+	nullable=fieldDefs[name]['nullable'] != '0') for name in names])
+
+    periodIds = []
+    with measureStage('load:parquet') as stage:
+	stage['rows'] = 0
+	for periodId, rows in itertools.groupby(visitRows, operator.itemgetter('period_id')):
+	    periodDir = os.path.join(directory, 'period_id=%d' % periodId)
+	    if not os.path.isdir(periodDir):
+		os.makedirs(periodDir)
+	    fileName = os.path.join(periodDir, 'part-0.parquet')
+	    writer = pyarrow.parquet.ParquetWriter(fileName + '.tmp', schema)
+	    try:
+		while True:
+		    rowGroup = list(itertools.islice(rows, rowGroupSize))
+		    if len(rowGroup) == 0:
+			break
+		    columns = [pyarrow.array([row.get(name) for row in rowGroup], type=field.type)
+			for name, field in zip(names, schema)]
+		    writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+		    stage['rows'] += len(rowGroup)
+	    finally:
+		writer.close()
+	    os.rename(fileName + '.tmp', fileName)
+	    periodIds.append(periodId)
+    return periodIds
+
+
+def removeParquetPeriods(directory, keptPeriodIds, periodIds=None):
+    """
+    Removes the Parquet files of periods that no longer have report rows.
+    @param keptPeriodIds: the periods just written
+    @param periodIds: the periods that were exported, None for every period
+    """
+    if not os.path.isdir(directory):
+	return
+    for dirName in os.listdir(directory):
+	match = re.match(r'^period_id=(\d+)$', dirName)
+	if match is None:
+	    continue
+	periodId = int(match.group(1))
+	if periodId not in keptPeriodIds and (periodIds is None or periodId in periodIds):
+	    shutil.rmtree(os.path.join(directory, dirName))
+
+
+def exportParquet(conn, directory, periodIds=None):
+    """
+    Writes the report rows to Parquet files (see writeParquet), streaming them from the report in period order.
+    Called once the report is committed, so the files never describe rows that are rolled back and the export
+    doesn't hold the locks of storing the report (e.g. swapReportTable's); the rows are read in a new read only
+    transaction of conn, which is rolled back.  Runs export the periods they queued, see exportPendingParquet.
+    @param periodIds: the periods to write, None for every period
+    """
+    cur = conn.cursor()
+    cur.execute('SET TRANSACTION READ ONLY')
+    cur.close()
+    fieldDefs = loadFieldDefs()
+    sql = 'SELECT ' + ','.join(fieldDefs) + ' FROM ' + FACILITY_VISIT_REPORT_TABLE
+    params = None
+    if periodIds is not None:
+	sql += ' WHERE period_id = ANY(%s)'
+	params = (list(periodIds),)
+    rows = loadVisitRows(conn, sql + ' ORDER BY period_id', params, RowLayout(fieldDefs),
+	stageName='extract:' + FACILITY_VISIT_REPORT_TABLE)
+    removeParquetPeriods(directory, writeParquet(rows, fieldDefs, directory), periodIds)
+    conn.rollback()
+
+
+def queueParquetExport(conn, periodIds=None):
+    """
+    Queues the periods whose report rows were stored in conn's transaction for exportPendingParquet, so the
+    files are written once the rows are committed, and are still written by a later run if writing them fails.
+    @param periodIds: the periods to write, None for every period
+    """
+    cur = conn.cursor()
+    cur.execute(PARQUET_PENDING_DDL)
+    if periodIds is None:
+	cur.execute('INSERT INTO ' + PARQUET_PENDING_TABLE + ' (period_id) VALUES (NULL)')
+    else:
+	cur.execute('INSERT INTO ' + PARQUET_PENDING_TABLE + ' (period_id) SELECT unnest(%s::integer[])',
+	    (list(periodIds),))
+    cur.close()
+
+
+def exportPendingParquet(conn, directory):
+    """
+    Writes the Parquet files of the periods queued by queueParquetExport (see exportParquet) and clears them
+    from the queue, committing conn's transaction.  Called once the queued periods are committed.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT to_regclass(%s)', (PARQUET_PENDING_TABLE,))
+    pending = []
+    if cur.fetchone()[0] is not None:
+	cur.execute('SELECT DISTINCT period_id FROM ' + PARQUET_PENDING_TABLE)
+	pending = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.rollback()
+    if not pending:
+	return
+
+    exportParquet(conn, directory, None if None in pending else pending)
+    cur = conn.cursor()
+    cur.execute('DELETE FROM ' + PARQUET_PENDING_TABLE + ' WHERE period_id IS NULL OR period_id = ANY(%s)',
+	([periodId for periodId in pending if periodId is not None],))
+    cur.close()
+    conn.commit()
+
+
+def rollupFields():
+    """
+    @return the integer report fields summed by the rollups, see ROLLUP_FIELD_PREFIXES
+    """
+    return [name for name, fieldDef in loadFieldDefs().iteritems()
+	if name.startswith(ROLLUP_FIELD_PREFIXES) and fieldDef['type'] == 'integer']
+
+
+def storeRollups(conn, periodIds=None, reportTable=FACILITY_VISIT_REPORT_TABLE):
+    """
+    Sums the report by each of ROLLUP_GRAINS and period into its rollup table, from the report rows just
+    stored in conn's transaction, so readers see rollups that match the report when it commits.  A rollup
+    table is only created, with a primary key of its grain and period, when it doesn't exist yet or its
+    columns no longer match the rollup fields, so its grants and the views on it are kept; otherwise its rows
+    are deleted and inserted, which doesn't lock out readers.  When periodIds is given only the rows of those
+    periods are replaced, which holds every group the report rows of those periods belong to, even if a
+    facility moved.
+    @param periodIds: the periods whose report rows were refreshed, None when the whole report was
+    @param reportTable: the table holding the report rows, FACILITY_VISIT_REPORT_SWAP_TABLE when they're
+	summed before it is swapped in, so the rollups don't hold the swap's lock on the report
+    """
+    fields = rollupFields()
+    sums = '\n    , '.join('sum(%s) AS %s' % (field, field) for field in fields)
+    cur = conn.cursor()
+    for groupColumn, tableName in ROLLUP_GRAINS:
+	with measureStage('load:rollup ' + tableName) as stage:
+	    selectSql = ROLLUP_SQL % {'groupColumn': groupColumn, 'sums': sums, 'reportTable': reportTable,
+		'where': '' if periodIds is None else 'WHERE period_id = ANY(%(periodIds)s)'}
+	    params = None if periodIds is None else {'periodIds': list(periodIds)}
+	    cur.execute(TABLE_COLUMNS_SQL, (tableName,))
+	    if [row[0] for row in cur.fetchall()] != [groupColumn, 'period_id', 'visit_count',
+		    'visited_count'] + fields:
+		cur.execute('DROP TABLE IF EXISTS ' + tableName)
+		cur.execute('CREATE TABLE ' + tableName + ' AS ' + selectSql + ' WITH NO DATA', params)
+		cur.execute('ALTER TABLE ' + tableName + ' ADD PRIMARY KEY (' + groupColumn + ', period_id)')
+		selectSql = ROLLUP_SQL % {'groupColumn': groupColumn, 'sums': sums, 'reportTable': reportTable,
+		    'where': ''}
+		params = None
+	    if params is None:
+		cur.execute('DELETE FROM ' + tableName)
+	    else:
+		cur.execute('DELETE FROM ' + tableName + ' WHERE period_id = ANY(%(periodIds)s)', params)
+	    cur.execute('INSERT INTO ' + tableName + ' ' + selectSql, params)
+	    stage['rows'] = cur.rowcount
+    cur.close()
+
+
+def completeLastVisitDate(facVisitRows, seeds, args):
+    """
+    Sets visited_last_date of visit rows that are only the tail of each facility's history, see --last-visit-date
+    @param seeds: dict of facility_id => last visit date from before the earliest of facVisitRows
+    @return the visit rows
+    """
+    if args.last_visit_date == 'python':
+	generateLastVisitDate(facVisitRows, seeds)
+	return facVisitRows
+    with measureStage('transform:visited_last_date') as stage:
+	facVisitRows = list(seedLastVisitDate(facVisitRows, seeds))
+	stage['rows'] = len(facVisitRows)
+    return facVisitRows
+
+
+def runMaterializedView(conn, args):
+    """
+    Builds the report in Postgres as FACILITY_VISIT_REPORT_VIEW, a materialized view of buildReportViewSql
+    with a unique index on visit_code.  The view is refreshed concurrently, so readers are never blocked,
+    unless the sql it was created from changed (new line item codes, field map changes), in which case it is
+    dropped and created again.
+    """
+    fieldDefs = loadFieldDefs()
+    viewSql = buildReportViewSql(conn, fieldDefs)
+    viewHash = hashlib.sha1(viewSql).hexdigest()
+
+    cur = conn.cursor()
+    cur.execute(VIEW_HASH_SQL, (FACILITY_VISIT_REPORT_VIEW,))
+    if cur.fetchone()[0] == viewHash:
+	with measureStage('load:refresh view'):
+	    cur.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY ' + FACILITY_VISIT_REPORT_VIEW)
+    else:
+	print "creating materialized view", FACILITY_VISIT_REPORT_VIEW
+	with measureStage('load:create view'):
+	    cur.execute('DROP MATERIALIZED VIEW IF EXISTS ' + FACILITY_VISIT_REPORT_VIEW)
+	    cur.execute('CREATE MATERIALIZED VIEW ' + FACILITY_VISIT_REPORT_VIEW + ' AS ' + viewSql)
+	    cur.execute('CREATE UNIQUE INDEX ' + FACILITY_VISIT_REPORT_VIEW + '_visit_code ON ' +
+		FACILITY_VISIT_REPORT_VIEW + ' (visit_code)')
+	    cur.execute('COMMENT ON MATERIALIZED VIEW ' + FACILITY_VISIT_REPORT_VIEW + ' IS %s', (viewHash,))
+
+    if args.check_view:
+	checkReportView(conn, list(fieldDefs))
+    cur.close()
+
+
+def checkReportView(conn, fields):
+    """
+    Prints how many rows of FACILITY_VISIT_REPORT_VIEW and of the report, as loaded by the other run modes,
+    differ on the given fields.  Both counts are zero when the view matches the report.
+    """
+    cur = conn.cursor()
+    cols = ', '.join(psycopg2.extensions.quote_ident(field, cur) for field in fields)
+    for left, right in [(FACILITY_VISIT_REPORT_VIEW, FACILITY_VISIT_REPORT_TABLE),
+	    (FACILITY_VISIT_REPORT_TABLE, FACILITY_VISIT_REPORT_VIEW)]:
+	cur.execute(VIEW_DIFF_SQL % {'fields': cols, 'left': left, 'right': right})
+	print "rows of", left, "not in", right, ":", cur.fetchone()[0]
+    cur.close()
+
+
+def installNotifyTriggers(conn):
+    """
+    (Re)creates the NOTIFY_TRIGGER on every table of INCREMENTAL_SOURCES, so committed changes to facility visits
+    and their line items are notified on NOTIFY_CHANNEL.
+    """
+    cur = conn.cursor()
+    cur.execute(NOTIFY_FUNCTION_SQL)
+    for tableName, idCol in INCREMENTAL_SOURCES:
+	cur.execute('DROP TRIGGER IF EXISTS ' + NOTIFY_TRIGGER + ' ON ' + tableName)
+	cur.execute(NOTIFY_TRIGGER_SQL % {'table': tableName, 'idColumn': idCol})
+    cur.close()
+
+
+def dropNotifyTriggers(conn):
+    cur = conn.cursor()
+    for tableName, idCol in INCREMENTAL_SOURCES:
+	cur.execute('DROP TRIGGER IF EXISTS ' + NOTIFY_TRIGGER + ' ON ' + tableName)
+    cur.execute('DROP FUNCTION IF EXISTS ' + NOTIFY_FUNCTION + '()')
+    cur.close()
+
+
+def listenForChanges():
+    """
+    @return a new autocommit connection listening on NOTIFY_CHANNEL
+    """
+    listenConn = psycopg2.connect(**dbConnectArgs())
+    listenConn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = listenConn.cursor()
+    cur.execute('LISTEN ' + NOTIFY_CHANNEL)
+    cur.close()
+    return listenConn
+
+
+def waitForChanges(listenConn, debounce=DAEMON_DEBOUNCE, maxWait=DAEMON_MAX_WAIT, maxBatch=DAEMON_MAX_BATCH,
+	firstNotified=None):
+    """
+    Blocks until a batch of changes has been notified: once no notification came for debounce seconds, maxWait
+    seconds after the first one, or when maxBatch facility visits have changed.
+    @param firstNotified: when the batch's first change was notified if it already has changes (e.g. of a
+	failed batch), in which case it doesn't wait for another
+    @return tuple of the set of changed facility visit ids, the number of notifications and when the first
+	one was received
+    """
+    visitIds = set()
+    notifyCount = 0
+    while True:
+	timeout = None
+	if firstNotified is not None:
+	    timeout = min(debounce, firstNotified + maxWait - time.time())
+	    if timeout <= 0 or len(visitIds) >= maxBatch:
+		break
+	if select.select([listenConn], [], [], timeout) == ([], [], []):
+	    if firstNotified is not None:
+		break # quiet for debounce seconds
+	    continue
+	listenConn.poll()
+	while listenConn.notifies:
+	    notify = listenConn.notifies.pop(0)
+	    notifyCount += 1
+	    if firstNotified is None:
+		firstNotified = time.time()
+	    if notify.payload:
+		visitIds.add(int(notify.payload))
+    return visitIds, notifyCount, firstNotified
+
+
+def runDaemon(conn, listenConn, fields, args, connPool=None):
+    """
+    Refreshes the report rows of facility visits as their changes are notified on listenConn, a batch of
+    changes at a time (see waitForChanges), until interrupted.  Reports each batch's size and its latency, the
+    time from the batch's first notification until its refresh is committed.  Facility visits that are deleted
+    keep their report rows, as in --incremental runs.
+
+    A batch that fails is rolled back and its facility visits are refreshed with the next batch, after
+    DAEMON_RETRY_DELAY seconds.  Connections that were lost are opened again, and connPool is closed and
+    created again when a batch fails with an OperationalError, as its connections may all be lost (e.g. the
+    server restarted).  Changes notified while the listening connection was lost are only refreshed by the
+    next --incremental run.
+    """
+    print 'Listening for changes on ' + NOTIFY_CHANNEL
+    failedIds = set()
+    failedNotified = None
+    try:
+	while True:
+	    refreshing = False
+	    try:
+		if listenConn.closed:
+		    listenConn = listenForChanges()
+		    print 'Listening for changes again, changes notified meanwhile are not refreshed'
+		visitIds, notifyCount, firstNotified = waitForChanges(listenConn, args.debounce, args.max_wait,
+		    args.max_batch, failedNotified)
+		visitIds.update(failedIds)
+		failedIds, failedNotified = visitIds, firstNotified # until the batch is committed
+		refreshing = True
+		if conn.closed:
+		    conn = psycopg2.connect(**dbConnectArgs())
+		if connPool is not None and connPool.closed:
+		    connPool = psycopg2.pool.ThreadedConnectionPool(1, args.workers, **dbConnectArgs())
+		with measureStage('daemon:batch') as stage:
+		    stage['rows'], periodIds = refreshVisits(conn, fields, args, visitIds, connPool)
+		    if args.parquet is not None:
+			queueParquetExport(conn, periodIds)
+		    conn.commit()
+		    stage['notifications'] = notifyCount
+		    stage['changed_visits'] = len(visitIds)
+		    stage['latency_seconds'] = time.time() - firstNotified
+		if args.parquet is not None:
+		    exportPendingParquet(conn, args.parquet) # the batch is retried if this fails
+		failedIds, failedNotified = set(), None
+	    except Exception, err:
+		if refreshing:
+		    print 'Refreshing %d changed facility visits failed, retrying in %.0fs: %s: %s' % (
+			len(failedIds), DAEMON_RETRY_DELAY, type(err).__name__, err)
+		else:
+		    print 'Listening for changes failed, retrying in %.0fs: %s: %s' % (DAEMON_RETRY_DELAY,
+			type(err).__name__, err)
+		    listenConn.close() # opened again
+		if not conn.closed:
+		    try:
+			conn.rollback()
+		    except psycopg2.Error:
+			conn.close() # opened again for the next batch
+		if connPool is not None and not connPool.closed and isinstance(err, psycopg2.OperationalError):
+		    connPool.closeall() # created again for the next batch
+		if args.prometheus_file is not None:
+		    writePrometheusTextfile(args.prometheus_file, STAGE_METRICS.totals(), False, time.time())
+		del STAGE_METRICS.stages[:]
+		time.sleep(DAEMON_RETRY_DELAY)
+		continue
+
+	    print 'Refreshed %d report rows for %d changed facility visits (%d notifications), %.2fs after the ' \
+		'first change was notified' % (stage['rows'], len(visitIds), notifyCount, stage['latency_seconds'])
+
+	    # each batch's metrics replace the last's
+	    if args.prometheus_file is not None:
+		writePrometheusTextfile(args.prometheus_file, STAGE_METRICS.totals(), True, time.time())
+	    del STAGE_METRICS.stages[:]
+    except KeyboardInterrupt:
+	print 'Stopped listening for changes'
+    finally:
+	conn.close() # closing them again in main does nothing
+	listenConn.close()
+	if connPool is not None and not connPool.closed:
+	    connPool.closeall()
+
+
+def writeMetricsLog(logFile, event, record):
+    """
+    Writes one JSON object per line to the --metrics-log file.
+    """
+    record = dict(record, event=event, time=datetime.now().isoformat())
+    logFile.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+    logFile.flush()
+
+
+def writePrometheusTextfile(path, totals, succeeded, finished):
+    """
+    Writes the run's stage totals (see StageMetrics.totals) in the Prometheus text format, for the node
+    exporter's textfile collector.  The file is written beside path and renamed over it, so the collector never
+    reads a partial file.
+    """
+    def quoteLabel(value):
+	return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+    lines = []
+    for metricName, totalName, helpText in PROMETHEUS_STAGE_METRICS:
+	lines.append('# HELP %s %s' % (metricName, helpText))
+	lines.append('# TYPE %s gauge' % metricName)
+	for stageName, total in totals.iteritems():
+	    lines.append('%s{stage=%s} %s' % (metricName, quoteLabel(stageName), repr(total[totalName])))
+    lines.append('# HELP distributions_etl_last_run_success 1 if the last run completed, 0 if it failed')
+    lines.append('# TYPE distributions_etl_last_run_success gauge')
+    lines.append('distributions_etl_last_run_success %d' % (1 if succeeded else 0))
+    lines.append('# HELP distributions_etl_last_run_timestamp_seconds When the last run finished')
+    lines.append('# TYPE distributions_etl_last_run_timestamp_seconds gauge')
+    lines.append('distributions_etl_last_run_timestamp_seconds %.3f' % finished)
+
+    f = open(path + '.tmp', 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def writeMemoryTrace(path, snapshot):
+    """
+    Writes the PROFILE_TOP allocation sites holding the most memory in a tracemalloc snapshot.
+    """
+    f = open(path, 'w')
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+	f.write(str(stat) + '\n')
+    f.close()
+
+
+def extractionQueries(conn, scope=None, pivotEngine='python', codeLists=None, lastVisitDate=False):
+    """
+    @param codeLists: the codes of each of LINE_ITEM_PIVOTS the sql pivot engine needs, selected without
+	caching them (see loadLineItemCodes) when not given
+    @return list of (name, sql, params) of the queries extractOpenLmis runs with the given scope and pivot
+	engine.  Unscoped they include the distinct code queries.
+    """
+    queries = [('extract:' + GEO_ZONE_TABLE,) + facilityGeoSql(scope)]
+    if pivotEngine == 'sql':
+	if codeLists is None:
+	    codeLists = loadLineItemCodes(conn, cacheCodes=False)
+	queries.append(('extract:pivoted ' + FACILITY_VISIT_TABLE,) + buildPivotSql(codeLists, scope,
+	    lastVisitDate))
+    else:
+	queries.append(('extract:' + FACILITY_VISIT_TABLE,) + facilityVisitSql(scope, lastVisitDate))
+	queries.extend(('extract:' + pivot.name,) + pivot.lineItemSql(scope) for pivot in LINE_ITEM_PIVOTS)
+    if scope is None:
+	queries.extend(('extract:distinct ' + pivot.name, pivot.distinctSql, None) for pivot in LINE_ITEM_PIVOTS)
+    return queries
+
+
+def explainQuery(conn, sql, params=None):
+    """
+    Runs sql under EXPLAIN (ANALYZE, BUFFERS, VERBOSE), which executes it, discarding its rows.  VERBOSE
+    qualifies every column in the plan's conditions with its table's alias, which findSeqScans relies on, as a
+    scan's own filter has unqualified columns otherwise.
+    @return the plan as EXPLAIN's JSON format has it: dict of the plan tree ('Plan'), 'Planning Time' and
+	'Execution Time' in milliseconds
+    """
+    cur = conn.cursor()
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, VERBOSE, FORMAT JSON) ' + sql, params)
+    plan = cur.fetchone()[0]
+    cur.close()
+    if isinstance(plan, basestring): # json isn't parsed by psycopg2 before 2.5
+	plan = json.loads(plan)
+    return plan[0]
+
+
+def findSeqScans(node, conditions=()):
+    """
+    Finds the sequential scans in a plan tree that read at least PROFILE_SEQ_SCAN_ROWS rows.  Each is given with
+    the columns of the scanned table its own filter and the conditions of the joins above it compare, the
+    columns an index could be used for (e.g. facilityvisitid of a line item table joined to facility visits).
+    @param node: plan node, as EXPLAIN's JSON format has it with VERBOSE (see explainQuery)
+    @param conditions: the join and filter conditions of the node's ancestors
+    @return list of dicts of table, alias, rows (read, over every loop) and columns
+    """
+    conditions = list(conditions) + [node[key] for key in ('Hash Cond', 'Merge Cond', 'Join Filter', 'Filter')
+	if key in node]
+    seqScans = []
+    if node['Node Type'] == 'Seq Scan':
+	rows = (node.get('Actual Rows', 0) + node.get('Rows Removed by Filter', 0)) * node.get('Actual Loops', 1)
+	if rows >= PROFILE_SEQ_SCAN_ROWS:
+	    columns = []
+	    for condition in conditions:
+		for alias, column in re.findall(r'\b(\w+)\.(\w+)\b', condition):
+		    if alias == node['Alias'] and column not in columns:
+			columns.append(column)
+	    seqScans.append({'table': node['Relation Name'], 'alias': node['Alias'], 'rows': rows,
+		'columns': columns})
+    for child in node.get('Plans', []):
+	seqScans.extend(findSeqScans(child, conditions))
+    return seqScans
+
+
+def suggestIndexes(conn, seqScans):
+    """
+    @param seqScans: the sequential scans of findSeqScans
+    @return sorted list of CREATE INDEX statements for the sequentially scanned columns that no index starts with
+    """
+    cur = conn.cursor()
+    statements = set()
+    for seqScan in seqScans:
+	for column in seqScan['columns']:
+	    cur.execute(INDEXED_COLUMN_SQL, (seqScan['table'], column))
+	    if not cur.fetchone()[0]:
+		statements.add('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s);' % tuple(
+		    psycopg2.extensions.quote_ident(name, cur) for name in
+		    (seqScan['table'] + '_' + column + '_idx', seqScan['table'], column)))
+    cur.close()
+    return sorted(statements)
+
+
+def profileSql(conn, args):
+    """
+    Runs the extraction queries of a full run, and of a run scoped to the PROFILE_SCOPE_SIZE latest facility
+    visits, under explainQuery.  Writes every plan with its timings and flagged sequential scans to
+    plans.json in the --profile-sql directory, and the suggested indexes (see suggestIndexes) to indexes.sql,
+    printing a summary.  The queries are executed in full, so this is best run against a replica, and nothing
+    is written to the database, e.g. the line item codes the sql pivot engine needs aren't cached.
+    """
+    cur = conn.cursor()
+    cur.execute(PROFILE_SCOPE_SQL, (PROFILE_SCOPE_SIZE,))
+    scope = VisitScope.byIds([row[0] for row in cur.fetchall()])
+    cur.close()
+    codeLists = loadLineItemCodes(conn, cacheCodes=False) if args.pivot_engine == 'sql' else None
+
+    profiles = []
+    seqScans = []
+    for scopeName, queryScope in [('full', None), ('scoped', scope)]:
+	for name, sql, params in extractionQueries(conn, queryScope, args.pivot_engine, codeLists,
+	    args.last_visit_date == 'sql'):
+	    plan = explainQuery(conn, sql, params)
+	    querySeqScans = findSeqScans(plan['Plan'])
+	    seqScans.extend(querySeqScans)
+	    profiles.append({'query': name, 'scope': scopeName, 'sql': sql, 'params': params,
+		'planning_ms': plan['Planning Time'], 'execution_ms': plan['Execution Time'],
+		'seq_scans': querySeqScans, 'plan': plan['Plan']})
+	    print '%-50s %-6s %10.1f ms  %s' % (name, scopeName, plan['Execution Time'],
+		', '.join('seq scan of %(table)s (%(rows)d rows)' % seqScan for seqScan in querySeqScans))
+    indexes = suggestIndexes(conn, seqScans)
+
+    if not os.path.isdir(args.profile_sql):
+	os.makedirs(args.profile_sql)
+    with open(os.path.join(args.profile_sql, 'plans.json'), 'w') as plansFile:
+	json.dump(profiles, plansFile, indent=2, sort_keys=True, default=str)
+    with open(os.path.join(args.profile_sql, 'indexes.sql'), 'w') as indexFile:
+	indexFile.write(''.join(statement + '\n' for statement in indexes))
+    print 'Suggested %d indexes in %s' % (len(indexes), os.path.join(args.profile_sql, 'indexes.sql'))
+    for statement in indexes:
+	print statement
+
+
+def reportMetrics(args, succeeded, started, metricsLog, profiler):
+    """
+    Writes the run's measurements to whichever of --metrics-log, --prometheus-file, --profile and
+    --trace-memory were asked for.
+    """
+    finished = time.time()
+    if metricsLog is not None:
+	writeMetricsLog(metricsLog, 'run', {'succeeded': succeeded, 'seconds': finished - started,
+	    'stages': STAGE_METRICS.totals()})
+	if metricsLog is not sys.stdout:
+	    metricsLog.close()
+    if args.prometheus_file is not None:
+	writePrometheusTextfile(args.prometheus_file, STAGE_METRICS.totals(), succeeded, finished)
+    if profiler is not None:
+	profiler.dump_stats(args.profile)
+	pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    if args.trace_memory is not None:
+	writeMemoryTrace(args.trace_memory, tracemalloc.take_snapshot())
+	tracemalloc.stop()
+
+
+def runPartitioned(conn, fields, args, marks):
+    """
+    Rebuilds the report with the facility visits split into partitions by delivery zone or by period (see
+    --partition-by), each extracted, pivoted and stored by one of a pool of worker processes.  Workers store
+    into FACILITY_VISIT_REPORT_STAGING_TABLE and see the same snapshot of the source tables.  Once every
+    partition is staged the report is replaced with the staged rows in conn's transaction (see
+    replaceReportFromStaging), so all partitions are committed together.
+
+    Each worker commits its staged rows along with a checkpoint of their partition keys, so a run that fails
+    keeps the partitions already staged and a --resume run only stages the rest (see startCheckpoint).  The
+    checkpoints are cleared by the caller, see finishCheckpoint.
+    @param marks: the high-water marks taken before the run
+    @return tuple of (number of report rows stored, the high-water marks to save: marks, or those of the run
+	resumed)
+    """
+    partitionColumn = PARTITION_COLUMNS[args.partition_by]
+    stagedKeys, marks = startCheckpoint(conn, fields, partitionColumn, marks, args.resume)
+    # the line item codes are loaded (and cached where they weren't) once, rather than by every worker at once
+    codeLists = loadLineItemCodes(conn, LINE_ITEM_CODE_MAX_AGE if args.pivot_engine == 'sql' else None)
+    conn.commit() # workers must see the staging table
+
+    keys = [key for key in loadDistinct(conn, PARTITION_KEY_SQL % {'partitionColumn': partitionColumn})
+	if key not in stagedKeys]
+    partitions = [(partitionColumn, keyChunk) for keyChunk in
+	splitPartitions(keys, args.processes * PARTITIONS_PER_PROCESS)]
+    if stagedKeys:
+	print 'Resuming with %d of %d %s partition keys already staged' % \
+	    (len(stagedKeys), len(stagedKeys) + len(keys), args.partition_by)
+
+    rowCount = 0
+    workers = multiprocessing.Pool(args.processes, initPartitionWorker, (args, fields, exportSnapshot(conn),
+	codeLists))
+    try:
+	for partitionRowCount, stages in workers.imap_unordered(runPartition, partitions):
+	    rowCount += partitionRowCount
+	    for stage in stages:
+		STAGE_METRICS.record(stage)
+	workers.close()
+    except BaseException:
+	workers.terminate()
+	raise
+    finally:
+	workers.join()
+
+    print 'Staged %d rows from %d partitions by %s' % (rowCount, len(partitions), args.partition_by)
+    rowCount = replaceReportFromStaging(conn, fields, args.refresh, args.rollups)
+    return rowCount, marks
+
+
+def startCheckpoint(conn, fields, partitionColumn, marks, resume=False):
+    """
+    Starts the checkpoints of a partitioned run: (re)creates FACILITY_VISIT_REPORT_STAGING_TABLE, logged, clears
+    CHECKPOINT_TABLE and keeps marks in CHECKPOINT_MARK_TABLE.  When resuming a run partitioned by the same
+    column whose staging table is still there, its staged rows and checkpoints are kept instead, as long as
+    the staged rows of every partition key number what its checkpoint says (see runPartition).
+    @param marks: the high-water marks taken before the run
+    @return tuple of (set of the partition keys already staged, the high-water marks of the run)
+    """
+    cur = conn.cursor()
+    cur.execute(CHECKPOINT_DDL)
+    cur.execute(CHECKPOINT_MARK_DDL)
+    if resume:
+	cur.execute('SELECT to_regclass(%s)', (FACILITY_VISIT_REPORT_STAGING_TABLE,))
+	stagingExists = cur.fetchone()[0] is not None
+	cur.execute('SELECT partition_column, partition_key, staged_rows FROM ' + CHECKPOINT_TABLE)
+	checkpoints = cur.fetchall()
+	if stagingExists and all(column == partitionColumn for column, key, stagedRows in checkpoints):
+	    cur.execute(STAGED_ROWS_SQL % {'reportColumn': PARTITION_REPORT_COLUMNS[partitionColumn]})
+	    if dict(cur.fetchall()) == dict((key, stagedRows) for column, key, stagedRows in checkpoints
+		    if stagedRows > 0):
+		cur.execute('SELECT source_table, high_water FROM ' + CHECKPOINT_MARK_TABLE)
+		resumedMarks = dict(cur.fetchall())
+		cur.close()
+		return set(key for column, key, stagedRows in checkpoints), resumedMarks
+	    print 'The staged rows do not match the checkpoints of the run partitioned by %s, starting over' % \
+		partitionColumn
+	else:
+	    print 'No run partitioned by %s to resume, starting over' % partitionColumn
+
+    createStagingTable(conn, fields, logged=True)
+    cur.execute('DELETE FROM ' + CHECKPOINT_TABLE)
+    cur.execute('DELETE FROM ' + CHECKPOINT_MARK_TABLE)
+    cur.executemany('INSERT INTO ' + CHECKPOINT_MARK_TABLE + ' (source_table, high_water) VALUES (%s, %s)',
+	marks.items())
+    cur.close()
+    return set(), marks
+
+
+def finishCheckpoint(conn):
+    """
+    Clears the checkpoints of a partitioned run and drops its staging table, in conn's transaction.  Every full
+    run does so once it has replaced the report, not only partitioned runs, so a --resume can't stage the rest
+    of a failed partitioned run onto a report that another run has replaced since.  The checkpoint tables are
+    dropped rather than emptied, as they only exist once a partitioned run started; startCheckpoint creates
+    them again.
+    """
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS ' + FACILITY_VISIT_REPORT_STAGING_TABLE)
+    cur.execute('DROP TABLE IF EXISTS ' + CHECKPOINT_TABLE)
+    cur.execute('DROP TABLE IF EXISTS ' + CHECKPOINT_MARK_TABLE)
+    cur.close()
+
+
+def runChunked(conn, fields, args, connPool=None):
+    """
+    Rebuilds the report a chunk of --chunk-size facility visit ids at a time.  Each chunk's facility visits and
+    line items (WHERE facilityvisitid BETWEEN the chunk's first and last id) are extracted, pivoted and stored
+    into FACILITY_VISIT_REPORT_STAGING_TABLE before the next chunk is loaded, so at most one chunk's rows are in
+    memory.  The report is then replaced from the staging table, see replaceReportFromStaging.
+    @return number of report rows stored
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT min(id), max(id) FROM ' + FACILITY_VISIT_TABLE)
+    firstId, lastId = cur.fetchone()
+    cur.close()
+    createStagingTable(conn, fields)
+
+    layout = visitRowLayout(fields)
+    scopes = []
+    if firstId is not None:
+	scopes = [VisitScope.byIdRange(chunkStart, chunkStart + args.chunk_size - 1)
+	    for chunkStart in xrange(firstId, lastId + 1, args.chunk_size)]
+
+    rowCount = 0
+    if args.pipeline:
+	rowCount = storeChunksPipelined(conn, fields, args, scopes)
+    else:
+	for scope in scopes:
+	    facVisitRows = loadOpenLmis(conn, scope, args.itersize, args.pivot_engine, layout, connPool)
+	    storeVisits(conn, facVisitRows, fields, loadMethod=args.load_method, batchSize=args.batch_size,
+		tableName=FACILITY_VISIT_REPORT_STAGING_TABLE, append=True)
+	    rowCount += len(facVisitRows)
+	    facVisitRows = None # release the chunk before loading the next
+
+    replaceReportFromStaging(conn, fields, args.refresh, args.rollups)
+    print 'Stored %d rows in %d chunks of %d facility visit ids' % (rowCount, len(scopes), args.chunk_size)
+    return rowCount
+
+
+def storeChunksPipelined(conn, fields, args, scopes):
+    """
+    Stores the chunks of a chunked run into FACILITY_VISIT_REPORT_STAGING_TABLE with extracting, pivoting and
+    storing overlapped, see runPipeline.  One thread extracts each chunk on a connection of its own reading
+    conn's snapshot, a second pivots the extracted chunks, and conn stores the pivoted chunks.  Every code is
+    seen across the chunks, so the cached line item codes are replaced by them.
+    @param scopes: VisitScope of each chunk
+    @return number of rows stored
+    """
+    layout = visitRowLayout(fields)
+    codeLists = loadLineItemCodes(conn, LINE_ITEM_CODE_MAX_AGE if args.pivot_engine == 'sql' else None)
+    pivotedCodes = [set() for pivot in LINE_ITEM_PIVOTS]
+
+    def extractChunks():
+	for scope in scopes:
+	    chunkCodes, results = extractOpenLmis(extractConn, scope, args.itersize, args.pivot_engine, layout,
+		codeLists=codeLists)
+	    yield list(results)
+
+    def pivotChunk(results):
+	facVisitRows, codes = transformOpenLmis(iter(results), codeLists, args.pivot_engine)
+	for chunkCodes, pivotCodes in zip(codes, pivotedCodes):
+	    pivotCodes.update(chunkCodes)
+	return facVisitRows
+
+    def storeChunk(facVisitRows):
+	storeVisits(conn, facVisitRows, fields, loadMethod=args.load_method, batchSize=args.batch_size,
+	    tableName=FACILITY_VISIT_REPORT_STAGING_TABLE, append=True)
+	return len(facVisitRows)
+
+    extractConn = psycopg2.connect(**dbConnectArgs())
+    try:
+	importSnapshot(extractConn, exportSnapshot(conn))
+	rowCounts = runPipeline(('extract', extractChunks()), [('pivot', pivotChunk), ('store', storeChunk)],
+	    args.queue_size)
+    finally:
+	extractConn.rollback()
+	extractConn.close()
+
+    if args.pivot_engine != 'sql':
+	for pivot, codes in zip(LINE_ITEM_PIVOTS, pivotedCodes):
+	    saveLineItemCodes(conn, pivot, sorted(codes), replace=True)
+    return sum(rowCounts)
+
+
+class PipelineStopped(Exception):
+    """
+    Raised in a pipeline stage waiting on a queue when another stage failed, see runPipeline
+    """
+
+
+def runPipeline(source, stages, queueSize=PIPELINE_QUEUE_SIZE):
+    """
+    Runs a producer/consumer pipeline.  The source is iterated in a thread of its own, and so is each stage
+    but the last, which runs in the calling thread.  Each stage takes the items of the one before from a
+    queue of at most queueSize items, so a stage that gets ahead blocks until the next one catches up.  Every
+    stage is measured as 'pipeline:<name>' (see measureStage) along with how long it was blocked on a full
+    output queue, starved on an empty input queue, and the max and mean depth of its input queue.  A failing
+    stage stops the pipeline and its error is raised.
+
+    @param source: tuple of (name, iterable of the items)
+    @param stages: list of (name, function of an item returning the item for the next stage)
+    @return list of the last stage's results
+    """
+    stopped = threading.Event()
+    errors = []
+    done = object()
+    queues = [Queue.Queue(queueSize) for stage in stages]
+    results = []
+    measured = []
+
+    def put(q, item, stage):
+	waitStart = time.time()
+	while True:
+	    if stopped.is_set():
+		raise PipelineStopped()
+	    try:
+		q.put(item, timeout=PIPELINE_POLL)
+		break
+	    except Queue.Full:
+		pass
+	stage['blocked_seconds'] += time.time() - waitStart
+
+    def take(q, stage):
+	while True:
+	    waitStart = time.time()
+	    while True:
+		if stopped.is_set():
+		    raise PipelineStopped()
+		try:
+		    item = q.get(timeout=PIPELINE_POLL)
+		    break
+		except Queue.Empty:
+		    pass
+	    stage['starved_seconds'] += time.time() - waitStart
+	    if item is done:
+		return
+	    depth = q.qsize() + 1
+	    stage['queue_max_depth'] = max(stage['queue_max_depth'], depth)
+	    stage['queue_mean_depth'] += (depth - stage['queue_mean_depth']) / float(stage['rows'] + 1)
+	    yield item
+
+    def runStage(name, items, fn, outQueue):
+	with measureStage('pipeline:' + name) as stage:
+	    stage.update(rows=0, blocked_seconds=0.0, starved_seconds=0.0, queue_max_depth=0, queue_mean_depth=0.0)
+	    measured.append(stage)
+	    for item in (items(stage) if callable(items) else items):
+		result = fn(item)
+		stage['rows'] += 1
+		if outQueue is None:
+		    results.append(result)
+		else:
+		    put(outQueue, result, stage)
+	    if outQueue is not None:
+		put(outQueue, done, stage)
+
+    def runThread(*stageArgs):
+	try:
+	    runStage(*stageArgs)
+	except PipelineStopped:
+	    pass
+	except BaseException:
+	    errors.append(sys.exc_info())
+	    stopped.set()
+
+    sourceName, sourceItems = source
+    threadArgs = [(sourceName, sourceItems, lambda item: item, queues[0])]
+    for i, (name, fn) in enumerate(stages[:-1]):
+	threadArgs.append((name, functools.partial(take, queues[i]), fn, queues[i + 1]))
+    threads = [threading.Thread(target=runThread, args=stageArgs) for stageArgs in threadArgs]
+    for thread in threads:
+	thread.start()
+
+    name, fn = stages[-1]
+    try:
+	runStage(name, functools.partial(take, queues[-1]), fn, None)
+    except PipelineStopped:
+	pass
+    except BaseException:
+	stopped.set()
+	raise
+    finally:
+	for thread in threads:
+	    thread.join()
+    if errors:
+	raise errors[0][0], errors[0][1], errors[0][2]
+
+    for stage in measured:
+	print '%s: %d items in %.2fs, blocked %.2fs, starved %.2fs, input queue depth max %d mean %.1f' % \
+	    (stage['stage'], stage['rows'], stage['seconds'], stage['blocked_seconds'], stage['starved_seconds'],
+	    stage['queue_max_depth'], stage['queue_mean_depth'])
+    return results
+
+
+def createStagingTable(conn, fields, logged=False):
+    """
+    (Re)creates FACILITY_VISIT_REPORT_STAGING_TABLE with the report's field columns.
+    @param logged: whether the table is logged, as it must be when its rows are kept along with checkpoints,
+	since a crash empties an unlogged table but not the checkpoints
+    """
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS ' + FACILITY_VISIT_REPORT_STAGING_TABLE)
+    cur.execute(STAGING_DDL % {'fields': ','.join(fields), 'tableKind': 'TABLE' if logged else 'UNLOGGED TABLE'})
+    cur.close()
+
+
+def replaceReportFromStaging(conn, fields, refresh='delete', rollups=False):
+    """
+    Sets visited_last_date of every row in FACILITY_VISIT_REPORT_STAGING_TABLE with STAGING_LAST_VISIT_SQL, as
+    rows staged in chunks or partitions didn't see each other, then replaces the report's rows with the staged
+    rows and drops the staging table, all in conn's transaction.
+    @param refresh: 'delete' deletes the report's rows and inserts the staged rows, 'swap' copies the staged
+	rows into a new table that is swapped in for the report (see swapReportTable)
+    @param rollups: whether to store the rollups (see storeRollups), before the swap
+    @return number of report rows stored
+    """
+    cur = conn.cursor()
+    with measureStage('transform:visited_last_date') as stage:
+	cur.execute(STAGING_LAST_VISIT_SQL)
+	stage['rows'] = cur.rowcount
+    with measureStage('load:staging') as stage:
+	targetTable = FACILITY_VISIT_REPORT_TABLE
+	if refresh == 'swap':
+	    createSwapTable(conn)
+	    targetTable = FACILITY_VISIT_REPORT_SWAP_TABLE
+	else:
+	    cur.execute('DELETE FROM ' + FACILITY_VISIT_REPORT_TABLE)
+	cur.execute('INSERT INTO ' + targetTable + ' (' + ','.join(fields) + ') SELECT ' +
+	    ','.join(fields) + ' FROM ' + FACILITY_VISIT_REPORT_STAGING_TABLE)
+	stage['rows'] = cur.rowcount
+	cur.execute('DROP TABLE ' + FACILITY_VISIT_REPORT_STAGING_TABLE)
+    cur.close()
+    if rollups:
+	storeRollups(conn, reportTable=targetTable)
+    if refresh == 'swap':
+	swapReportTable(conn)
+    return stage['rows']
+
+
+def createSwapTable(conn):
+    """
+    (Re)creates FACILITY_VISIT_REPORT_SWAP_TABLE with the report's columns, NOT NULLs and defaults but without
+    its constraints and indexes, which swapReportTable builds once the table is loaded.  The period partitioned
+    report (see reportTableDdl) isn't swapped, as LIKE copies neither its partitioning nor its partitions.
+    """
+    if reportPartitioned(conn):
+	raise Exception('--refresh swap would replace the period partitioned report with a plain table, ' +
+	    'use --refresh partitions')
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS ' + FACILITY_VISIT_REPORT_SWAP_TABLE)
+    cur.execute('CREATE TABLE ' + FACILITY_VISIT_REPORT_SWAP_TABLE + ' (LIKE ' + FACILITY_VISIT_REPORT_TABLE +
+	' INCLUDING DEFAULTS)')
+    cur.close()
+
+
+def swapReportTable(conn):
+    """
+    Replaces the report with the loaded FACILITY_VISIT_REPORT_SWAP_TABLE.  The report's constraints and indexes
+    are built on the swap table first, under temporary names, while readers still use the report.  Then the
+    report is locked, its serial sequences handed to the swap table, and the report dropped and the swap table
+    renamed in its place with the original constraint and index names and privileges.  Readers only wait from
+    the lock to conn's commit, and no dead rows are left behind.  Views on the report must be dropped first.
+    """
+    cur = conn.cursor()
+    cur.execute(REPORT_CONSTRAINT_SQL, (FACILITY_VISIT_REPORT_TABLE,))
+    constraints = cur.fetchall()
+    cur.execute(REPORT_INDEX_SQL, (FACILITY_VISIT_REPORT_TABLE,))
+    indexes = cur.fetchall()
+    cur.execute(REPORT_SEQUENCE_SQL, (FACILITY_VISIT_REPORT_TABLE,) * 3)
+    sequences = cur.fetchall()
+    cur.execute(REPORT_GRANT_SQL, (FACILITY_VISIT_REPORT_TABLE,))
+    grants = cur.fetchall()
+
+    def swapName(name):
+	return name[:58] + '_swap' # within the 63 characters of a Postgres name
+
+    def quote(name):
+	return psycopg2.extensions.quote_ident(name, cur)
+
+    with measureStage('load:swap indexes'):
+	addReportIndexes(cur, FACILITY_VISIT_REPORT_SWAP_TABLE, constraints, indexes, swapName)
+
+    with measureStage('load:swap'):
+	cur.execute('LOCK TABLE ' + FACILITY_VISIT_REPORT_TABLE + ' IN ACCESS EXCLUSIVE MODE')
+	for column, sequence in sequences:
+	    cur.execute('ALTER SEQUENCE ' + sequence + ' OWNED BY ' + FACILITY_VISIT_REPORT_SWAP_TABLE + '.' +
+		quote(column))
+	cur.execute('DROP TABLE ' + FACILITY_VISIT_REPORT_TABLE)
+	cur.execute('ALTER TABLE ' + FACILITY_VISIT_REPORT_SWAP_TABLE + ' RENAME TO ' + FACILITY_VISIT_REPORT_TABLE)
+	renameReportIndexes(cur, FACILITY_VISIT_REPORT_TABLE, constraints, indexes, swapName,
+	    lambda name: name)
+	for grantee, privilege in grants:
+	    cur.execute('GRANT ' + privilege + ' ON ' + FACILITY_VISIT_REPORT_TABLE + ' TO ' +
+		(grantee if grantee == 'PUBLIC' else quote(grantee)))
+    cur.close()
+
+
+def addReportIndexes(cur, tableName, constraints, indexes, nameFn):
+    """
+    Builds the report's constraints and indexes on tableName, each named nameFn(its name in the report).
+    @param constraints: REPORT_CONSTRAINT_SQL's rows for the report
+    @param indexes: REPORT_INDEX_SQL's rows for the report
+    """
+    for name, definition in constraints:
+	cur.execute('ALTER TABLE ' + tableName + ' ADD CONSTRAINT ' +
+	    psycopg2.extensions.quote_ident(nameFn(name), cur) + ' ' + definition)
+    for name, definition in indexes:
+	# CREATE [UNIQUE] INDEX name ON [ONLY] table USING ...
+	definition = re.sub(r'^(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+',
+	    lambda m: m.group(1) + psycopg2.extensions.quote_ident(nameFn(name), cur) + m.group(2) + tableName,
+	    definition)
+	cur.execute(definition)
+
+
+def renameReportIndexes(cur, tableName, constraints, indexes, fromFn, toFn):
+    """
+    Renames the constraints and indexes addReportIndexes built on tableName from fromFn(name) to toFn(name)
+    """
+    def quote(name):
+	return psycopg2.extensions.quote_ident(name, cur)
+
+    for name, definition in constraints:
+	cur.execute('ALTER TABLE ' + tableName + ' RENAME CONSTRAINT ' + quote(fromFn(name)) + ' TO ' +
+	    quote(toFn(name)))
+    for name, definition in indexes:
+	cur.execute('ALTER INDEX ' + quote(fromFn(name)) + ' RENAME TO ' + quote(toFn(name)))
+
+
+def reportTableDdl(fieldDefs, sources=False):
+    """
+    Generates the DDL of the report table from the field map: a column per field of the field map's type,
+    NOT NULL unless nullable and with its constraint, list partitioned by period_id with REPORT_INDEX_COLUMNS
+    indexed.  replacePartitions creates and replaces the partitions, one per processing period.  Unique
+    constraints of a partitioned table must include the partition key, so the primary key is (id, period_id)
+    and visit_code is unique along with period_id (which visit_code already implies).
+
+    With sources it's the DDL of FACILITY_VISIT_REPORT_SOURCES_TABLE instead, the report of --sources runs,
+    which isn't partitioned.  It has no foreign keys, as its rows come from several source databases, and its
+    unique constraints include SOURCE_KEY_COLUMN, as visit codes are only unique within their source.
+
+    @param fieldDefs: loadFieldDefs
+    @param sources: whether to generate the DDL of FACILITY_VISIT_REPORT_SOURCES_TABLE
+    @return the sql statements
+    """
+    tableName = FACILITY_VISIT_REPORT_TABLE
+    cols = ['id serial']
+    tableConstraints = ['PRIMARY KEY (id, period_id)']
+    uniqueColumns = '%s, period_id'
+    if sources:
+	tableName = FACILITY_VISIT_REPORT_SOURCES_TABLE
+	cols.append(SOURCE_KEY_COLUMN + ' text NOT NULL')
+	tableConstraints = ['PRIMARY KEY (id)']
+	uniqueColumns = SOURCE_KEY_COLUMN + ', %s'
+    for name, fieldDef in fieldDefs.iteritems():
+	col = name + ' ' + fieldDef['type']
+	if fieldDef['nullable'] == '0':
+	    col += ' NOT NULL'
+	if fieldDef['constraint'] == 'unique':
+	    tableConstraints.append('UNIQUE (' + uniqueColumns % name + ')')
+	elif fieldDef['constraint'] and not sources: # the other constraints are the foreign keys
+	    col += ' ' + fieldDef['constraint']
+	cols.append(col)
+    cols.append(ROW_HASH_COLUMN + ' text')
+
+    ddl = 'CREATE TABLE ' + tableName + ' ( ' + '\n\t, '.join(cols + tableConstraints) + '\n)' + \
+	('' if sources else ' PARTITION BY LIST (period_id)') + ';\n'
+    for column in REPORT_INDEX_COLUMNS:
+	ddl += 'CREATE INDEX ' + tableName + '_' + column + ' ON ' + tableName + ' (' + column + ');\n'
+    return ddl
+
+
+def partitionName(name, periodId):
+    """
+    @return the name of a period's partition of the report, or of the partition's constraint or index of the
+	given name in the report
+    """
+    suffix = '_p%d' % periodId
+    return name[:63 - len(suffix)] + suffix # within the 63 characters of a Postgres name
+
+
+def replacePartitions(conn, visitRows, fields, periodIds, loadMethod='copy', batchSize=LOAD_BATCH_SIZE):
+    """
+    Replaces the partitions of the period partitioned report (see reportTableDdl) of the given periods with
+    visitRows, which must be every report row of those periods.  Each period's rows are loaded into a new
+    table, which gets the report's constraints and indexes, while readers still use the old partition.  The
+    old partition is then detached and dropped, and the new table attached in its place.  A period without
+    rows is left without a partition.  Readers see the new partitions at conn's commit.
+    @return number of rows written
+    """
+    byPeriod = {}
+    for visitD in visitRows:
+	byPeriod.setdefault(visitD['period_id'], []).append(visitD)
+    unknownPeriods = set(byPeriod).difference(periodIds)
+    if unknownPeriods:
+	raise ValueError('Rows of periods not being replaced: ' + str(sorted(unknownPeriods)))
+
+    cur = conn.cursor()
+    cur.execute(REPORT_CONSTRAINT_SQL, (FACILITY_VISIT_REPORT_TABLE,))
+    constraints = cur.fetchall()
+    cur.execute(REPORT_INDEX_SQL, (FACILITY_VISIT_REPORT_TABLE,))
+    indexes = cur.fetchall()
+
+    rowCount = 0
+    for periodId in periodIds:
+	finalName = functools.partial(partitionName, periodId=periodId)
+	newName = lambda name: finalName(name)[:59] + '_new'
+	partition = finalName(FACILITY_VISIT_REPORT_TABLE)
+	rows = byPeriod.get(periodId)
+	if rows:
+	    cur.execute('DROP TABLE IF EXISTS ' + newName(FACILITY_VISIT_REPORT_TABLE))
+	    cur.execute('CREATE TABLE ' + newName(FACILITY_VISIT_REPORT_TABLE) + ' (LIKE ' +
+		FACILITY_VISIT_REPORT_TABLE + ' INCLUDING DEFAULTS, CHECK (period_id = %d))' % periodId)
+	    rowCount += replaceVisits(conn, rows, fields, False, loadMethod, batchSize,
+		newName(FACILITY_VISIT_REPORT_TABLE), True)
+	    addReportIndexes(cur, newName(FACILITY_VISIT_REPORT_TABLE), constraints, indexes, newName)
+
+	cur.execute('SELECT to_regclass(%s)', (partition,))
+	if cur.fetchone()[0] is not None:
+	    cur.execute('ALTER TABLE ' + FACILITY_VISIT_REPORT_TABLE + ' DETACH PARTITION ' + partition)
+	    cur.execute('DROP TABLE ' + partition)
+	if rows:
+	    cur.execute('ALTER TABLE ' + newName(FACILITY_VISIT_REPORT_TABLE) + ' RENAME TO ' + partition)
+	    renameReportIndexes(cur, partition, constraints, indexes, newName, finalName)
+	    cur.execute('ALTER TABLE ' + FACILITY_VISIT_REPORT_TABLE + ' ATTACH PARTITION ' + partition +
+		' FOR VALUES IN (%d)' % periodId)
+    cur.close()
+    return rowCount
+
+
+def splitPartitions(keys, count):
+    """
+    @return keys split into at most count lists of consecutive keys, of about the same length
+    """
+    size = max(1, -(-len(keys) // count))
+    return [keys[start:start + size] for start in xrange(0, len(keys), size)]
+
+
+# The db connection and run options of a partition worker process, see initPartitionWorker
+PARTITION_WORKER = {}
+
+
+# The run options of a source worker process, see initSourceWorker
+SOURCE_WORKER = {}
+
+
+def initPartitionWorker(args, fields, snapshotId, codeLists):
+    """
+    Starts a partition worker process with its own db connection, that reads the source tables as of the
+    exported snapshot snapshotId.
+    @param codeLists: the codes of each of LINE_ITEM_PIVOTS, as the parent loaded them
+    """
+    del STAGE_METRICS.listeners[:] # the parent logs the stages workers return
+    conn = psycopg2.connect(**dbConnectArgs())
+    multiprocessing.util.Finalize(conn, conn.close, exitpriority=10)
+    PARTITION_WORKER.update(conn=conn, args=args, fields=fields, snapshotId=snapshotId, codeLists=codeLists)
+
+
+def runPartition(partition):
+    """
+    Extracts, pivots and stores the facility visits of one partition into the staging table, committing them.
+    Runs in a partition worker process.
+    @param partition: tuple of the distributions column partitioned by and a list of its values
+    @return tuple of the number of rows stored and the partition's measured stages
+    """
+    conn = PARTITION_WORKER['conn']
+    args = PARTITION_WORKER['args']
+    fields = PARTITION_WORKER['fields']
+    del STAGE_METRICS.stages[:]
+    try:
+	importSnapshot(conn, PARTITION_WORKER['snapshotId'])
+	facVisitRows = loadOpenLmis(conn, VisitScope.byPartition(*partition), args.itersize, args.pivot_engine,
+	    visitRowLayout(fields), codeLists=PARTITION_WORKER['codeLists'])
+	storeVisits(conn, facVisitRows, fields, loadMethod=args.load_method, batchSize=args.batch_size,
+	    tableName=FACILITY_VISIT_REPORT_STAGING_TABLE, append=True)
+	# each key's staged rows are counted, so a resumed run can tell they're all still staged
+	partitionColumn, keys = partition
+	stagedRows = dict((key, 0) for key in keys)
+	for facVisitD in facVisitRows:
+	    stagedRows[facVisitD[PARTITION_REPORT_COLUMNS[partitionColumn]]] += 1
+	cur = conn.cursor()
+	cur.executemany('INSERT INTO ' + CHECKPOINT_TABLE + ' (partition_column, partition_key, staged_rows) ' +
+	    'VALUES (%s, %s, %s)', [(partitionColumn, key, count) for key, count in stagedRows.iteritems()])
+	cur.close()
+	conn.commit() # the partition's rows and checkpoint together
+    except BaseException:
+	conn.rollback()
+	raise
+    return len(facVisitRows), list(STAGE_METRICS.stages)
+
+
+def dbConnectArgs():
+    """
+    @return keyword arguments for psycopg2.connect.  Text is decoded straight to unicode, see register_type above.
+    """
+    return {'host': DB_HOST, 'port': DB_PORT, 'database': DB_NAME, 'user': DB_USER, 'client_encoding': 'UTF8'}
+
+
+def loadSources(fileName):
+    """
+    Reads the source databases of --sources from an INI file with a section per source, named by the source's
+    key, of SOURCE_OPTIONS.  e.g.:
+
+	[north]
+	host = lmis-north.example.org
+	database = open_lmis
+
+    @return OrderedDict of source key => keyword arguments for psycopg2.connect, see dbConnectArgs
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(fileName):
+	raise IOError('Sources file not found: ' + fileName)
+    sources = OrderedDict()
+    for sourceKey in config.sections():
+	unknown = set(config.options(sourceKey)).difference(SOURCE_OPTIONS)
+	if unknown:
+	    raise ValueError('Unknown options of source ' + sourceKey + ': ' + ', '.join(sorted(unknown)))
+	sources[sourceKey] = dbConnectArgs()
+	sources[sourceKey].update(config.items(sourceKey))
+    if not sources:
+	raise ValueError('No sources in ' + fileName)
+    return sources
+
+
+def runSources(conn, fields, args):
+    """
+    Rebuilds FACILITY_VISIT_REPORT_SOURCES_TABLE in conn's database, creating it when missing (see
+    reportTableDdl), from every source database of --sources (see loadSources).  Each source is extracted and
+    pivoted by its own worker process, so the sources are extracted concurrently and the run takes about as
+    long as the slowest of them.  Their rows are tagged with their source's key (see tagSourceRows) and
+    stored together, replacing every row of the table.
+    @return number of report rows stored
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT to_regclass(%s)', (FACILITY_VISIT_REPORT_SOURCES_TABLE,))
+    if cur.fetchone()[0] is None:
+	cur.execute(reportTableDdl(loadFieldDefs(), sources=True))
+    cur.close()
+
+    sources = loadSources(args.sources)
+    sourceFields = [SOURCE_KEY_COLUMN] + fields
+    facVisitRows = []
+    workers = multiprocessing.Pool(len(sources), initSourceWorker, (args, sourceFields))
+    try:
+	for sourceKey, sourceRows, stages in workers.imap_unordered(runSource, sources.items()):
+	    print 'Extracted %d rows from source %s' % (len(sourceRows), sourceKey)
+	    facVisitRows.extend(sourceRows)
+	    for stage in stages:
+		STAGE_METRICS.record(stage)
+	workers.close()
+    except BaseException:
+	workers.terminate()
+	raise
+    finally:
+	workers.join()
+
+    storeVisits(conn, facVisitRows, sourceFields, loadMethod=args.load_method, batchSize=args.batch_size,
+	tableName=FACILITY_VISIT_REPORT_SOURCES_TABLE)
+    return len(facVisitRows)
+
+
+def initSourceWorker(args, fields):
+    """
+    Starts a source worker process.
+    @param fields: the fields of FACILITY_VISIT_REPORT_SOURCES_TABLE, SOURCE_KEY_COLUMN and the report fields
+    """
+    del STAGE_METRICS.listeners[:] # the parent logs the stages workers return
+    SOURCE_WORKER.update(args=args, fields=fields)
+
+
+def runSource(source):
+    """
+    Extracts and pivots the facility visits of one source database, over --workers connections, and computes
+    their visited_last_date.  Runs in a source worker process.  Nothing is written to the source, its
+    connection is read only and the line item codes aren't cached in it, as sources may be replicas.
+    @param source: tuple of the source key and its connection arguments
+    @return tuple of the source key, its facility visit rows (see tagSourceRows) and its measured stages
+    """
+    sourceKey, connectArgs = source
+    args = SOURCE_WORKER['args']
+    del STAGE_METRICS.stages[:]
+    conn = psycopg2.connect(**connectArgs)
+    conn.set_session(readonly=True) # sources may be replicas, or their user may not create tables
+    connPool = None
+    try:
+	if args.workers > 1:
+	    connPool = psycopg2.pool.ThreadedConnectionPool(1, args.workers, **connectArgs)
+	facVisitRows = loadOpenLmis(conn, itersize=args.itersize, pivotEngine=args.pivot_engine,
+	    layout=visitRowLayout(SOURCE_WORKER['fields']), connPool=connPool, cacheCodes=False,
+	    lastVisitDate=args.last_visit_date == 'sql')
+	if args.last_visit_date == 'python':
+	    generateLastVisitDate(facVisitRows)
+    finally:
+	if connPool is not None:
+	    connPool.closeall()
+	conn.rollback()
+	conn.close()
+    return sourceKey, tagSourceRows(facVisitRows, sourceKey), list(STAGE_METRICS.stages)
+
+
+def tagSourceRows(facVisitRows, sourceKey):
+    """
+    Sets SOURCE_KEY_COLUMN of every facility visit row to its source's key, which tells apart the rows of
+    sources with the same visit codes or ids.
+    @return facVisitRows
+    """
+    for facVisitD in facVisitRows:
+	facVisitD[SOURCE_KEY_COLUMN] = sourceKey
+    return facVisitRows
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Denormalizes OpenLMIS facility visits into ' +
+	FACILITY_VISIT_REPORT_TABLE)
+    parser.add_argument('--incremental', action='store_true',
+	help='only refresh facility visits changed since the last run (full refresh if there was none)')
+    parser.add_argument('--load-method', choices=['copy', 'insert'], default='copy',
+	help='how report rows are written: COPY FROM STDIN (default) or multi-row INSERT statements')
+    parser.add_argument('--batch-size', type=int, default=LOAD_BATCH_SIZE,
+	help='report rows sent per COPY or INSERT statement (default: %(default)s)')
+    parser.add_argument('--itersize', type=int, default=EXTRACT_ITER_SIZE,
+	help='source rows fetched per round trip by the extraction cursors (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+	help='source tables extracted concurrently, each over its own pooled connection (default: %(default)s)')
+    parser.add_argument('--pivot-engine', choices=['python', 'sql', 'numpy'], default='python',
+	help='how line items are pivoted into report columns: in Python (default), in one generated ' +
+	'Postgres query, or with vectorized NumPy arrays')
+    parser.add_argument('--last-visit-date', choices=['python', 'sql'], default='python',
+	help='how visited_last_date is computed: by sorting every visit in Python (default) or by the window ' +
+	'function in the facility visit query')
+    parser.add_argument('--partition-by', choices=sorted(PARTITION_COLUMNS), default=None,
+	help='rebuild the report in partitions of facility visits by delivery zone or by period, extracted, ' +
+	'pivoted and stored in parallel by --processes worker processes and committed together')
+    parser.add_argument('--resume', action='store_true',
+	help='with --partition-by, keep the partitions a failed partitioned run already staged and only run ' +
+	'the rest, unless another full run completed since')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+	help='worker processes of a partitioned run, each with its own connection (default: %(default)s)')
+    parser.add_argument('--sources', default=None, metavar='FILE',
+	help='rebuild the report from every source database listed in the INI file FILE, a section per source ' +
+	'named by its key with any of ' + ', '.join(SOURCE_OPTIONS) + ', each extracted by its own worker ' +
+	'process.  The report is stored in ' + FACILITY_VISIT_REPORT_SOURCES_TABLE + ' of the DB_NAME database, ' +
+	'created when missing, with each row\'s source key in its ' + SOURCE_KEY_COLUMN + ' column')
+    parser.add_argument('--daemon', action='store_true',
+	help='after the run, install triggers notifying changes to facility visits and their line items and ' +
+	'keep refreshing the report rows of changed facility visits as changes are notified')
+    parser.add_argument('--debounce', type=float, default=DAEMON_DEBOUNCE,
+	help='--daemon waits for this many seconds without changes before refreshing (default: %(default)s)')
+    parser.add_argument('--max-wait', type=float, default=DAEMON_MAX_WAIT,
+	help='--daemon refreshes at most this many seconds after the first change (default: %(default)s)')
+    parser.add_argument('--max-batch', type=int, default=DAEMON_MAX_BATCH,
+	help='--daemon refreshes as soon as this many facility visits changed (default: %(default)s)')
+    parser.add_argument('--drop-triggers', action='store_true',
+	help='drop the triggers --daemon installs, and do nothing else')
+    parser.add_argument('--refresh', choices=['delete', 'swap', 'partitions', 'changed'], default='delete',
+	help='how a full run replaces the report: delete its rows and insert the new ones (default), load ' +
+	'a new table, index it and swap it in for the report (not for the period partitioned report), replace ' +
+	'each period\'s partition of the period partitioned report (see --report-ddl), or only write the ' +
+	'rows whose hash changed and delete the ones no longer generated.  Incremental runs with partitions ' +
+	'replace the partitions of every period from the earliest changed one, and with changed only write the ' +
+	'changed rows')
+    parser.add_argument('--report-ddl', default=None, metavar='FILE',
+	help='write the DDL of the period partitioned report, generated from the field map, to FILE (- for ' +
+	'standard output), and do nothing else.  With --sources, the DDL of ' +
+	FACILITY_VISIT_REPORT_SOURCES_TABLE + ' instead')
+    parser.add_argument('--chunk-size', type=int, default=None,
+	help='rebuild the report a chunk of this many facility visit ids at a time, holding only one chunk ' +
+	'in memory')
+    parser.add_argument('--materialized-view', action='store_true',
+	help='build the report in Postgres as the materialized view ' + FACILITY_VISIT_REPORT_VIEW +
+	' instead, refreshing it concurrently (or creating it when the line item codes or field map changed)')
+    parser.add_argument('--check-view', action='store_true',
+	help='with --materialized-view, print how many rows of the view and of the report table differ')
+    parser.add_argument('--rollups', action='store_true',
+	help='also sum the report\'s epi inventory, epi use and coverage columns by district, province and ' +
+	'delivery zone per period into rollup tables.  Incremental runs only replace the refreshed periods')
+    parser.add_argument('--parquet', default=None, metavar='DIR',
+	help='also write the report rows to Parquet files in DIR, one per period ' +
+	'(period_id=<id>/part-0.parquet). ' +
+	'The files are written once the report is committed, incremental runs only rewrite the refreshed ' +
+	'periods\' files.  Requires pyarrow')
+    parser.add_argument('--pipeline', action='store_true',
+	help='with --chunk-size, extract, pivot and store the chunks in threads connected by bounded queues, so ' +
+	'extracting, pivoting and storing overlap')
+    parser.add_argument('--queue-size', type=int, default=PIPELINE_QUEUE_SIZE,
+	help='--pipeline chunks that may wait between two of its stages (default: %(default)s)')
+    parser.add_argument('--metrics-log', default=None, metavar='FILE',
+	help='append a JSON line per stage (wall time, rows, bytes fetched, peak memory) and per run to FILE, ' +
+	'- for standard output')
+    parser.add_argument('--prometheus-file', default=None, metavar='FILE',
+	help='write the stage metrics to FILE for the Prometheus node exporter\'s textfile collector')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+	help='run under cProfile, saving the stats to FILE and printing the top functions by cumulative time')
+    parser.add_argument('--profile-sql', default=None, metavar='DIR',
+	help='run the extraction queries under EXPLAIN (ANALYZE, BUFFERS), writing their plans and timings to ' +
+	'DIR/plans.json and indexes for the sequential scans of large tables to DIR/indexes.sql, and do nothing ' +
+	'else.  The queries are run in full, unscoped and scoped to the latest facility visits')
+    parser.add_argument('--trace-memory', default=None, metavar='FILE',
+	help='trace allocations with tracemalloc, writing the top allocation sites at the end of the run to FILE')
+    args = parser.parse_args(argv)
+    if args.partition_by is not None and args.incremental:
+	parser.error('--partition-by only applies to full runs, not --incremental')
+    if args.refresh == 'swap' and args.incremental:
+	parser.error('--refresh swap only applies to full runs, not --incremental')
+    if args.refresh in ('partitions', 'changed') and \
+	    (args.partition_by is not None or args.chunk_size is not None):
+	parser.error('--refresh ' + args.refresh + ' does not apply to --partition-by or --chunk-size runs')
+    if args.chunk_size is not None and (args.incremental or args.partition_by is not None):
+	parser.error('--chunk-size only applies to full runs, not --incremental or --partition-by')
+    if args.materialized_view and (args.incremental or args.daemon or args.partition_by is not None or
+	    args.chunk_size is not None or args.refresh != 'delete' or args.rollups or args.parquet is not None):
+	parser.error('--materialized-view does not apply to --incremental, --daemon, --partition-by, ' +
+	    '--chunk-size, --refresh, --rollups or --parquet runs')
+    if args.resume and args.partition_by is None:
+	parser.error('--resume only applies to --partition-by runs')
+    if args.pipeline and args.chunk_size is None:
+	parser.error('--pipeline only applies to --chunk-size runs')
+    if args.check_view and not args.materialized_view:
+	parser.error('--check-view only applies to --materialized-view')
+    if args.sources is not None and (args.incremental or args.daemon or args.partition_by is not None or
+	    args.chunk_size is not None or args.materialized_view or args.refresh != 'delete' or args.rollups or
+	    args.parquet is not None):
+	# --refresh swap and changed, --rollups and --parquet only apply to the report table, which isn't stored
+	parser.error('--sources only applies to full runs, not --incremental, --daemon, --partition-by, ' +
+	    '--chunk-size, --materialized-view, --refresh, --rollups or --parquet')
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if args.trace_memory is not None and tracemalloc is None:
+	raise ImportError('tracemalloc is required for --trace-memory')
+    if args.parquet is not None and pyarrow is None:
+	raise ImportError('pyarrow is required for --parquet')
+
+    metricsLog = None
+    if args.metrics_log is not None:
+	metricsLog = sys.stdout if args.metrics_log == '-' else open(args.metrics_log, 'a')
+	STAGE_METRICS.listeners.append(lambda stage: writeMetricsLog(metricsLog, 'stage', stage))
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if args.trace_memory is not None:
+	tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    if args.report_ddl is not None:
+	ddlFile = sys.stdout if args.report_ddl == '-' else open(args.report_ddl, 'w')
+	ddlFile.write(reportTableDdl(loadFieldDefs(), args.sources is not None))
+	if ddlFile is not sys.stdout:
+	    ddlFile.close()
+	return
+
+    if args.drop_triggers:
+	conn = psycopg2.connect(**dbConnectArgs())
+	try:
+	    dropNotifyTriggers(conn)
+	    conn.commit()
+	finally:
+	    conn.close()
+	return
+
+    if args.profile_sql is not None:
+	conn = psycopg2.connect(**dbConnectArgs())
+	conn.set_session(readonly=True) # profiling only reads, so it runs on replicas
+	try:
+	    profileSql(conn, args)
+	finally:
+	    conn.rollback()
+	    conn.close()
+	return
+
+    dbConn = None
+    listenConn = None
+    connPool = None
+    succeeded = False
+    started = time.time()
+    try:
+	if profiler is not None:
+	    profiler.enable()
+	with measureStage('run') as stage:
+	    dbConn = psycopg2.connect(**dbConnectArgs())
+	    if args.workers > 1 and args.sources is None: # source workers pool their own connections
+		connPool = psycopg2.pool.ThreadedConnectionPool(1, args.workers, **dbConnectArgs())
+	    if args.daemon:
+		# listen before the run, so changes committed while it runs are refreshed after it
+		installNotifyTriggers(dbConn)
+		dbConn.commit()
+		listenConn = listenForChanges()
+
+	    # load desired field list, marks are taken before extracting so no change made during the run is missed.
+	    # They're only taken once incremental runs keep them, as taking them reads every source table, and
+	    # runs from --sources have none as the report isn't in a source database.
+	    fields = loadFields()
+	    keepMarks = args.sources is None and (args.incremental or args.daemon or highWaterMarksKept(dbConn))
+	    newMarks = currentHighWaterMarks(dbConn) if keepMarks else {}
+	    marks = loadHighWaterMarks(dbConn) if keepMarks else {}
+	    exportPeriodIds = None # the periods to write to --parquet, None for every period
+
+	    if args.materialized_view:
+		runMaterializedView(dbConn, args)
+	    elif (args.incremental or args.daemon) and marks:
+		stage['rows'], exportPeriodIds = runIncremental(dbConn, fields, args, marks, connPool)
+	    elif args.sources is not None:
+		stage['rows'] = runSources(dbConn, fields, args)
+	    else:
+		if args.partition_by is not None:
+		    stage['rows'], newMarks = runPartitioned(dbConn, fields, args, newMarks)
+		elif args.chunk_size is not None:
+		    stage['rows'] = runChunked(dbConn, fields, args, connPool)
+		else:
+		    stage['rows'] = runFull(dbConn, fields, args, connPool)
+		finishCheckpoint(dbConn)
+
+	    # the periods to export are committed with the marks, so the next run exports them if this one fails to
+	    if args.parquet is not None:
+		queueParquetExport(dbConn, exportPeriodIds)
+	    if keepMarks:
+		saveHighWaterMarks(dbConn, newMarks)
+	    dbConn.commit()
+	    if args.parquet is not None:
+		exportPendingParquet(dbConn, args.parquet)
+	succeeded = True
+
+	print "distributions-etl has completed"
+	if listenConn is not None:
+	    runDaemon(dbConn, listenConn, fields, args, connPool)
+    except BaseException, err:
+	if dbConn is not None:
+	    dbConn.rollback()
+	raise 
+    finally:
+	if profiler is not None:
+	    profiler.disable()
+	if connPool is not None and not connPool.closed: # runDaemon closes its own
+	    connPool.closeall()
+	if listenConn is not None:
+	    listenConn.close()
+	if dbConn is not None:
+	    dbConn.close()
+	reportMetrics(args, succeeded, started, metricsLog, profiler)
+
+
+if __name__ == '__main__':
+    main()
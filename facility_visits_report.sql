@@ -216,4 +216,5 @@ CREATE TABLE facility_visits_report ( id serial PRIMARY KEY
 	, full_vaccinations_male_mb integer
 	, full_vaccinations_female_hc integer
 	, full_vaccinations_female_mb integer
+	, row_hash text
 );
@@ -0,0 +1,525 @@
+"""
+Tests of distributions-etl.py: the line item pivots, compared with pivotLineItems, and the helpers of change
+detection, profiling, sources, partitioned and pipelined runs and the Parquet export.  With a Postgres given by
+DISTRIBUTIONS_ETL_TEST_DSN, also the pivots and the report view done in Postgres, compared on fixture source
+tables, and the rollups and index suggestions.  Run with python -m unittest discover from this directory.  The
+fixture tables are temporary, and every test's transaction is rolled back.
+"""
+from collections import OrderedDict
+from datetime import date
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# libpq connection string of a Postgres to run the fixture tests in, they're skipped without one
+TEST_DSN = os.environ.get('DISTRIBUTIONS_ETL_TEST_DSN')
+
+etl = None
+
+
+def setUpModule():
+    global etl
+    try:
+	etl = imp.load_source('distributions_etl', os.path.join(HERE, 'distributions-etl.py'))
+    except ImportError, err: # psycopg2, which every test needs the module for
+	raise unittest.SkipTest(str(err))
+    etl.FIELD_MAP = os.path.join(HERE, etl.FIELD_MAP)
+
+
+# Line items of each of LINE_ITEM_PIVOTS, as (facility visit id, list of line item dicts) ordered by visit.
+# Visits have only some of the codes, and visit 2 has no full coverage.
+LINE_ITEMS = [
+    [(1, [{'productcode': 'bcg20', 'existingquantity': 1, 'spoiledquantity': 2, 'deliveredquantity': 3,
+	    'idealquantity': 4},
+	{'productcode': 'polio10', 'existingquantity': 5, 'spoiledquantity': None, 'deliveredquantity': 7,
+	    'idealquantity': 8}]),
+     (2, [{'productcode': 'bcg20', 'existingquantity': 9, 'spoiledquantity': 10, 'deliveredquantity': 11,
+	    'idealquantity': 12}]),
+     (3, [{'productcode': 'polio10', 'existingquantity': 13, 'spoiledquantity': 14, 'deliveredquantity': 15,
+	    'idealquantity': 16}])],
+    [(1, [{'product_code': '1bcg', 'first_of_month': 1, 'received': 2, 'distributed': 3, 'loss': 4,
+	    'end_of_month': 5, 'expiration': None},
+	{'product_code': '3polio', 'first_of_month': 6, 'received': 7, 'distributed': 8, 'loss': 9,
+	    'end_of_month': 10, 'expiration': None}]),
+     (2, [{'product_code': '3polio', 'first_of_month': 11, 'received': 12, 'distributed': 13, 'loss': 14,
+	    'end_of_month': 15, 'expiration': None}]),
+     (3, [{'product_code': '1bcg', 'first_of_month': 16, 'received': 17, 'distributed': 18, 'loss': 19,
+	    'end_of_month': 20, 'expiration': None}])],
+    [(1, [{'demographicgroup': 'Pregnant Women', 'healthcentertetanus1': 1, 'outreachtetanus1': 2,
+	    'healthcentertetanus2to5': 3, 'outreachtetanus2to5': 4, 'targetgroup': 5}]),
+     (2, [{'demographicgroup': 'Pregnant Women', 'healthcentertetanus1': 6, 'outreachtetanus1': 7,
+	    'healthcentertetanus2to5': 8, 'outreachtetanus2to5': 9, 'targetgroup': 10},
+	{'demographicgroup': 'Students not MIF', 'healthcentertetanus1': 11, 'outreachtetanus1': 12,
+	    'healthcentertetanus2to5': 13, 'outreachtetanus2to5': 14, 'targetgroup': 15}]),
+     (3, [{'demographicgroup': 'Students not MIF', 'healthcentertetanus1': 16, 'outreachtetanus1': 17,
+	    'healthcentertetanus2to5': 18, 'outreachtetanus2to5': 19, 'targetgroup': 20}])],
+    [(1, [{'vaccination': 'BCG', 'healthcenter11months': 1, 'outreach11months': 2, 'healthcenter23months': 3,
+	    'outreach23months': 4, 'targetgroup': 5}]),
+     (2, [{'vaccination': 'Polio 1st dose', 'healthcenter11months': 6, 'outreach11months': 7,
+	    'healthcenter23months': 8, 'outreach23months': 9, 'targetgroup': 10}]),
+     (3, [{'vaccination': 'BCG', 'healthcenter11months': 11, 'outreach11months': 12, 'healthcenter23months': 13,
+	    'outreach23months': 14, 'targetgroup': 15},
+	{'vaccination': 'Polio 1st dose', 'healthcenter11months': 16, 'outreach11months': 17,
+	    'healthcenter23months': 18, 'outreach23months': 19, 'targetgroup': 20}])],
+    [(1, [{'productvialname': 'BCG', 'openedvials': 1}, {'productvialname': 'Polio', 'openedvials': 2}]),
+     (2, [{'productvialname': 'Polio', 'openedvials': 3}]),
+     (3, [{'productvialname': 'BCG', 'openedvials': 4}])]]
+
+
+# The source tables the fixture needs, as temporary tables in place of any OpenLMIS tables of the database
+FIXTURE_DDL = """CREATE TEMP TABLE geographic_levels (id integer, code text);
+CREATE TEMP TABLE geographic_zones (id integer, parentid integer, levelid integer);
+CREATE TEMP TABLE facilities (id integer, code text, geographiczoneid integer);
+CREATE TEMP TABLE delivery_zones (id integer);
+CREATE TEMP TABLE processing_periods (id integer, startdate date);
+CREATE TEMP TABLE distributions (id integer, deliveryzoneid integer, periodid integer);
+CREATE TEMP TABLE facility_visits (id integer, facilityid integer, distributionid integer, visited boolean,
+    visitdate date, confirmedbyname text, confirmedbytitle text, verifiedbyname text, verifiedbytitle text,
+    reasonfornotvisiting text, otherreasondescription text, observations text, facilitycatchmentpopulation integer,
+    modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE full_coverages (facilityvisitid integer, femalehealthcenter integer, femaleoutreach integer,
+    malehealthcenter integer, maleoutreach integer, modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE adult_coverage_opened_vial_line_items (facilityvisitid integer, openedvials integer,
+    modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE product_groups (id integer, code text);
+CREATE TEMP TABLE epi_inventory_line_items (facilityvisitid integer, productcode text, existingquantity integer,
+    spoiledquantity integer, deliveredquantity integer, idealquantity integer,
+    modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE epi_use_line_items (facilityvisitid integer, productgroupid integer, stockatfirstofmonth integer,
+    stockatendofmonth integer, expirationdate text, received integer, distributed integer, loss integer,
+    modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE vaccination_adult_coverage_line_items (facilityvisitid integer, demographicgroup text,
+    healthcentertetanus1 integer, outreachtetanus1 integer, healthcentertetanus2to5 integer,
+    outreachtetanus2to5 integer, targetgroup integer, modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE vaccination_child_coverage_line_items (facilityvisitid integer, vaccination text,
+    healthcenter11months integer, outreach11months integer, healthcenter23months integer, outreach23months integer,
+    targetgroup integer, modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE child_coverage_opened_vial_line_items (facilityvisitid integer, productvialname text,
+    openedvials integer, modifieddate timestamp DEFAULT now());
+CREATE TEMP TABLE facility_visits_report_etl_codes (line_item_table text NOT NULL, code text NOT NULL,
+    cached_at timestamptz NOT NULL DEFAULT now(), PRIMARY KEY (line_item_table, code));
+
+INSERT INTO geographic_levels VALUES (1, 'country'), (2, 'commune'), (3, 'dept');
+INSERT INTO geographic_zones VALUES (1, NULL, 1), (2, 1, 2), (3, 2, 3), (4, 2, 3);
+INSERT INTO facilities VALUES (1, 'F1', 3), (2, 'F2', 4);
+INSERT INTO delivery_zones VALUES (1);
+INSERT INTO processing_periods VALUES (1, '2014-05-01'), (2, '2014-06-01');
+INSERT INTO distributions VALUES (1, 1, 1), (2, 1, 2);
+INSERT INTO facility_visits VALUES (1, 1, 1, true, '2014-05-10', 'a', 'b', 'c', 'd', NULL, NULL, 'ok', 100),
+    (2, 2, 1, false, NULL, NULL, NULL, NULL, NULL, 'ROAD', 'flooded', NULL, 200),
+    (3, 1, 2, true, '2014-06-12', 'a', 'b', 'c', 'd', NULL, NULL, NULL, 110);
+INSERT INTO full_coverages VALUES (1, 1, 2, 3, 4), (3, 5, 6, 7, 8);
+INSERT INTO adult_coverage_opened_vial_line_items VALUES (1, 3), (2, NULL), (3, 4);
+INSERT INTO product_groups VALUES (1, '1bcg'), (3, '3polio');"""
+
+
+def fixtureInsertSql():
+    """
+    @return the sql inserting LINE_ITEMS into the fixture's line item tables
+    """
+    lineItemTables = [('epi_inventory_line_items', LINE_ITEMS[0], ['productcode', 'existingquantity',
+	    'spoiledquantity', 'deliveredquantity', 'idealquantity']),
+	('vaccination_adult_coverage_line_items', LINE_ITEMS[2], ['demographicgroup', 'healthcentertetanus1',
+	    'outreachtetanus1', 'healthcentertetanus2to5', 'outreachtetanus2to5', 'targetgroup']),
+	('vaccination_child_coverage_line_items', LINE_ITEMS[3], ['vaccination', 'healthcenter11months',
+	    'outreach11months', 'healthcenter23months', 'outreach23months', 'targetgroup']),
+	('child_coverage_opened_vial_line_items', LINE_ITEMS[4], ['productvialname', 'openedvials'])]
+
+    def literal(value):
+	return 'NULL' if value is None else "'%s'" % value
+
+    sql = []
+    for table, visitItems, cols in lineItemTables:
+	for visitId, lineItems in visitItems:
+	    for li in lineItems:
+		sql.append('INSERT INTO %s (facilityvisitid, %s) VALUES (%d, %s);' % (table, ', '.join(cols),
+		    visitId, ', '.join(literal(li[col]) for col in cols)))
+    for visitId, lineItems in LINE_ITEMS[1]:
+	for li in lineItems:
+	    # product group ids are the codes' first digit, expirations are MM/YYYY text in the source table
+	    sql.append('INSERT INTO epi_use_line_items (facilityvisitid, productgroupid, stockatfirstofmonth, ' +
+		'stockatendofmonth, expirationdate, received, distributed, loss) VALUES ' +
+		"(%d, %s, %d, %d, '%02d/2015', %d, %d, %d);" % (visitId, li['product_code'][0],
+		li['first_of_month'], li['end_of_month'], li['loss'] % 12 + 1, li['received'], li['distributed'],
+		li['loss']))
+    return '\n'.join(sql)
+
+
+def fixturePivot(pivot, lineItems):
+    """
+    @return a copy of a LineItemPivot that loads the given line items rather than its source table
+    """
+    return etl.LineItemPivot(pivot.source, pivot.keyColName, pivot.cols, pivot.rename, pivot.distinctSql,
+	loader=lambda conn, scope, itersize: iter(lineItems), name=pivot.name)
+
+
+class PivotTest(unittest.TestCase):
+    """
+    The pivots of the Python and NumPy pivot engines give the columns and values pivotLineItems does.
+    """
+
+    def testColumnLayout(self):
+	for pivot, visitItems in zip(etl.LINE_ITEM_PIVOTS, LINE_ITEMS):
+	    codes = sorted(set(li[pivot.keyColName] for visitId, lineItems in visitItems for li in lineItems))
+	    expected = [pivot.rename(code + '_' + col) for code in codes for col in pivot.cols]
+	    self.assertEqual(list(pivot.columnLayout(codes)), expected)
+	self.assertEqual(etl.EPI_INV_PIVOT.columnLayout(['bcg20']).keys(), ['epi_inventory_bcg_existing',
+	    'epi_inventory_bcg_spoiled', 'epi_inventory_bcg_delivered', 'epi_inventory_bcg_isa'])
+
+    def testPythonPivot(self):
+	for pivot, visitItems in zip(etl.LINE_ITEM_PIVOTS, LINE_ITEMS):
+	    visitValues, codes = etl.extractLineItemValues(None, fixturePivot(pivot, visitItems))
+	    pivotD, codes = etl.pivotLineItemValues(pivot, visitValues, codes)
+	    self.assertEqual(pivotD, etl.pivotLineItems(visitItems, pivot.keyColName, codes, pivot.cols,
+		pivot.rename))
+
+    def testNumpyPivot(self):
+	if etl.numpy is None:
+	    self.skipTest('numpy is not installed')
+	for pivot, visitItems in zip(etl.LINE_ITEM_PIVOTS, LINE_ITEMS):
+	    codes = sorted(set(li[pivot.keyColName] for visitId, lineItems in visitItems for li in lineItems))
+	    lineItems = [(visitId, li) for visitId, visitLineItems in visitItems for li in visitLineItems]
+	    columns = ([visitId for visitId, li in lineItems], [li[pivot.keyColName] for visitId, li in lineItems],
+		[[li[col] for visitId, li in lineItems] for col in pivot.cols])
+	    pivotLayout = etl.PivotLayout([pivot], [codes])
+	    rowLayout = etl.RowLayout(['id'] + pivotLayout.columns)
+	    rows = [etl.VisitRow(rowLayout, [visitId] + [None] * len(pivotLayout.columns)) for visitId in [1, 2, 3]]
+	    etl.mapLineItemPivotsNumpy(rows, pivotLayout, [columns])
+
+	    expected = etl.pivotLineItems(visitItems, pivot.keyColName, codes, pivot.cols, pivot.rename)
+	    for row in rows:
+		self.assertEqual(dict((col, row[col]) for col in pivotLayout.columns),
+		    expected.get(row['id'], dict.fromkeys(pivotLayout.columns)))
+
+
+class ChangeDetectionTest(unittest.TestCase):
+    """
+    rowHash tells the changed report rows storeChangedVisits writes from the unchanged ones.
+    """
+
+    def testCopyValue(self):
+	self.assertEqual([etl.copyValue(value) for value in [None, True, False, 3, date(2015, 1, 2),
+	    u'a\tb\\c\nd', u'\xe9']], ['\\N', 't', 'f', '3', '2015-01-02', 'a\\tb\\\\c\\nd', '\xc3\xa9'])
+
+    def testRowHash(self):
+	fields = ['visit_code', 'visited', 'epi_inventory_bcg_spoiled']
+	row = {'visit_code': u'F1-2014-05', 'visited': True, 'epi_inventory_bcg_spoiled': 2}
+	rowHash = etl.rowHash(row, fields)
+	self.assertEqual(etl.rowHash(dict(row), fields), rowHash)
+	self.assertEqual(etl.rowHash(dict(row, observations=u'ok'), fields), rowHash) # not a hashed field
+	for changed in [{'epi_inventory_bcg_spoiled': 3}, {'epi_inventory_bcg_spoiled': None}, {'visited': False}]:
+	    self.assertNotEqual(etl.rowHash(dict(row, **changed), fields), rowHash)
+
+
+class SeqScanTest(unittest.TestCase):
+    """
+    findSeqScans finds the large sequential scans of a plan with the columns their conditions compare.
+    """
+
+    def testFindSeqScans(self):
+	plan = {'Node Type': 'Hash Join', 'Hash Cond': '(li.facilityvisitid = fv.id)', 'Plans': [
+	    {'Node Type': 'Seq Scan', 'Relation Name': 'epi_use_line_items', 'Alias': 'li', 'Actual Rows': 20000,
+		'Actual Loops': 1, 'Filter': '(li.productgroupid IS NOT NULL)'},
+	    {'Node Type': 'Hash', 'Plans': [
+		{'Node Type': 'Nested Loop', 'Join Filter': '(f.id = fv.facilityid)', 'Plans': [
+		    {'Node Type': 'Seq Scan', 'Relation Name': 'facility_visits', 'Alias': 'fv',
+			'Actual Rows': 10, 'Rows Removed by Filter': 9990, 'Actual Loops': 1,
+			'Filter': "(fv.id = ANY ('{1,2}'::integer[]))"},
+		    {'Node Type': 'Seq Scan', 'Relation Name': 'facilities', 'Alias': 'f', 'Actual Rows': 2,
+			'Actual Loops': 10}]}]}]}
+	self.assertEqual(etl.findSeqScans(plan), [
+	    {'table': 'epi_use_line_items', 'alias': 'li', 'rows': 20000,
+		'columns': ['facilityvisitid', 'productgroupid']},
+	    {'table': 'facility_visits', 'alias': 'fv', 'rows': 10000, 'columns': ['id', 'facilityid']}])
+
+
+class SourcesTest(unittest.TestCase):
+    """
+    The sources of --sources are read from their INI file, and their rows are tagged and stored in their own
+    table.
+    """
+
+    def setUp(self):
+	self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+	shutil.rmtree(self.directory)
+
+    def writeSources(self, text):
+	fileName = os.path.join(self.directory, 'sources.ini')
+	with open(fileName, 'w') as sourcesFile:
+	    sourcesFile.write(text)
+	return fileName
+
+    def testLoadSources(self):
+	sources = etl.loadSources(self.writeSources('[north]\nhost = north.example.org\n\n[south]\n' +
+	    'database = lmis_south\n'))
+	self.assertEqual(sources.keys(), ['north', 'south'])
+	self.assertEqual(sources['north'], dict(etl.dbConnectArgs(), host='north.example.org'))
+	self.assertEqual(sources['south'], dict(etl.dbConnectArgs(), database='lmis_south'))
+	self.assertRaises(ValueError, etl.loadSources, self.writeSources('[north]\nhots = north.example.org\n'))
+	self.assertRaises(ValueError, etl.loadSources, self.writeSources(''))
+
+    def testTagSourceRows(self):
+	layout = etl.visitRowLayout([etl.SOURCE_KEY_COLUMN, 'visit_code'])
+	rows = etl.tagSourceRows([etl.VisitRow(layout, [None, u'F1-2014-05'] + [None] * (len(layout.columns) - 2))],
+	    'north')
+	self.assertEqual((rows[0][etl.SOURCE_KEY_COLUMN], rows[0]['visit_code']), ('north', u'F1-2014-05'))
+
+    def testSourcesDdl(self):
+	fieldDefs = etl.loadFieldDefs()
+	self.assertIn('references', etl.reportTableDdl(fieldDefs))
+	ddl = etl.reportTableDdl(fieldDefs, sources=True)
+	self.assertIn('CREATE TABLE ' + etl.FACILITY_VISIT_REPORT_SOURCES_TABLE + ' ', ddl)
+	self.assertIn('UNIQUE (source_key, visit_code)', ddl)
+	self.assertNotIn('references', ddl)
+	self.assertNotIn('PARTITION BY', ddl)
+
+
+class SplitPartitionsTest(unittest.TestCase):
+    """
+    splitPartitions splits partition keys into lists of consecutive keys of about the same length.
+    """
+
+    def testSplitPartitions(self):
+	self.assertEqual(etl.splitPartitions(range(10), 4), [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]])
+	self.assertEqual(etl.splitPartitions([1, 2], 4), [[1], [2]])
+	self.assertEqual(etl.splitPartitions([], 4), [])
+
+
+class PipelineTest(unittest.TestCase):
+    """
+    runPipeline passes every item through its stages in order, and raises the error of a failing stage.
+    """
+
+    def testPipeline(self):
+	results = etl.runPipeline(('numbers', xrange(100)), [('double', lambda x: 2 * x), ('add', lambda x: x + 1)],
+	    queueSize=2)
+	self.assertEqual(results, [2 * x + 1 for x in xrange(100)])
+
+    def testFailingStage(self):
+	def fail(x):
+	    if x == 3:
+		raise ValueError('stage failed')
+	    return x
+	self.assertRaises(ValueError, etl.runPipeline, ('numbers', xrange(100)), [('fail', fail),
+	    ('same', lambda x: x)])
+
+
+class ParquetTest(unittest.TestCase):
+    """
+    writeParquet writes a file per period, and removeParquetPeriods removes the files of the periods that
+    were exported without rows.
+    """
+
+    def setUp(self):
+	self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+	shutil.rmtree(self.directory)
+
+    def testWriteParquet(self):
+	if etl.pyarrow is None:
+	    self.skipTest('pyarrow is not installed')
+	fieldDefs = etl.loadFieldDefs()
+	fieldDefs = OrderedDict((name, fieldDefs[name]) for name in ['visit_code', 'period_id', 'visited',
+	    'epi_inventory_bcg_spoiled'])
+	rows = [{'visit_code': u'F1-2014-05', 'period_id': 1, 'visited': True, 'epi_inventory_bcg_spoiled': 2},
+	    {'visit_code': u'F2-2014-05', 'period_id': 1, 'visited': False, 'epi_inventory_bcg_spoiled': None},
+	    {'visit_code': u'F1-2014-06', 'period_id': 2, 'visited': True, 'epi_inventory_bcg_spoiled': 4}]
+	self.assertEqual(etl.writeParquet(rows, fieldDefs, self.directory, rowGroupSize=1), [1, 2])
+	table = etl.pyarrow.parquet.read_table(os.path.join(self.directory, 'period_id=1', 'part-0.parquet'))
+	self.assertEqual(dict(table.to_pydict()), {'visit_code': [u'F1-2014-05', u'F2-2014-05'],
+	    'visited': [True, False], 'epi_inventory_bcg_spoiled': [2, None]})
+	self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'period_id=2'))), ['part-0.parquet'])
+
+    def testRemoveParquetPeriods(self):
+	for periodId in [1, 2, 3]:
+	    os.makedirs(os.path.join(self.directory, 'period_id=%d' % periodId))
+	etl.removeParquetPeriods(self.directory, [1], [1, 2])
+	self.assertEqual(sorted(os.listdir(self.directory)), ['period_id=1', 'period_id=3'])
+	etl.removeParquetPeriods(self.directory, [1])
+	self.assertEqual(os.listdir(self.directory), ['period_id=1'])
+
+
+class FixtureTestCase(unittest.TestCase):
+    """
+    Runs each test in a transaction of the DISTRIBUTIONS_ETL_TEST_DSN database with the fixture source tables,
+    rolled back afterwards.
+    """
+
+    def setUp(self):
+	if TEST_DSN is None:
+	    self.skipTest('DISTRIBUTIONS_ETL_TEST_DSN is not set')
+	self.conn = etl.psycopg2.connect(TEST_DSN)
+	cur = self.conn.cursor()
+	cur.execute(FIXTURE_DDL)
+	cur.execute(fixtureInsertSql())
+	cur.close()
+
+    def tearDown(self):
+	self.conn.rollback()
+	self.conn.close()
+
+    def loadPythonPivoted(self, layout):
+	"""
+	@return dict of facility visit id => report values, from the fixture's facility visits and line items
+	    pivoted by pivotLineItems
+	"""
+	facVisitRows = list(etl.loadFacilityVisits(self.conn, layout))
+	for pivot in etl.LINE_ITEM_PIVOTS:
+	    codes = sorted(etl.loadDistinct(self.conn, pivot.distinctSql))
+	    pivotD = etl.pivotLineItems(list(pivot.loadLineItems(self.conn)), pivot.keyColName, codes, pivot.cols,
+		pivot.rename)
+	    columns = pivot.columnLayout(codes).keys()
+	    for facVisitD in facVisitRows:
+		facVisitD.update(pivotD.get(facVisitD['id'], dict.fromkeys(columns)).iteritems())
+	return dict((fv['id'], dict(zip(layout.columns, fv.values))) for fv in facVisitRows)
+
+
+class SqlPivotTest(FixtureTestCase):
+    """
+    buildPivotSql pivots the fixture's line items as pivotLineItems does.
+    """
+
+    def testSqlPivot(self):
+	layout = etl.visitRowLayout()
+	codeLists = [sorted(etl.loadDistinct(self.conn, pivot.distinctSql)) for pivot in etl.LINE_ITEM_PIVOTS]
+	sqlRows = dict((fv['id'], dict(zip(layout.columns, fv.values))) for fv in
+	    etl.loadPivotedFacilityVisits(self.conn, layout, codeLists=codeLists))
+	self.assertEqual(sqlRows, self.loadPythonPivoted(layout))
+
+    def testScopedSqlPivot(self):
+	layout = etl.visitRowLayout()
+	codeLists = [sorted(etl.loadDistinct(self.conn, pivot.distinctSql)) for pivot in etl.LINE_ITEM_PIVOTS]
+	sqlRows = etl.loadPivotedFacilityVisits(self.conn, layout, etl.VisitScope.byIds([2]), codeLists=codeLists)
+	self.assertEqual([dict(zip(layout.columns, fv.values)) for fv in sqlRows],
+	    [self.loadPythonPivoted(layout)[2]])
+
+
+class ReportViewTest(FixtureTestCase):
+    """
+    The report's materialized view (buildReportViewSql) has the rows a Python run builds from the fixture.
+    """
+
+    def testReportView(self):
+	fieldDefs = etl.loadFieldDefs()
+	layout = etl.visitRowLayout(list(fieldDefs))
+	facVisitRows = etl.loadOpenLmis(self.conn, layout=layout)
+	etl.generateLastVisitDate(facVisitRows)
+	expected = dict((fv['visit_code'], dict((name, fv[name]) for name in fieldDefs)) for fv in facVisitRows)
+
+	cur = etl.getDictCursor(self.conn)
+	cur.execute(etl.buildReportViewSql(self.conn, fieldDefs))
+	viewRows = dict((row['visit_code'], dict(row)) for row in cur.fetchall())
+	cur.close()
+	self.assertEqual(len(viewRows), 3)
+	self.assertEqual(viewRows, expected)
+
+
+class ReadOnlySourceTest(FixtureTestCase):
+    """
+    Sources of --sources are extracted without writing to them (see runSource), so they may be read only.
+    """
+
+    def testReadOnlySource(self):
+	cur = self.conn.cursor()
+	cur.execute('DROP TABLE ' + etl.LINE_ITEM_CODE_TABLE) # the fixture's, caching codes would create it
+	cur.execute('SET TRANSACTION READ ONLY')
+	cur.close()
+	layout = etl.visitRowLayout()
+	for pivotEngine in ['python', 'sql']:
+	    facVisitRows = etl.loadOpenLmis(self.conn, pivotEngine=pivotEngine, layout=layout, cacheCodes=False)
+	    self.assertEqual(sorted(fv['id'] for fv in facVisitRows), [1, 2, 3])
+
+
+class HighWaterMarkTest(FixtureTestCase):
+    """
+    An incremental run picks up a row committed after the high-water marks were taken, though its modifieddate
+    is below the latest one, as long as it is within HIGH_WATER_OVERLAP.
+    """
+
+    def testLateCommit(self):
+	cur = self.conn.cursor()
+	for tableName, idCol in etl.INCREMENTAL_SOURCES:
+	    cur.execute('UPDATE ' + tableName + " SET modifieddate = now() - interval '1 day'")
+	cur.execute("UPDATE facility_visits SET modifieddate = now() WHERE id = 3")
+	cur.execute('SELECT now()::timestamp')
+	now = cur.fetchone()[0]
+	marks = etl.currentHighWaterMarks(self.conn)
+	self.assertEqual(marks['facility_visits'], now - etl.HIGH_WATER_OVERLAP)
+	self.assertEqual(etl.loadChangedVisitIds(self.conn, marks), set([3]))
+
+	# written by a transaction that started a minute before the marks were taken, committed after
+	cur.execute("INSERT INTO full_coverages VALUES (2, 1, 1, 1, 1, now() - interval '1 minute')")
+	cur.close()
+	self.assertEqual(etl.loadChangedVisitIds(self.conn, marks), set([2, 3]))
+
+
+class RollupTest(FixtureTestCase):
+    """
+    storeRollups sums a report by grain and period, replacing only the given periods' sums, and keeps its
+    rollup tables from one run to the next.
+    """
+
+    def setUp(self):
+	FixtureTestCase.setUp(self)
+	cur = self.conn.cursor()
+	cur.execute('CREATE TEMP TABLE ' + etl.FACILITY_VISIT_REPORT_TABLE + ' (' + ', '.join(name + ' ' +
+	    fieldDef['type'] for name, fieldDef in etl.loadFieldDefs().iteritems()) + ')')
+	cur.execute('INSERT INTO ' + etl.FACILITY_VISIT_REPORT_TABLE + ' (visit_code, district_id, province_id, ' +
+	    'delivery_zone_id, period_id, visited, epi_inventory_bcg_spoiled) VALUES ' +
+	    "('a', 3, 2, 1, 1, true, 2), ('b', 3, 2, 1, 1, false, 3), ('c', 4, 2, 1, 1, true, 4), " +
+	    "('d', 3, 2, 1, 2, true, 5)")
+	cur.close()
+
+    def loadDistrictRollup(self):
+	"""
+	@return the district rollup's rows of district, period, visit count, visited count and bcg spoiled
+	"""
+	cur = self.conn.cursor()
+	cur.execute('SELECT district_id, period_id, visit_count, visited_count, epi_inventory_bcg_spoiled FROM ' +
+	    dict(etl.ROLLUP_GRAINS)['district_id'] + ' ORDER BY district_id, period_id')
+	rows = cur.fetchall()
+	cur.close()
+	return rows
+
+    def testRollups(self):
+	etl.storeRollups(self.conn)
+	self.assertEqual(self.loadDistrictRollup(), [(3, 1, 2, 1, 5), (3, 2, 1, 1, 5), (4, 1, 1, 1, 4)])
+
+	cur = self.conn.cursor()
+	cur.execute('UPDATE ' + etl.FACILITY_VISIT_REPORT_TABLE + ' SET epi_inventory_bcg_spoiled = 7')
+	cur.execute('SELECT to_regclass(%s)::oid', (dict(etl.ROLLUP_GRAINS)['district_id'],))
+	tableOid = cur.fetchone()[0]
+	etl.storeRollups(self.conn, [2])
+	self.assertEqual(self.loadDistrictRollup(), [(3, 1, 2, 1, 5), (3, 2, 1, 1, 7), (4, 1, 1, 1, 4)])
+	etl.storeRollups(self.conn)
+	self.assertEqual(self.loadDistrictRollup(), [(3, 1, 2, 1, 14), (3, 2, 1, 1, 7), (4, 1, 1, 1, 7)])
+	cur.execute('SELECT to_regclass(%s)::oid', (dict(etl.ROLLUP_GRAINS)['district_id'],))
+	self.assertEqual(cur.fetchone()[0], tableOid) # refreshed, not created again
+	cur.close()
+
+
+class SuggestIndexesTest(FixtureTestCase):
+    """
+    suggestIndexes suggests an index for every sequentially scanned column no index starts with.
+    """
+
+    def testSuggestIndexes(self):
+	cur = self.conn.cursor()
+	cur.execute('CREATE INDEX ON facility_visits (id)')
+	cur.close()
+	seqScans = [{'table': 'facility_visits', 'alias': 'fv', 'rows': 10000, 'columns': ['id', 'facilityid']},
+	    {'table': 'facility_visits', 'alias': 'fv', 'rows': 10000, 'columns': ['facilityid']}]
+	self.assertEqual(etl.suggestIndexes(self.conn, seqScans), ['CREATE INDEX CONCURRENTLY IF NOT EXISTS ' +
+	    'facility_visits_facilityid_idx ON facility_visits (facilityid);'])
+
+
+if __name__ == '__main__':
+    unittest.main()